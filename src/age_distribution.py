@@ -0,0 +1,194 @@
+# Age/gender histograms of patient cohorts, rendered headless in parallel
+import os
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# Histograms of all of a cohort's patients, not just one month's
+ALL_MONTHS = "all"
+
+# Same colors as PatientDB.get_n_colors
+TABLEAU_COLORS = [
+    "tab:blue",
+    "tab:orange",
+    "tab:green",
+    "tab:red",
+    "tab:purple",
+    "tab:brown",
+    "tab:pink",
+    "tab:gray",
+    "tab:olive",
+    "tab:cyan",
+]
+
+
+def get_patient_age_arrays(patients, compare_date):
+    """Ages, gender codes and visit months of the patients in one pass.
+
+    Patients without a date of birth or gender are left out, like
+    PatientDB.calculate_age_gender_distribution. Returns patient IDs, ages,
+    gender codes, the gender names, and (patient row, month) pairs with one
+    pair per month a patient has visits in.
+    """
+    c = Counter()
+    gender_codes = dict()
+    patient_ids = []
+    ages = []
+    genders = []
+    month_rows = []
+    months = []
+    for patient in patients.patients:
+        c["total_patients"] += 1
+        if not patient.date_of_birth:
+            c["patients_without_dob"] += 1
+            continue
+        if not patient.gender:
+            c["patients_without_gender"] += 1
+            continue
+        # Full years old, like PatientDB.calculate_patient_ages
+        age = int((compare_date - patient.date_of_birth).days / 365)
+        if age < 0:
+            c["patients_with_negative_age"] += 1
+            continue
+        row = len(patient_ids)
+        patient_ids.append(patient.patient_id)
+        ages.append(age)
+        genders.append(gender_codes.setdefault(str(patient.gender), len(gender_codes)))
+        patient_months = {visit.date.strftime("%Y-%m") for visit in patient.visits}
+        for month in sorted(patient_months):
+            month_rows.append(row)
+            months.append(month)
+    print(f"{c}", flush=True)
+
+    # Sort genders so colors don't depend on patient order
+    gender_names = sorted(gender_codes)
+    gender_order = np.array([gender_codes[gender] for gender in gender_names])
+    sorted_codes = np.empty(len(gender_names), dtype=np.int64)
+    sorted_codes[gender_order] = np.arange(len(gender_names))
+    genders = sorted_codes[np.array(genders, dtype=np.int64)]
+    return (
+        np.array(patient_ids, dtype=str),
+        np.array(ages, dtype=np.int64),
+        genders,
+        gender_names,
+        np.array(month_rows, dtype=np.int64),
+        np.array(months, dtype=str),
+    )
+
+
+def count_age_genders(ages, genders, num_genders, age_bins):
+    """Gender x age bin counts, the last bin includes its right edge."""
+    bins = np.searchsorted(age_bins, ages, side="right") - 1
+    bins[ages == age_bins[-1]] = len(age_bins) - 2
+    in_range = (bins >= 0) & (bins < len(age_bins) - 1)
+    num_bins = len(age_bins) - 1
+    flat_bins = genders[in_range] * num_bins + bins[in_range]
+    counts = np.bincount(flat_bins, minlength=num_genders * num_bins)
+    return counts.reshape(num_genders, num_bins)
+
+
+def calculate_age_gender_histograms(
+    patients, cohorts, compare_date, age_bins=None, split_by_month=True
+):
+    """Age/gender histograms of every cohort and month in one pass.
+
+    cohorts maps a cohort name to a set of patient IDs, None for all
+    patients. Returns a dict with the gender names, the age bin edges (one
+    per year of the ages by default) and (cohort, month) -> gender x age bin
+    counts, month is ALL_MONTHS for the whole cohort.
+    """
+    patient_ids, ages, genders, gender_names, month_rows, months = (
+        get_patient_age_arrays(patients, compare_date)
+    )
+    if age_bins is None:
+        max_age = int(ages.max()) if len(ages) else 0
+        age_bins = np.arange(0, max_age + 2)
+    age_bins = np.asarray(age_bins)
+    unique_months = np.unique(months).tolist()
+
+    histograms = dict()
+    for cohort, cohort_patient_ids in cohorts.items():
+        if cohort_patient_ids is None:
+            in_cohort = np.ones(len(patient_ids), dtype=bool)
+        else:
+            in_cohort = np.isin(patient_ids, list(cohort_patient_ids))
+        histograms[(cohort, ALL_MONTHS)] = count_age_genders(
+            ages[in_cohort], genders[in_cohort], len(gender_names), age_bins
+        )
+        if not split_by_month:
+            continue
+        cohort_rows = month_rows[in_cohort[month_rows]]
+        cohort_months = months[in_cohort[month_rows]]
+        for month in unique_months:
+            rows = cohort_rows[cohort_months == month]
+            if not len(rows):
+                continue
+            histograms[(cohort, month)] = count_age_genders(
+                ages[rows], genders[rows], len(gender_names), age_bins
+            )
+
+    return {
+        "genders": gender_names,
+        "age_bins": age_bins,
+        "histograms": histograms,
+    }
+
+
+def render_age_gender_histogram(task):
+    """Render one stacked age/gender histogram to a PNG with the Agg backend."""
+    path, title, gender_names, age_bins, counts = task
+    # A bare Figure doesn't touch pyplot's global state, so it's safe in workers
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    colors = [TABLEAU_COLORS[i % len(TABLEAU_COLORS)] for i in range(len(gender_names))]
+    left_edges = age_bins[:-1]
+    ax.hist(
+        [left_edges] * len(gender_names),
+        bins=age_bins,
+        weights=list(counts),
+        density=counts.sum() > 0,
+        histtype="bar",
+        stacked=True,
+        color=colors,
+        label=gender_names,
+    )
+    ax.legend()
+    ax.set_title(title)
+    ax.set_xlabel("Age(Years)", fontsize=16)
+    ax.set_ylabel("Count", fontsize=16)
+    fig.savefig(path)
+    return path
+
+
+def get_histogram_path(output_dir, cohort, month):
+    if month == ALL_MONTHS:
+        return f"{output_dir}/{cohort}_dist.png"
+    return f"{output_dir}/{cohort}_{month}_dist.png"
+
+
+def render_age_gender_histograms(age_gender_histograms, output_dir, num_workers=1):
+    """Render every histogram to output_dir, in a process pool with num_workers > 1."""
+    os.makedirs(output_dir, exist_ok=True)
+    gender_names = age_gender_histograms["genders"]
+    age_bins = age_gender_histograms["age_bins"]
+    tasks = [
+        (
+            get_histogram_path(output_dir, cohort, month),
+            f"{cohort} {month}",
+            gender_names,
+            age_bins,
+            counts,
+        )
+        for (cohort, month), counts in sorted(
+            age_gender_histograms["histograms"].items()
+        )
+    ]
+    print(f"Rendering {len(tasks)} age histograms to {output_dir}", flush=True)
+    if num_workers <= 1:
+        return [render_age_gender_histogram(task) for task in tasks]
+    with Pool(num_workers) as pool:
+        return list(pool.imap(render_age_gender_histogram, tasks, chunksize=4))
@@ -0,0 +1,286 @@
+# Timing and memory measurements of benchmark stages
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import psutil
+
+# Seconds between RSS samples while a stage runs
+RSS_SAMPLE_INTERVAL = 0.05
+
+# Number of source lines reported per traced stage
+TOP_ALLOCATORS = 10
+
+# Allocations of the tracing machinery itself
+TRACEMALLOC_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def get_rss_mb(process=None):
+    process = process or psutil.Process()
+    return process.memory_info().rss / 2**20
+
+
+class RssSampler:
+    """Sample the RSS of this process in a thread, keeping the peak.
+
+    ru_maxrss is the peak of the whole process lifetime, sampling gives the
+    peak of a single stage. Children, e.g. pool workers, are included.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss_mb = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        self.peak_rss_mb = max(self.peak_rss_mb, get_process_tree_rss_mb(self.process))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+
+def measure(name, fn, *args, trace_memory=False, **kwargs):
+    """Run fn(*args, **kwargs) and measure its wall/CPU time and memory.
+
+    Returns fn's result and a record with wall_s, cpu_s, start/peak RSS in MB
+    and, with trace_memory, the peak of Python allocations in MB.
+    """
+    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} Running {name}", flush=True)
+    if trace_memory:
+        tracemalloc.start()
+    start_rss_mb = get_rss_mb()
+    with RssSampler() as rss_sampler:
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        result = fn(*args, **kwargs)
+        cpu_s = time.process_time() - start_cpu
+        wall_s = time.perf_counter() - start_wall
+    record = {
+        "name": name,
+        "wall_s": wall_s,
+        "cpu_s": cpu_s,
+        "start_rss_mb": start_rss_mb,
+        "peak_rss_mb": rss_sampler.peak_rss_mb,
+    }
+    if trace_memory:
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        record["traced_peak_mb"] = traced_peak / 2**20
+    print(
+        f"{name}: wall_s: {wall_s:.3f}, cpu_s: {cpu_s:.3f}, "
+        f"peak_rss_mb: {record['peak_rss_mb']:.1f}",
+        flush=True,
+    )
+    return result, record
+
+
+def get_top_allocators(snapshot, top_n=TOP_ALLOCATORS):
+    """Source lines holding the most traced memory in a snapshot."""
+    stats = snapshot.filter_traces(TRACEMALLOC_FILTERS).statistics("lineno")
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_mb": stat.size / 2**20,
+            "count": stat.count,
+        }
+        for stat in stats[:top_n]
+    ]
+
+
+class StageProfiler:
+    """Wall/CPU time, peak RSS and top allocators of the stages of a run.
+
+    With trace_memory, tracemalloc runs during each stage: traced_peak_mb is
+    the stage's peak of Python allocations and top_allocators the lines
+    holding the memory it allocated that is still alive at its end.
+    Stages don't nest.
+    """
+
+    def __init__(self, name, trace_memory=False, top_n=TOP_ALLOCATORS):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.top_n = top_n
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        """Record a stage, failed stages too, with failed: True."""
+        print(f"{datetime.now():%Y-%m-%d %H:%M:%S} Stage {name}", flush=True)
+        if self.trace_memory:
+            tracemalloc.start()
+        start_rss_mb = get_rss_mb()
+        failed = True
+        rss_sampler = RssSampler()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            with rss_sampler:
+                yield
+                failed = False
+        finally:
+            cpu_s = time.process_time() - start_cpu
+            wall_s = time.perf_counter() - start_wall
+            record = {
+                "name": name,
+                "wall_s": wall_s,
+                "cpu_s": cpu_s,
+                "start_rss_mb": start_rss_mb,
+                "end_rss_mb": get_rss_mb(),
+                "peak_rss_mb": rss_sampler.peak_rss_mb,
+            }
+            if failed:
+                record["failed"] = True
+            if self.trace_memory:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                record["traced_peak_mb"] = traced_peak / 2**20
+                record["top_allocators"] = get_top_allocators(
+                    tracemalloc.take_snapshot(), self.top_n
+                )
+                tracemalloc.stop()
+            self.records.append(record)
+            print(
+                f"Stage {name}: wall_s: {wall_s:.3f}, cpu_s: {cpu_s:.3f}, "
+                f"peak_rss_mb: {record['peak_rss_mb']:.1f}"
+                + (", failed" if failed else ""),
+                flush=True,
+            )
+
+    def print_summary(self):
+        total_wall_s = sum(record["wall_s"] for record in self.records)
+        print(f"{self.name} stages:", flush=True)
+        for record in self.records:
+            wall_pct = 100 * record["wall_s"] / total_wall_s if total_wall_s else 0
+            print(
+                f"\t{record['name']}: wall_s: {record['wall_s']:.3f} "
+                f"({wall_pct:.1f}%), cpu_s: {record['cpu_s']:.3f}, "
+                f"peak_rss_mb: {record['peak_rss_mb']:.1f}",
+                flush=True,
+            )
+
+    def dump(self, path, config=None):
+        """Dump the stage records of the run as a JSON report."""
+        self.print_summary()
+        return dump_results(path, self.records, {"run": self.name, **(config or {})})
+
+
+def get_profile_path(output_dir, name):
+    """A per run report path, stamped like PatientDB.dump(unique=True)."""
+    return f"{output_dir}/{name}_profile_{time.strftime('%Y%m%d-%H%M%S')}.json"
+
+
+def get_process_tree_rss_mb(process):
+    """RSS of a process and its children, e.g. dask workers."""
+    rss = 0
+    for tree_process in [process] + process.children(recursive=True):
+        try:
+            rss += tree_process.memory_info().rss
+        except psutil.Error:
+            # Children can exit between listing and sampling them
+            continue
+    return rss / 2**20
+
+
+def measure_command(name, command, interval=RSS_SAMPLE_INTERVAL):
+    """Run a command and measure its wall/CPU time and peak RSS.
+
+    CPU time is that of all waited for children, RSS is sampled over the
+    command's whole process tree.
+    """
+    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} Running {name}: {command}", flush=True)
+    start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_wall = time.perf_counter()
+    process = psutil.Popen(command)
+    peak_rss_mb = 0.0
+    while True:
+        try:
+            returncode = process.wait(timeout=interval)
+            break
+        except psutil.TimeoutExpired:
+            peak_rss_mb = max(peak_rss_mb, get_process_tree_rss_mb(process))
+    wall_s = time.perf_counter() - start_wall
+    end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_s = (end_usage.ru_utime - start_usage.ru_utime) + (
+        end_usage.ru_stime - start_usage.ru_stime
+    )
+    record = {
+        "name": name,
+        "command": command,
+        "returncode": returncode,
+        "wall_s": wall_s,
+        "cpu_s": cpu_s,
+        "peak_rss_mb": peak_rss_mb,
+    }
+    print(
+        f"{name}: returncode: {returncode}, wall_s: {wall_s:.3f}, "
+        f"cpu_s: {cpu_s:.3f}, peak_rss_mb: {peak_rss_mb:.1f}",
+        flush=True,
+    )
+    return record
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def get_environment():
+    """Where the results come from, so runs of different releases compare."""
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "total_memory_mb": psutil.virtual_memory().total / 2**20,
+    }
+
+
+def dump_results(path, records, config=None):
+    """Dump benchmark records with the environment and config as JSON."""
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    results = {
+        "environment": get_environment(),
+        "config": config or dict(),
+        "records": records,
+    }
+    print(f"Dumping {len(records)} benchmark records to {path}", flush=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return results
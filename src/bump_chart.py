@@ -1,4 +1,10 @@
+import argparse
 import json
+from collections import Counter
+
+import numpy as np
+
+from count_cube import format_periods, write_frequencies_csv
 
 
 def load_json(path):
@@ -14,50 +20,196 @@ def search_drug_category(drug_code, drug_labels):
             continue
         if entity_id == drug_code:
             print("Found a drug label match")
+            drug_category = None
             drug_categories = drug_label.get('drug_category')
             if drug_categories:
                 if len(drug_categories) > 1:
                     print("Multiple drug categories found, using first")
-                    drug_category = drug_categories[0]
-                else:
-                    drug_category = drug_categories
-            return drug_cateogry
+                drug_category = drug_categories[0]
+            return drug_category
+
+
+def create_drug_category_index(patient_kg_labels):
+    """Map entity_id -> drug categories of the labels that have any."""
+    drug_category_index = dict()
+    for patient_kg_label in patient_kg_labels:
+        entity_id = patient_kg_label.get('entity_id')
+        drug_categories = patient_kg_label.get('drug_category')
+        if not entity_id or not drug_categories:
+            continue
+        # Like search_drug_category, the first label of an entity_id wins
+        drug_category_index.setdefault(entity_id, tuple(drug_categories))
+    return drug_category_index
+
+
+def get_visit_months(nlp_jsonl_path):
+    """Map the graph_id of every NLP JSONL visit to its YYYY-MM.
+
+    graph_ids are "<patient_id>_<visit index>" like patient_kg's, visits
+    numbered in the order of the patient's line.
+    """
+    c = Counter()
+    visit_months = dict()
+    with open(nlp_jsonl_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                c['JSONDecodeError'] += 1
+                continue
+            for visit_i, visit in enumerate(record.get('visits') or []):
+                timestamp = visit.get('timestamp')
+                if not timestamp:
+                    c['visits_without_timestamp'] += 1
+                    continue
+                visit_months[f"{record['patient_id']}_{visit_i}"] = timestamp[0:7]
+    c['visits'] = len(visit_months)
+    print(f"{c}", flush=True)
+    return visit_months
+
+
+def count_drug_categories(patient_kg, drug_category_index, visit_months=None, use_first_category=True):
+    """Count the drug categories of every rx in patient_kg in one pass.
 
+    patient_kg has one entry per visit, visit_months optionally maps a
+    graph_id to the YYYY-MM of the visit. Returns a dict with the sorted
+    categories, patient_ids and months, and int64 patient x category and
+    month x category counts. Visits without a month only count per patient.
+    """
+    categories = sorted({
+        drug_category
+        for drug_categories in drug_category_index.values()
+        for drug_category in drug_categories
+    })
+    category_codes = {drug_category: code for code, drug_category in enumerate(categories)}
+    # entity_id -> category codes, so each rx is a single dict lookup
+    code_index = {
+        entity_id: [category_codes[drug_category] for drug_category in drug_categories]
+        for entity_id, drug_categories in drug_category_index.items()
+    }
+    if use_first_category:
+        code_index = {entity_id: codes[:1] for entity_id, codes in code_index.items()}
 
-def main():
+    c = Counter()
+    patient_rows = dict()
+    month_cols = dict()
+    rows = []
+    cols = []
+    codes = []
+    for patient in patient_kg:
+        c['visits'] += 1
+        graph_id = patient['graph_id']
+        patient_id = graph_id.split('_', 1)[0]
+        row = patient_rows.setdefault(patient_id, len(patient_rows))
+        col = -1
+        month = visit_months.get(graph_id) if visit_months else None
+        if month:
+            col = month_cols.setdefault(month[0:7], len(month_cols))
+        else:
+            c['visits_without_month'] += 1
+        for rx in patient.get('rx') or []:
+            c['rx'] += 1
+            rx_codes = code_index.get(rx)
+            if not rx_codes:
+                c['rx_without_category'] += 1
+                continue
+            for code in rx_codes:
+                rows.append(row)
+                cols.append(col)
+                codes.append(code)
+    print(f"{c}", flush=True)
+
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    codes = np.array(codes, dtype=np.int64)
+    patient_counts = np.zeros((len(patient_rows), len(categories)), dtype=np.int64)
+    np.add.at(patient_counts, (rows, codes), 1)
+
+    # Months sorted, cols remapped from order of first appearance
+    months = sorted(month_cols)
+    month_order = np.array([month_cols[month] for month in months], dtype=np.int64)
+    sorted_cols = np.empty(len(months), dtype=np.int64)
+    sorted_cols[month_order] = np.arange(len(months))
+    has_month = cols >= 0
+    month_counts = np.zeros((len(months), len(categories)), dtype=np.int64)
+    np.add.at(month_counts, (sorted_cols[cols[has_month]], codes[has_month]), 1)
+
+    return {
+        'categories': categories,
+        'patient_ids': list(patient_rows),
+        'patient_counts': patient_counts,
+        'months': months,
+        'month_counts': month_counts,
+    }
+
+
+def dump_bump_chart(path, drug_category_counts):
+    """Dump category,month,count lines of the month counts for the bump chart."""
+    print(f"Dumping drug category month counts to {path}")
+    months = np.array(drug_category_counts['months'], dtype='datetime64[M]')
+    labels = format_periods(months.astype('datetime64[D]'), 'month')
+    write_frequencies_csv(
+        path,
+        drug_category_counts['categories'],
+        labels,
+        drug_category_counts['month_counts'].T,
+        drop_empty_words=False,
+    )
+
+
+def get_command_line_args():
     data_dir = "/Users/hamc649/Documents/deepcare/covid-19/visualization/data/slack"
-    patient_kg_path = f"{data_dir}/patient_kg.json"
-    patient_kg_labels_path = f"{data_dir}/patient_kg_labels.json"
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patient_kg_path", default=f"{data_dir}/patient_kg.json")
+    parser.add_argument(
+        "--patient_kg_labels_path", default=f"{data_dir}/patient_kg_labels.json"
+    )
+    parser.add_argument(
+        "--nlp_jsonl_path",
+        default=None,
+        help="NLP JSONL patients to take the visit months from",
+    )
+    parser.add_argument(
+        "--visit_months_path",
+        default=None,
+        help="JSON of graph_id -> YYYY-MM visit months, instead of --nlp_jsonl_path",
+    )
+    parser.add_argument(
+        "--output_path",
+        default=f"{data_dir}/drug_category_months.csv",
+        help="Month x drug category counts CSV, written when visit months are given",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    return args
 
-    patient_kg = load_json(patient_kg_path)
-    patient_kg_labels = load_json(patient_kg_labels_path)
 
-    drug_kg_labels = []
+def main(args):
+    patient_kg = load_json(args.patient_kg_path)
+    patient_kg_labels = load_json(args.patient_kg_labels_path)
 
     no_space_labels = []
-    uniq_drug_categories = set()
     for patient_kg_label in patient_kg_labels:
         label = patient_kg_label['label']
-        drug_categories = patient_kg_label.get('drug_category')
-        if drug_categories:
-            drug_kg_labels.append(patient_kg_label)
-            for drug_category in drug_categories:
-                uniq_drug_categories.add(drug_category)
-            print()
         if ' ' not in label and not label.isnumeric():
             no_space_labels.append(label)
-        
-        print()
 
-    for patient in patient_kg:
-        rxs = patient.get('rx')
-        for rx in rxs:
-            drug_category = search_drug_category(rx, drug_kg_labels)
-        print()
+    drug_category_index = create_drug_category_index(patient_kg_labels)
+    print(f"Indexed {len(drug_category_index)} drug labels")
+
+    visit_months = None
+    if args.visit_months_path:
+        visit_months = load_json(args.visit_months_path)
+    elif args.nlp_jsonl_path:
+        visit_months = get_visit_months(args.nlp_jsonl_path)
+    drug_category_counts = count_drug_categories(patient_kg, drug_category_index, visit_months)
 
-    print()
+    category_totals = drug_category_counts['patient_counts'].sum(axis=0)
+    for code in np.argsort(-category_totals, kind='stable'):
+        print(f"{drug_category_counts['categories'][code]}: {category_totals[code]}")
 
+    if visit_months:
+        dump_bump_chart(args.output_path, drug_category_counts)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(get_command_line_args())
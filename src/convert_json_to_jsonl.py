@@ -1,101 +1,508 @@
+import codecs
 import json
+import mmap
 import os
 import re
 import sys
+import time
 from collections import Counter
-from copy import deepcopy
-from io import StringIO
+from multiprocessing import Pool
 from pathlib import Path
 
+import numpy as np
 
-def format_patient(patient_lines, first_line, last_line):
-    patient_lines[-1] = patient_lines[-1].replace("},", "}")
-    patient_str = "".join(patient_lines)
-    patient_str_full = f"{first_line}{patient_str}{last_line}"
-    patient_file = StringIO(patient_str_full)
-    patient = json.load(patient_file)
-    patient_id = list(patient.keys())[0]
-    patient_val = list(patient.values())[0]
-    patient_val["patient_id"] = patient_id
-    formatted_patient = patient_val
+# Bytes read from the input per chunk
+READ_CHUNK_SIZE = 1 << 22
 
-    # print()
-    return formatted_patient
+# Bytes buffered by each batch file writer
+WRITE_BUFFER_SIZE = 1 << 20
 
+# Whitespace between JSON tokens
+WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
 
-def dump_patient(patient, path, c):
-    with open(path, "a+") as fout:
-        patient_line = json.dumps(patient)
-        fout.write(f"{patient_line}\n")
+# Bytes scanned at a time when finding member offsets, small enough for the
+# numpy passes over a chunk to stay in cache
+SCAN_CHUNK_SIZE = 1 << 16
 
-    # Keep track of patients dumped for batching
-    c["total_patients_dumped"] += 1
-    c["batch_patients_dumped"] += 1
-    if c["batch_patients_dumped"] >= c["num_patients_per_batch"]:
-        c["batch_patients_dumped"] = 0
-        c["batch_id"] += 1
-        print(f"Batch: {c['batch_id']}")
+
+class TopLevelMemberScanner:
+    """Incremental tokenizer for the members of a top-level JSON object.
+
+    feed() takes the input in chunks of any size and yields every
+    '"key": value' member that the input so far completes. Only the
+    top-level punctuation is scanned in python, values are parsed by the C
+    json decoder. Memory is bounded by the largest member, whatever the
+    whitespace and line breaks look like.
+
+    Offsets count decoded characters. With encoding "latin-1" every byte is
+    one character, so offsets are byte offsets into the file.
+    """
+
+    def __init__(self, encoding="utf-8"):
+        self.text_decoder = codecs.getincrementaldecoder(encoding)()
+        self.json_decoder = json.JSONDecoder()
+        self.text = ""
+        # Absolute offset of text[0]
+        self.offset = 0
+        self.state = "start"
+        self.key = None
+        self.member_start = None
+        # Don't retry parsing a value cut off by the end of the text until
+        # there is twice as much text, so huge members are only re-parsed
+        # O(log size) times
+        self.min_value_length = 0
+        self.done = False
+
+    def feed(self, chunk, final=False):
+        """Yield (start, end, key, value) of the completed members."""
+        self.text += self.text_decoder.decode(chunk, final)
+        text = self.text
+        length = len(text)
+        pos = 0
+        while not self.done:
+            pos = WHITESPACE_RE.match(text, pos).end()
+            if pos >= length:
+                break
+            char = text[pos]
+            if self.state == "start":
+                self.expect(char, "{", pos)
+                self.state = "first_key"
+                pos += 1
+            elif self.state in ["first_key", "key"]:
+                if char == "}" and self.state == "first_key":
+                    self.done = True
+                    break
+                self.expect(char, '"', pos)
+                try:
+                    self.key, end = json.decoder.scanstring(text, pos + 1)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break  # The key is cut off, wait for more text
+                self.member_start = self.offset + pos
+                self.state = "colon"
+                pos = end
+            elif self.state == "colon":
+                self.expect(char, ":", pos)
+                self.state = "value"
+                pos += 1
+            elif self.state == "value":
+                if length - pos < self.min_value_length and not final:
+                    break
+                try:
+                    value, end = self.json_decoder.raw_decode(text, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    self.min_value_length = 2 * (length - pos)
+                    break
+                # A number at the end of the text might continue
+                if end >= length and not final:
+                    break
+                self.min_value_length = 0
+                yield self.member_start, self.offset + end, self.key, value
+                self.state = "comma"
+                pos = end
+            elif self.state == "comma":
+                if char == "}":
+                    self.done = True
+                    break
+                self.expect(char, ",", pos)
+                self.state = "key"
+                pos += 1
+
+        # Only keep the text of the token that isn't complete yet
+        self.text = text[pos:]
+        self.offset += pos
+
+    def expect(self, char, expected, pos):
+        if char != expected:
+            raise ValueError(
+                f"Expected {expected!r} at offset {self.offset + pos}, got {char!r}"
+            )
+
+
+def iter_json_members(fin, encoding="utf-8", chunk_size=READ_CHUNK_SIZE):
+    """Stream the (start, end, key, value) members of a JSON object file."""
+    scanner = TopLevelMemberScanner(encoding)
+    while not scanner.done:
+        chunk = fin.read(chunk_size)
+        yield from scanner.feed(chunk, final=not chunk)
+        if not chunk:
+            break
+    if not scanner.done:
+        raise ValueError(f"Truncated JSON object at offset {scanner.offset}")
+
+
+def format_patient(patient_id, patient):
+    patient["patient_id"] = patient_id
+    return patient
+
+
+def get_batch_path(output_dir, base_path, batch_id):
+    return f"{output_dir}/{base_path}_batch{batch_id:05d}.jsonl"
+
+
+class BatchWriter:
+    """Buffered writer that starts a new JSONL file every N patients.
+
+    With num_patients_per_batch None all patients go to one file.
+    """
+
+    def __init__(self, output_dir, base_path, num_patients_per_batch, c):
+        self.output_dir = output_dir
+        self.base_path = base_path
+        self.num_patients_per_batch = num_patients_per_batch
+        self.c = c
+        self.fout = None
+        self.paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open_next_batch(self):
+        self.close()
+        if self.num_patients_per_batch:
+            path = get_batch_path(self.output_dir, self.base_path, self.c["batch_id"])
+        else:
+            path = f"{self.output_dir}/{self.base_path}.jsonl"
+        print(f"Batch: {self.c['batch_id']}, writing to {path}", flush=True)
+        # Overwrites any previous output file
+        self.fout = open(path, "w", buffering=WRITE_BUFFER_SIZE)
+        self.paths.append(path)
+
+    def write(self, patient):
+        if self.fout is None:
+            self.open_next_batch()
+        self.fout.write(f"{json.dumps(patient)}\n")
+
+        # Keep track of patients dumped for batching
+        self.c["total_patients_dumped"] += 1
+        self.c["batch_patients_dumped"] += 1
+        if (
+            self.num_patients_per_batch
+            and self.c["batch_patients_dumped"] >= self.num_patients_per_batch
+        ):
+            self.c["batch_patients_dumped"] = 0
+            self.c["batch_id"] += 1
+            self.close()
+
+    def close(self):
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
 
 
 def chunk_big_json(
     input_path,
-    output_path,
+    output_dir,
+    base_path,
     num_patients_per_batch,
 ):
+    """Split a JSON object of patients into JSONL batch files.
 
-    # Pattern to match patient ID
-    patient_id_pattern = re.compile(r'^ {4}"\d{8}": {\n$')
-
-    # header and footer defaults
-    first_line = "{\n"
-    last_line = "}"
-    first_loop = True
-
+    Returns the paths of the batch files, in input order.
+    """
     # Set up vars
     c = Counter()
-    c["line_num"] = -1
     c["batch_id"] = 0
     c["batch_patients_dumped"] = 0
-    c["num_patients_per_batch"] = num_patients_per_batch
-    patient_lines = []
-
-    ## Remove files in output dir
-    # for root, dirs, files in os.walk(output_dir):
-    #    for f in files:
-    #        print(f"Removing {f}")
-    #        os.remove(os.path.join(root, f))
 
     # Create directory after deleting
     Path(output_dir).mkdir(parents=True, exist_ok=True)
-    # sys.exit()
-
-    with open(input_path) as fin:
-        for line in fin:
-            c["line_num"] += 1
-            if c["line_num"] % 100000000 == 0:
-                print(f"Processing line no: {c['line_num']}", flush=True)
-            # Skip the first line of the entire patients dump
-            if first_loop:
-                first_loop = False
-                continue
-
-            patient_id_match = patient_id_pattern.match(line)
-            # Found patient line
-            if patient_id_match:
-                if patient_lines:
-                    patient = format_patient(patient_lines, first_line, last_line)
-                    dump_patient(patient, output_path, c)
-
-                    patient_lines.clear()
-            patient_lines.append(line)
-        # Take care of the last patient
-        if patient_lines:
-            # Remove the last line for the entire patients dump
-            patient_lines.pop()
-            patient = format_patient(patient_lines, first_line, last_line)
-            dump_patient(patient, output_path, c)
+
+    with open(input_path, "rb") as fin, BatchWriter(
+        output_dir, base_path, num_patients_per_batch, c
+    ) as writer:
+        for _, end, patient_id, patient in iter_json_members(fin):
+            patient = format_patient(patient_id, patient)
+            writer.write(patient)
+            if c["total_patients_dumped"] % 100000 == 0:
+                print(
+                    f"Processing patient no: {c['total_patients_dumped']}, "
+                    f"offset: {end}",
+                    flush=True,
+                )
 
     print(f"{c}")
+    return writer.paths
+
+
+def get_structural_positions(chunk):
+    """Positions of the quotes, brackets and commas of a uint8 array."""
+    # [ and ] only differ from { and } in the 0x20 bit
+    brackets = chunk | 0x20
+    mask = (chunk == ord('"')) | (chunk == ord(","))
+    mask |= (brackets == ord("{")) | (brackets == ord("}"))
+    return np.flatnonzero(mask)
+
+
+def find_top_level_separators(data, chunk_size=SCAN_CHUNK_SIZE):
+    """Byte offsets of the top-level object's '{', its commas and its '}'.
+
+    Only quotes, brackets and commas are looked at, in numpy, chunk by
+    chunk: quotes toggle whether we're in a string and brackets outside of
+    strings change the depth. Values are never decoded.
+    """
+    first = 0
+    while first < len(data) and data[first] in b" \t\n\r":
+        first += 1
+    if first < len(data) and data[first] != ord("{"):
+        raise ValueError(f"Expected '{{' at offset {first}, got {chr(data[first])!r}")
+    separators = []
+    in_string = 0
+    depth = 0
+    done = False
+    chunk_start = 0
+    while chunk_start < len(data) and not done:
+        chunk_end = min(chunk_start + chunk_size, len(data))
+        # Don't split a run of backslashes from the character it escapes
+        while chunk_end < len(data) and data[chunk_end - 1] == ord("\\"):
+            chunk_end += 1
+        chunk = data[chunk_start:chunk_end]
+        positions = get_structural_positions(chunk)
+        chars = chunk[positions]
+
+        quotes = chars == ord('"')
+        # Quotes after an odd number of backslashes are escaped, rare enough
+        # to count in python
+        for i in np.flatnonzero(quotes & (chunk[positions - 1] == ord("\\"))):
+            pos = chunk_start + int(positions[i]) - 1
+            num_backslashes = 0
+            while pos >= 0 and data[pos] == ord("\\"):
+                num_backslashes += 1
+                pos -= 1
+            quotes[i] = num_backslashes % 2 == 0
+        # In a string if an odd number of quotes come before
+        quote_counts = np.cumsum(quotes, dtype=np.int64) + in_string
+        structural = ~quotes & ((quote_counts & 1) == 0)
+        if len(quote_counts):
+            in_string = int(quote_counts[-1] & 1)
+
+        positions = positions[structural]
+        chars = chars[structural]
+        opening = (chars | 0x20) == ord("{")
+        closing = (chars | 0x20) == ord("}")
+        depths = np.cumsum(opening.astype(np.int64) - closing.astype(np.int64)) + depth
+        if len(depths):
+            depth = int(depths[-1])
+
+        is_separator = (depths == 1) & ((chars == ord(",")) | (chars == ord("{")))
+        is_closing = (chars == ord("}")) & (depths == 0)
+        if is_closing.any():
+            # Ignore anything after the object
+            last = np.flatnonzero(is_closing)[0]
+            is_separator[last] = True
+            is_separator[last + 1 :] = False
+            done = True
+        separators.append(chunk_start + positions[is_separator])
+        chunk_start = chunk_end
+
+    if not done:
+        raise ValueError(f"Truncated JSON object at offset {chunk_start}")
+    return np.concatenate(separators)
+
+
+def decode_member_key(buf, start):
+    """The key of the member at start, decoding only as much as it takes."""
+    length = 256
+    while True:
+        text = buf[start : start + length].decode("utf-8", errors="replace")
+        try:
+            key, _ = json.decoder.scanstring(text, 1)
+            return key
+        except json.JSONDecodeError:
+            if start + length >= len(buf):
+                raise
+            length *= 2
+
+
+def scan_member_offsets(input_path):
+    """Pre-scan a JSON object of patients for its members' byte offsets.
+
+    Returns the patient IDs and the start/end byte offsets of their
+    '"patient_id": {...}' members. Patients aren't decoded, the shard
+    workers do that.
+    """
+    print(f"Scanning {input_path} for patient offsets", flush=True)
+    start_time = time.perf_counter()
+    patient_ids = []
+    starts = []
+    ends = []
+    if os.path.getsize(input_path) == 0:
+        raise ValueError("Truncated JSON object at offset 0")
+    with open(input_path, "rb") as fin:
+        # Not closed explicitly, numpy views keep the map open until collected
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    separators = find_top_level_separators(np.frombuffer(buf, dtype=np.uint8))
+    whitespace = b" \t\n\r"
+    separators = separators.tolist()
+    for separator, next_separator in zip(separators[:-1], separators[1:]):
+        start = separator + 1
+        end = next_separator
+        while start < end and buf[start] in whitespace:
+            start += 1
+        while end > start and buf[end - 1] in whitespace:
+            end -= 1
+        if start == end:
+            # Only an empty object has no member between separators
+            continue
+        if buf[start] != ord('"'):
+            raise ValueError(
+                f"Expected '\"' at offset {start}, got {buf[start:start + 1]!r}"
+            )
+        patient_ids.append(decode_member_key(buf, start))
+        starts.append(start)
+        ends.append(end)
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    size_mb = os.path.getsize(input_path) / 1e6
+    print(
+        f"Found {len(starts)} patients in {elapsed:.1f}s ({size_mb / elapsed:.0f} MB/s)",
+        flush=True,
+    )
+    return (
+        np.array(patient_ids, dtype=str),
+        np.array(starts, dtype=np.int64),
+        np.array(ends, dtype=np.int64),
+    )
+
+
+def load_or_scan_member_offsets(input_path, offsets_path):
+    """Load saved member offsets if the input hasn't changed, else scan."""
+    stat = os.stat(input_path)
+    if os.path.exists(offsets_path):
+        with np.load(offsets_path, allow_pickle=False) as offsets:
+            if (
+                int(offsets["input_size"]) == stat.st_size
+                and int(offsets["input_mtime_ns"]) == stat.st_mtime_ns
+            ):
+                print(f"Loading patient offsets from {offsets_path}")
+                return offsets["patient_ids"], offsets["starts"], offsets["ends"]
+
+    patient_ids, starts, ends = scan_member_offsets(input_path)
+    with open(offsets_path, "wb") as f:
+        np.savez(
+            f,
+            patient_ids=patient_ids,
+            starts=starts,
+            ends=ends,
+            input_size=stat.st_size,
+            input_mtime_ns=stat.st_mtime_ns,
+        )
+    return patient_ids, starts, ends
+
+
+def get_shard_bounds(starts, ends, num_shards):
+    """Split members into contiguous shards with about equal byte sizes."""
+    sizes = np.cumsum(ends - starts)
+    if not len(sizes):
+        return []
+    targets = sizes[-1] * np.arange(1, num_shards) / num_shards
+    cuts = np.searchsorted(sizes, targets, side="right")
+    bounds = np.unique(np.concatenate([[0], cuts, [len(sizes)]]))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def get_shard_path(output_dir, base_path, shard_id):
+    return f"{output_dir}/{base_path}_shard{shard_id:05d}.jsonl"
+
+
+def convert_shard(shard):
+    """Convert one shard's members, read by offset, to a JSONL file."""
+    shard_id, input_path, starts, ends, output_path = shard
+    c = Counter()
+    with open(input_path, "rb") as fin, open(
+        output_path, "w", buffering=WRITE_BUFFER_SIZE
+    ) as fout:
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            fin.seek(start)
+            member = fin.read(end - start)
+            patient_id, patient = next(iter(json.loads(b"{" + member + b"}").items()))
+            patient = format_patient(patient_id, patient)
+            fout.write(f"{json.dumps(patient)}\n")
+            c["patients"] += 1
+            c["bytes"] += end - start
+    return shard_id, c
+
+
+def convert_big_json_parallel(
+    input_path,
+    output_dir,
+    base_path,
+    num_workers,
+    num_shards=None,
+):
+    """Convert a JSON object of patients to JSONL shards with a process pool.
+
+    A byte level pre-scan finds the offsets of every patient, the patients are
+    split into contiguous shards and every worker writes its shards on its
+    own. The shards and their patients are listed in a manifest.
+    Returns the manifest path.
+    """
+    if not num_shards:
+        num_shards = num_workers
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    start_time = time.perf_counter()
+
+    offsets_path = f"{output_dir}/{base_path}_offsets.npz"
+    patient_ids, starts, ends = load_or_scan_member_offsets(input_path, offsets_path)
+    shard_bounds = get_shard_bounds(starts, ends, num_shards)
+    shards = [
+        (
+            shard_id,
+            input_path,
+            starts[first:last],
+            ends[first:last],
+            get_shard_path(output_dir, base_path, shard_id),
+        )
+        for shard_id, (first, last) in enumerate(shard_bounds)
+    ]
+    print(
+        f"Converting {len(starts)} patients in {len(shards)} shards "
+        f"with {num_workers} workers",
+        flush=True,
+    )
+
+    shard_counters = dict()
+    with Pool(num_workers) as pool:
+        for shard_id, c in pool.imap_unordered(convert_shard, shards):
+            shard_counters[shard_id] = c
+            print(f"Shard {shard_id}: {c}", flush=True)
+
+    manifest = dict()
+    manifest["input_path"] = os.path.abspath(input_path)
+    manifest["input_size"] = os.path.getsize(input_path)
+    manifest["num_patients"] = len(starts)
+    manifest["shards"] = []
+    for (shard_id, _, _, _, shard_path), (first, last) in zip(shards, shard_bounds):
+        c = shard_counters[shard_id]
+        manifest["shards"].append(
+            {
+                "path": shard_path,
+                "num_patients": c["patients"],
+                "num_input_bytes": c["bytes"],
+                "first_patient_id": str(patient_ids[first]),
+                "last_patient_id": str(patient_ids[last - 1]),
+                "start_offset": int(starts[first]),
+                "end_offset": int(ends[last - 1]),
+            }
+        )
+    elapsed = time.perf_counter() - start_time
+    manifest["elapsed_seconds"] = round(elapsed, 3)
+
+    manifest_path = f"{output_dir}/{base_path}_manifest.json"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    size_mb = manifest["input_size"] / 1e6
+    print(
+        f"Converted {size_mb:.0f} MB in {elapsed:.1f}s "
+        f"({size_mb / max(elapsed, 1e-9):.0f} MB/s), manifest: {manifest_path}",
+        flush=True,
+    )
+    return manifest_path
 
 
 if __name__ == "__main__":
@@ -117,17 +524,28 @@ if __name__ == "__main__":
     #input_paths = [f"{base_path}_batch{x}.json" for x in range(16)]
     input_paths = [f'{base_path}.json']
 
-    output_path = f'{output_dir}/{base_path}.jsonl'
+    # Processes converting shards of each input, 1 converts on a single core
+    num_workers = os.cpu_count()
 
     print(f"input_paths: {input_paths}")
-    print(f"output_path: {output_path}")
+    print(f"output_dir: {output_dir}")
+    print(f"num_workers: {num_workers}")
     #sys.exit(0)
 
     for input_path in input_paths:
         print(f"Processing input_path: {input_path}")
         full_input_path = f"{input_dir}/{input_path}"
-        chunk_big_json(
-            full_input_path,
-            output_path,
-            n_patients_per_partition,
-        )
+        if num_workers > 1:
+            convert_big_json_parallel(
+                full_input_path,
+                output_dir,
+                Path(input_path).stem,
+                num_workers,
+            )
+        else:
+            chunk_big_json(
+                full_input_path,
+                output_dir,
+                Path(input_path).stem,
+                n_patients_per_partition,
+            )
@@ -1,162 +1,141 @@
 import csv
+from array import array
 from collections import Counter
 
+import numpy as np
+
+from count_cube import write_frequencies_csv
+
+# Facets of month_counts_age_race_sex, attributes go to the first facet
+# whose substring they contain
+AGE_RACE_SEX_FACETS = [("age", "age"), ("race", "race"), ("sex", "sex")]
+
+# Every attribute in a single facet
+ALL_ATTRIBUTES_FACETS = [("", "")]
+
 
 def translate_month(month):
-    if month == "2020-01":
-        month_translation = "Q1 2020"
-    if month == "2020-02":
-        month_translation = "Q2 2020"
-    if month == "2020-03":
-        month_translation = "Q3 2020"
-    if month == "2020-04":
-        month_translation = "Q4 2020"
-    if month == "2020-05":
-        month_translation = "Q5 2020"
-    if month == "2020-06":
-        month_translation = "Q6 2020"
-    if month == "2020-07":
-        month_translation = "Q7 2020"
-    if month == "2020-08":
-        month_translation = "Q8 2020"
-    if month == "2020-09":
-        month_translation = "Q9 2020"
-    if month == "2020-10":
-        month_translation = "Q10 2020"
-    if month == "2020-11":
-        month_translation = "Q11 2020"
-    if month == "2020-12":
-        month_translation = "Q12 2020"
-    return month_translation
-
-
-def dump_frequencies_months(path, month_counts, months, words):
-    print("Dumping frequencies for month counts")
-    with open(path, "w") as f:
-        header = "territory,quarter,profit\n"
-        f.write(header)
-
-        for word in sorted(words):
-            for month in months:
-                count = month_counts[month][word]
-                month_translation = translate_month(month)
-                freq_line = f"{word},{month_translation},{count}\n"
-                f.write(freq_line)
+    """Label a YYYY-MM month like the visualization expects, "Q<month> <year>"."""
+    year, month_num = month.split("-")[0:2]
+    return f"Q{int(month_num)} {year}"
+
+
+def create_substring_classifier(facets):
+    """Create a classifier from (facet, substring) pairs, first match wins.
+
+    The classifier returns None for attributes that aren't in any facet.
+    """
+
+    def classify(attribute):
+        for facet, substring in facets:
+            if substring in attribute:
+                return facet
+        return None
+
+    return classify
+
+
+def parse_count(count):
+    """Parse a count, None if it isn't a finite number.
+
+    Counts without a fractional part, like "3.0", are ints so they're
+    written back as "3".
+    """
+    try:
+        return int(count)
+    except ValueError:
+        pass
+    try:
+        count = float(count)
+    except ValueError:
+        return None
+    if not np.isfinite(count):
+        return None
+    if count.is_integer():
+        return int(count)
+    return count
+
+
+def pivot_month_counts(input_paths, classify):
+    """Pivot (month, attribute, count) TSV rows into a matrix per facet.
+
+    The TSVs are streamed once. Months come from the data, sorted, and are
+    shared by all facets. Returns the months and a dict of facet ->
+    (attributes, attribute x month count matrix).
+    """
+    month_index = dict()
+    facet_entries = dict()
+    c = Counter()
+    for input_path in input_paths:
+        print(f"Reading {input_path}")
+        with open(input_path, "r") as f:
+            read_tsv = csv.reader(f, delimiter="\t")
+            for row in read_tsv:
+                c["rows"] += 1
+                month = row[0]
+                attribute = row[1]
+                facet = classify(attribute)
+                if facet is None:
+                    c["unclassified_rows"] += 1
+                    continue
+                if facet not in facet_entries:
+                    facet_entries[facet] = (dict(), array("q"), array("q"), [])
+                attribute_index, rows, cols, counts = facet_entries[facet]
+                rows.append(attribute_index.setdefault(attribute, len(attribute_index)))
+                cols.append(month_index.setdefault(month, len(month_index)))
+                count = parse_count(row[2])
+                if count is None:
+                    # Empty or non-numeric counts are zero-filled
+                    c["bad_count_rows"] += 1
+                    count = 0
+                counts.append(count)
+    print(f"{c}")
+
+    months = sorted(month_index)
+    # Column of each month in order of first appearance, in the sorted months
+    month_cols = np.argsort(np.array(list(month_index), dtype=str), kind="stable")
+    month_cols = np.argsort(month_cols)
+
+    facet_matrices = dict()
+    for facet, (attribute_index, rows, cols, counts) in facet_entries.items():
+        # Ints unless a count has a fractional part
+        counts = np.array(counts)
+        matrix = np.zeros((len(attribute_index), len(months)), dtype=counts.dtype)
+        attribute_rows = np.frombuffer(rows, dtype=np.int64)
+        month_rows = month_cols[np.frombuffer(cols, dtype=np.int64)]
+        # Like the old month dicts, the last count of a repeated pair wins
+        matrix[attribute_rows, month_rows] = counts
+        facet_matrices[facet] = (list(attribute_index), matrix)
+    return months, facet_matrices
+
+
+def dump_facet_month_counts(months, facet_matrices, base_path, output_dir, facets):
+    labels = [translate_month(month) for month in months]
+    # Facets without any rows still get a CSV with just the header
+    empty_matrix = ([], np.zeros((0, len(months)), dtype=np.int64))
+    for facet in dict.fromkeys(facet for facet, _ in facets):
+        attributes, matrix = facet_matrices.get(facet, empty_matrix)
+        suffix = f"-{facet}" if facet else ""
+        output_path = f"{output_dir}/{base_path}{suffix}.csv"
+        print(f"Dumping month counts for {facet or 'all'} attributes to {output_path}")
+        write_frequencies_csv(
+            output_path, attributes, labels, matrix, drop_empty_words=False
+        )
+
+
+def month_counts_facets(input_paths, base_path, output_dir, facets):
+    """Write a month counts CSV per facet of the TSVs in a single pass."""
+    classify = create_substring_classifier(facets)
+    months, facet_matrices = pivot_month_counts(input_paths, classify)
+    dump_facet_month_counts(months, facet_matrices, base_path, output_dir, facets)
 
 
 def month_counts_comorbidity(input_path, base_path, output_dir):
-    month_counts = dict()
-    months = [
-        "2020-01",
-        "2020-02",
-        "2020-03",
-        "2020-04",
-        "2020-05",
-        "2020-06",
-        "2020-07",
-        "2020-08",
-        "2020-09",
-        "2020-10",
-        "2020-11",
-        "2020-12",
-    ]
-    for month in months:
-        month_counts[month] = Counter()
-
-    with open(input_path, 'r') as f:
-        read_tsv = csv.reader(f, delimiter="\t")
-        for row in read_tsv:
-            month = row[0]
-            attribute = row[1]
-            count = row[2]
-            month_counts[month][attribute] = count
-
-    print("Dumping month counts for comorbidity related attributes")
-    months_unique_words = set()
-    for month, month_count in month_counts.items():
-        for word, word_count in month_count.items():
-            months_unique_words.add(word)
-
-    output_path = f"{output_dir}/{base_path}.csv"
-    dump_frequencies_months(
-        output_path, month_counts, months, months_unique_words
-    )
-
-        
-def month_counts_age_race_sex(input_path, base_path, output_dir):
-    month_counts_age = dict()
-    month_counts_race = dict()
-    month_counts_sex = dict()
-
-    months = [
-        "2020-01",
-        "2020-02",
-        "2020-03",
-        "2020-04",
-        "2020-05",
-        "2020-06",
-        "2020-07",
-        "2020-08",
-        "2020-09",
-        "2020-10",
-        "2020-11",
-        "2020-12",
-    ]
-    for month in months:
-        month_counts_age[month] = Counter()
-        month_counts_race[month] = Counter()
-        month_counts_sex[month] = Counter()
-
-    with open(input_path, 'r') as f:
-        read_tsv = csv.reader(f, delimiter="\t")
-        for row in read_tsv:
-            month = row[0]
-            attribute = row[1]
-            count = row[2]
-            if 'age' in attribute:
-                month_counts_age[month][attribute] = count
-            elif 'race' in attribute:
-                month_counts_race[month][attribute] = count
-            elif 'sex' in attribute:
-                month_counts_sex[month][attribute] = count
-                
-
-
-    print("Dumping month counts for age related attributes")
-    months_unique_words_age = set()
-    for month, month_count in month_counts_age.items():
-        for word, word_count in month_count.items():
-            months_unique_words_age.add(word)
-
-    output_path_age = f"{output_dir}/{base_path}-age.csv"
-    dump_frequencies_months(
-        output_path_age, month_counts_age, months, months_unique_words_age
-    )
-
-    print("Dumping month counts for race related attributes")
-    months_unique_words_race = set()
-    for month, month_count in month_counts_race.items():
-        for word, word_count in month_count.items():
-            months_unique_words_race.add(word)
-
-    output_path_race = f"{output_dir}/{base_path}-race.csv"
-    dump_frequencies_months(
-        output_path_race, month_counts_race, months, months_unique_words_race
-    )
-
-    print("Dumping month counts for sex related attributes")
-    months_unique_words_sex = set()
-    for month, month_count in month_counts_sex.items():
-        for word, word_count in month_count.items():
-            months_unique_words_sex.add(word)
-
-    output_path_sex = f"{output_dir}/{base_path}-sex.csv"
-    dump_frequencies_months(
-        output_path_sex, month_counts_sex, months, months_unique_words_sex
-    )
-
+    month_counts_facets([input_path], base_path, output_dir, ALL_ATTRIBUTES_FACETS)
 
 
+def month_counts_age_race_sex(input_path, base_path, output_dir):
+    month_counts_facets([input_path], base_path, output_dir, AGE_RACE_SEX_FACETS)
 
 
 if __name__ == '__main__':
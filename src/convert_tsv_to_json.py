@@ -1,5 +1,6 @@
 import csv
 import json
+from collections import Counter
 
 
 def main(input_path, output_path):
@@ -43,6 +44,137 @@ def main(input_path, output_path):
         json.dump(output, fout)
 
 
+# Ways to combine the values of repeated (comorbidity, drug) rows
+AGGREGATIONS = ["sum", "mean", "max"]
+
+COMORBIDITY_GROUP = 0
+DRUG_GROUP = 1
+
+
+class GraphBuilder:
+    """Comorbidity to drug edges of many months, keyed by integer node ids.
+
+    Node ids are shared by all months, edges[month] maps
+    (source_id, target_id) to [value sum, row count, value max].
+    """
+
+    def __init__(self):
+        self.node_ids = dict()
+        self.nodes = []
+        self.edges = dict()
+        self.c = Counter()
+
+    def get_node_id(self, name, group):
+        key = (name, group)
+        node_id = self.node_ids.get(key)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.node_ids[key] = node_id
+            self.nodes.append(key)
+        return node_id
+
+    def add_tsv(self, month, input_path):
+        print(f"Reading {month} links from {input_path}")
+        month_edges = self.edges.setdefault(month, dict())
+        with open(input_path, "r") as fin:
+            read_tsv = csv.reader(fin, delimiter="\t")
+            for row in read_tsv:
+                self.c["rows"] += 1
+                try:
+                    value = float(row[2])
+                except (IndexError, ValueError):
+                    self.c["malformed_rows"] += 1
+                    continue
+                source_id = self.get_node_id(row[0], COMORBIDITY_GROUP)
+                target_id = self.get_node_id(row[1], DRUG_GROUP)
+                edge = month_edges.get((source_id, target_id))
+                if edge is None:
+                    month_edges[(source_id, target_id)] = [value, 1, value]
+                    continue
+                self.c["duplicate_rows"] += 1
+                edge[0] += value
+                edge[1] += 1
+                edge[2] = max(edge[2], value)
+
+    def get_weights(self, month, aggregation="mean"):
+        """{(source_id, target_id): weight} of a month's edges."""
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(
+                f"Unknown aggregation {aggregation}, expected one of {AGGREGATIONS}"
+            )
+        weights = dict()
+        for key, (value_sum, count, value_max) in self.edges[month].items():
+            if aggregation == "sum":
+                weights[key] = value_sum
+            elif aggregation == "mean":
+                weights[key] = value_sum / count
+            else:
+                weights[key] = value_max
+        return weights
+
+    def get_graph(self, month, aggregation="mean", min_weight=None, top_n=None):
+        """Node/link dict of a month, keeping the top_n heaviest edges of at
+        least min_weight and only the nodes they connect."""
+        weights = self.get_weights(month, aggregation)
+        if min_weight is not None:
+            weights = {
+                key: weight for key, weight in weights.items() if weight >= min_weight
+            }
+        # Ties are broken by node ids so the output doesn't depend on TSV order
+        edges = sorted(weights.items(), key=lambda item: (-item[1], item[0]))
+        if top_n is not None:
+            edges = edges[:top_n]
+
+        node_ids = sorted({node_id for key, _ in edges for node_id in key})
+        nodes = [
+            {"id": self.nodes[node_id][0], "group": self.nodes[node_id][1]}
+            for node_id in node_ids
+        ]
+        links = [
+            {
+                "source": self.nodes[source_id][0],
+                "target": self.nodes[target_id][0],
+                "value": round(weight, 4),
+            }
+            for (source_id, target_id), weight in edges
+        ]
+        return {"nodes": nodes, "links": links}
+
+    def dump_graphs(
+        self, output_dir, base_path, aggregation="mean", min_weight=None, top_n=None
+    ):
+        """Dump a compact {base_path}_{month}.json per month, returns the paths."""
+        output_paths = []
+        for month in sorted(self.edges):
+            graph = self.get_graph(month, aggregation, min_weight, top_n)
+            output_path = f"{output_dir}/{base_path}_{month}.json"
+            print(
+                f"Dumping {len(graph['nodes'])} nodes and {len(graph['links'])} "
+                f"links to {output_path}"
+            )
+            with open(output_path, "w") as fout:
+                json.dump(graph, fout, separators=(",", ":"))
+            output_paths.append(output_path)
+        return output_paths
+
+
+def main_months(
+    input_dir,
+    output_dir,
+    base_path,
+    months,
+    aggregation="mean",
+    min_weight=None,
+    top_n=None,
+):
+    """Build the graphs of all months' {base_path}_{month}.tsv in one run."""
+    builder = GraphBuilder()
+    for month in months:
+        builder.add_tsv(month, f"{input_dir}/{base_path}_{month}.tsv")
+    print(f"{builder.c}")
+    return builder.dump_graphs(output_dir, base_path, aggregation, min_weight, top_n)
+
+
 if __name__ == "__main__":
     repo_dir = "/Users/hamc649/Documents/deepcare/covid-19/covid-nlp"
     script_name = "convert_tsv_to_json"
@@ -50,15 +182,7 @@ if __name__ == "__main__":
     input_dir = f"{script_dir}/input"
     output_dir = f"{script_dir}/output"
 
-    month = "2020-02"
-    month = "2020-03"
-    #month = "2020-04"
-    #month = "2020-05"
-    #month = "2020-06"
-
-    print(f"month: {month}")
-
-    base_path = f"comborbidity_concomitant_drug_interaction_{month}"
-    input_path = f"{input_dir}/{base_path}.tsv"
-    output_path = f"{output_dir}/{base_path}.json"
-    main(input_path, output_path)
+    base_path = "comborbidity_concomitant_drug_interaction"
+    months = ["2020-02", "2020-03", "2020-04", "2020-05", "2020-06"]
+    print(f"months: {months}")
+    main_months(input_dir, output_dir, base_path, months, top_n=200)
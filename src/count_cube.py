@@ -0,0 +1,228 @@
+# Vocabulary x day entity count cube
+from datetime import datetime
+
+import numpy as np
+
+RESOLUTIONS = ["day", "week", "month", "quarter", "year"]
+
+# Default range of days counted by an EntityCountCube, days outside of it are
+# counted as malformed instead of stretching the dense day axis
+MIN_DAY = "1900-01-01"
+MAX_DAY = "2099-12-31"
+
+
+def parse_day(day_key):
+    """Parse a YYYY-MM-DD key, NaT for malformed timestamps."""
+    try:
+        return np.datetime64(day_key, "D")
+    except ValueError:
+        return np.datetime64("NaT", "D")
+
+
+def get_periods(days, resolution):
+    """Map a datetime64[D] array to the first day of each day's period."""
+    if resolution == "day":
+        return days
+    if resolution == "week":
+        # Weeks start on Monday, 1970-01-01 was a Thursday
+        weekdays = (days.astype(np.int64) + 3) % 7
+        return days - weekdays.astype("timedelta64[D]")
+    months = days.astype("datetime64[M]")
+    if resolution == "month":
+        return months.astype("datetime64[D]")
+    if resolution == "quarter":
+        month_nums = months.astype(np.int64)
+        quarters = (month_nums - month_nums % 3).astype("datetime64[M]")
+        return quarters.astype("datetime64[D]")
+    if resolution == "year":
+        return days.astype("datetime64[Y]").astype("datetime64[D]")
+    raise ValueError(f"Unknown resolution {resolution}, expected one of {RESOLUTIONS}")
+
+
+def format_periods(periods, resolution):
+    """Labels of period start days, months and quarters match the old CSVs."""
+    if resolution in ["day", "week"]:
+        return np.datetime_as_string(periods, unit="D")
+    dates = [datetime.strptime(str(period), "%Y-%m-%d") for period in periods]
+    if resolution == "month":
+        labels = [date.strftime("%B %Y") for date in dates]
+    elif resolution == "quarter":
+        labels = [f"Q{(date.month - 1) // 3 + 1} {date.year}" for date in dates]
+    else:
+        labels = [str(date.year) for date in dates]
+    return np.array(labels, dtype=str)
+
+
+def format_counts(counts):
+    """Counts as strings, integral counts of float arrays without a ".0"."""
+    count_strs = counts.astype(str)
+    if counts.dtype.kind == "f":
+        integral = np.isfinite(counts) & (counts == np.trunc(counts))
+        int_strs = np.where(integral, counts, 0).astype(np.int64).astype(str)
+        count_strs = np.where(integral, int_strs, count_strs)
+    return count_strs
+
+
+def write_frequencies_csv(path, words, labels, counts, drop_empty_words=True):
+    """Write word,label,count lines of a word x label matrix in one write.
+
+    Words are sorted, words without any counts are left out by default.
+    """
+    words = np.array(words, dtype=str)
+    if drop_empty_words:
+        word_rows = np.flatnonzero(counts.any(axis=1))
+    else:
+        word_rows = np.arange(len(words))
+    word_rows = word_rows[np.argsort(words[word_rows], kind="stable")]
+    labels = np.asarray(labels, dtype=str)
+
+    lines = np.char.add(np.repeat(words[word_rows], len(labels)), ",")
+    lines = np.char.add(lines, np.tile(labels, len(word_rows)))
+    lines = np.char.add(lines, ",")
+    lines = np.char.add(lines, format_counts(counts[word_rows].ravel()))
+    with open(path, "w") as f:
+        header = "territory,quarter,profit\n"
+        f.write(header)
+        if len(lines):
+            f.write("\n".join(lines.tolist()))
+            f.write("\n")
+
+
+class EntityCountCube:
+    """Entity counts in a vocab x day numpy array.
+
+    Rows are words in order of first appearance, column i is start_day + i.
+    The day range grows to cover every counted day between min_day and
+    max_day, days outside of them are counted in num_malformed_days. Rows grow
+    by doubling so new words don't copy the whole array every time.
+    """
+
+    def __init__(self, min_day=MIN_DAY, max_day=MAX_DAY):
+        self.vocab = dict()
+        self.words = []
+        self.start_day = None
+        self.counts = np.zeros((0, 0), dtype=np.int32)
+        self.num_malformed_days = 0
+        self.min_day = np.datetime64(min_day, "D")
+        self.max_day = np.datetime64(max_day, "D")
+
+    def __str__(self):
+        return (
+            f"EntityCountCube(num_words: {len(self.words)}, "
+            f"num_days: {self.num_days()}, start_day: {self.start_day}, "
+            f"num_malformed_days: {self.num_malformed_days})"
+        )
+
+    def num_days(self):
+        return self.counts.shape[1]
+
+    def get_counts(self):
+        return self.counts[: len(self.words)]
+
+    def get_days(self):
+        if self.start_day is None:
+            return np.array([], dtype="datetime64[D]")
+        return self.start_day + np.arange(self.num_days())
+
+    def get_word_row(self, word):
+        row = self.vocab.get(word)
+        if row is None:
+            row = len(self.words)
+            self.vocab[word] = row
+            self.words.append(word)
+        return row
+
+    def resize(self, first_day, last_day):
+        """Grow counts to cover the vocabulary and first_day..last_day."""
+        if self.start_day is None:
+            start_day = first_day
+            end_day = last_day
+        else:
+            start_day = min(self.start_day, first_day)
+            end_day = max(self.start_day + self.num_days() - 1, last_day)
+        num_days = int((end_day - start_day).astype(np.int64)) + 1
+        num_rows = len(self.counts)
+        if len(self.words) > num_rows:
+            num_rows = max(len(self.words), 2 * num_rows)
+        shape = (num_rows, num_days)
+        if shape == self.counts.shape:
+            return
+        counts = np.zeros(shape, dtype=np.int32)
+        if self.start_day is not None:
+            offset = int((self.start_day - start_day).astype(np.int64))
+            num_words, num_old_days = self.counts.shape
+            counts[:num_words, offset : offset + num_old_days] = self.counts
+        self.counts = counts
+        self.start_day = start_day
+
+    def add_counts(self, day_entity_counts):
+        """Add a {(day_key, entity): count} Counter to the cube."""
+        if not day_entity_counts:
+            return
+        day_keys, entities = zip(*day_entity_counts.keys())
+        values = np.fromiter(
+            day_entity_counts.values(), dtype=np.int64, count=len(day_keys)
+        )
+        # Only parse each distinct day once
+        parsed_days = {day_key: parse_day(day_key) for day_key in set(day_keys)}
+        days = np.array([parsed_days[day_key] for day_key in day_keys])
+        valid = ~np.isnat(days)
+        valid[valid] = (days[valid] >= self.min_day) & (days[valid] <= self.max_day)
+        self.num_malformed_days += int(values[~valid].sum())
+        if not valid.any():
+            return
+
+        rows = np.fromiter(
+            (self.get_word_row(entity) for entity in entities),
+            dtype=np.int64,
+            count=len(entities),
+        )
+        rows, days, values = rows[valid], days[valid], values[valid]
+        self.resize(days.min(), days.max())
+        columns = (days - self.start_day).astype(np.int64)
+        np.add.at(self.counts, (rows, columns), values)
+
+    def merge(self, other):
+        """Add the counts of another cube with the same day range."""
+        self.num_malformed_days += other.num_malformed_days
+        if other.start_day is None:
+            return
+        rows = np.array(
+            [self.get_word_row(word) for word in other.words], dtype=np.int64
+        )
+        other_last_day = other.start_day + other.num_days() - 1
+        self.resize(other.start_day, other_last_day)
+        offset = int((other.start_day - self.start_day).astype(np.int64))
+        self.counts[rows, offset : offset + other.num_days()] += other.get_counts()
+
+    def rollup(self, resolution="month", start_date=None, end_date=None):
+        """Sum the days of each period between the optional bounds.
+
+        Returns the first day of each period and a vocab x period array.
+        """
+        days = self.get_days()
+        counts = self.get_counts()
+        selected = np.ones(len(days), dtype=bool)
+        if start_date:
+            selected &= days >= np.datetime64(start_date, "D")
+        if end_date:
+            selected &= days <= np.datetime64(end_date, "D")
+        days = days[selected]
+        counts = counts[:, selected]
+        if not len(days):
+            return days, np.zeros((len(self.words), 0), dtype=np.int64)
+
+        # Days are sorted, so each period is one contiguous run of columns
+        periods = get_periods(days, resolution)
+        starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+        period_counts = np.add.reduceat(counts, starts, axis=1, dtype=np.int64)
+        return periods[starts], period_counts
+
+    def dump_frequencies(
+        self, path, resolution="month", start_date=None, end_date=None
+    ):
+        """Dump word,period,count lines for every word counted in the range."""
+        print(f"Dumping frequencies for {resolution} counts to {path}")
+        periods, period_counts = self.rollup(resolution, start_date, end_date)
+        labels = format_periods(periods, resolution)
+        write_frequencies_csv(path, self.words, labels, period_counts)
@@ -267,6 +267,17 @@ class Event(Entity):
         self.event_type = "DRUG_EXPOSURE"
         self.add_drug_exposure_roles(row, drug_concept_name)
 
+    def nlp_entity_role(self, event_type, entity_result, section_header="", note_id=""):
+        self.event_type = event_type
+        self.add_nlp_entity_roles(entity_result, section_header, note_id)
+
+    def add_nlp_entity_roles(self, entity_result, section_header, note_id):
+        # Keep everything the NLP pipeline extracted, e.g. entity and text
+        for role, role_value in entity_result.items():
+            self.roles[role] = role_value
+        self.roles["section_header"] = section_header
+        self.roles["note_id"] = note_id
+
     def add_meddra_roles(self, row):
         # Meddra levels
         self.roles["SOC"] = row.SOC
@@ -1,5 +1,6 @@
 from collections import Counter
 from datetime import datetime
+from itertools import islice
 from typing import Dict, Set
 
 import dask.dataframe as dd
@@ -7,6 +8,21 @@ import pandas as pd
 
 from data_schema import Event
 from patient_db import PatientDB
+from progress import Progress
+
+# CONCEPT classes that are turned into DRUG_EXPOSURE events
+ACCEPTED_DRUG_CONCEPT_CLASS_IDS = set()
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Prescription Drug')
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Ingredient')
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('CVX')
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Undefined')
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Drug Product')
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Branded Drug')
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Branded Drug Form')
+ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add("Clinical Drug")
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Clinical Drug Comp')
+# Quantity first in string
+# ACCEPTED_DRUG_CONCEPT_CLASS_IDS.add('Quant Clinical Drug')
 
 
 def get_diagnosis_events_distress(patients: PatientDB, row, date_str, patient_id):
@@ -231,7 +247,7 @@ def get_distinct_column_values(df, output_dir, keys, use_dask=False):
                 f.write(f"{distinct_column_value}\n")
 
 
-def get_diagnosis_events(patients: PatientDB, df):
+def get_diagnosis_events(patients: PatientDB, df, max_rows=10000):
     print("Getting diagnosis events...")
     columns: Dict[str, Counter] = dict()
     column_names = df.columns.tolist()
@@ -243,57 +259,64 @@ def get_diagnosis_events(patients: PatientDB, df):
     # itterrows
     # temporarily using to satisfy unkown columns addition to roles
 
-    # FIXME, only look at 1000000 rows
-    i_max = 10000
-    print(f"Limiting iteration of dataframe to a maximum of {i_max} rows")
-    for i, row in enumerate(df.itertuples()):
-        if i % (i_max / 10) == 0:
-            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{now_str} Tuple: {i}/{i_max}")
-        if i >= i_max:
-            break
-        # import pdb;pdb.set_trace()
-        date_str = row.date
-        patient_id = str(row.patid)
-
-        # Meddra column value counters
-        # count_column_values(row, columns)
-
-        # Check for different types of diagnosis events
-        found_depression = get_diagnosis_events_depression(
-            patients, row, date_str, patient_id
-        )
-        found_anxiety = get_diagnosis_events_anxiety(
-            patients, row, date_str, patient_id
-        )
-        found_insomnia = get_diagnosis_events_insomnia(
-            patients, row, date_str, patient_id
-        )
-        found_distress = get_diagnosis_events_distress(
-            patients, row, date_str, patient_id
-        )
-
-        # If we don't find a mental health symptom assume we have found
-        # a diagnosis event/symptom without match
-        found_any_events = any(
-            [found_depression, found_anxiety, found_insomnia, found_distress]
-        )
-
-        if found_any_events:
-            continue
-        # Add meddra event
-        meddra_event = Event(
-            chartdate=date_str, visit_id=date_str, patient_id=patient_id
-        )
-        meddra_event.meddra_role(row)
-        patients.add_event(meddra_event)
+    # FIXME, only look at max_rows rows, None looks at all rows
+    i_max = max_rows
+    # Don't compute the length of dask dataframes just for the ETA
+    num_rows = len(df) if isinstance(df, pd.DataFrame) else None
+    if i_max is not None:
+        print(f"Limiting iteration of dataframe to a maximum of {i_max} rows")
+        num_rows = i_max if num_rows is None else min(num_rows, i_max)
+    c = Counter()
+    with Progress(
+        "get_diagnosis_events", num_rows, counters=c, unit="rows"
+    ) as progress:
+        for row in progress.track(islice(df.itertuples(), i_max)):
+            # import pdb;pdb.set_trace()
+            date_str = row.date
+            patient_id = str(row.patid)
+
+            # Meddra column value counters
+            # count_column_values(row, columns)
+
+            # Check for different types of diagnosis events
+            found_depression = get_diagnosis_events_depression(
+                patients, row, date_str, patient_id
+            )
+            found_anxiety = get_diagnosis_events_anxiety(
+                patients, row, date_str, patient_id
+            )
+            found_insomnia = get_diagnosis_events_insomnia(
+                patients, row, date_str, patient_id
+            )
+            found_distress = get_diagnosis_events_distress(
+                patients, row, date_str, patient_id
+            )
+
+            # If we don't find a mental health symptom assume we have found
+            # a diagnosis event/symptom without match
+            found_any_events = any(
+                [found_depression, found_anxiety, found_insomnia, found_distress]
+            )
+
+            if found_any_events:
+                c["mental_health_events"] += 1
+                continue
+            # Add meddra event
+            meddra_event = Event(
+                chartdate=date_str, visit_id=date_str, patient_id=patient_id
+            )
+            meddra_event.meddra_role(row)
+            patients.add_event(meddra_event)
+            c["meddra_events"] += 1
 
     # print(f"columns: {columns}")
     # print("Top 10 diagnosis ")
     # import pdb;pdb.set_trace()
 
 
-def get_medication_events(patients: PatientDB, concept_df, df, use_dask=False):
+def get_medication_events(
+    patients: PatientDB, concept_df, df, use_dask=False, max_rows=10000
+):
     print("Getting medication events...", flush=True)
     columns: Dict[str, Counter] = dict()
     column_names = df.columns.tolist()
@@ -304,9 +327,9 @@ def get_medication_events(patients: PatientDB, concept_df, df, use_dask=False):
     # new_df = df.join(concept_df.set_index('concept_id'),
     # n='drug_concept_id', how="left", ruffix="")
     if use_dask:
-        df_lib = pd
-    else:
         df_lib = dd
+    else:
+        df_lib = pd
 
     # new_df = df_lib.merge(
     #    df, concept_df, how="left", left_on="drug_concept_id",
@@ -326,28 +349,19 @@ def get_medication_events(patients: PatientDB, concept_df, df, use_dask=False):
     # import pdb;pdb.set_trace()
 
     drug_concept_class_ids: Set[str] = set()
-    accepted_drug_concept_class_ids = set()
-    # accepted_drug_concept_class_ids.add('Prescription Drug')
-    # accepted_drug_concept_class_ids.add('Ingredient')
-    # accepted_drug_concept_class_ids.add('CVX')
-    # accepted_drug_concept_class_ids.add('Undefined')
-    # accepted_drug_concept_class_ids.add('Drug Product')
-    # accepted_drug_concept_class_ids.add('Branded Drug')
-    # accepted_drug_concept_class_ids.add('Branded Drug Form')
-    accepted_drug_concept_class_ids.add("Clinical Drug")
-    # accepted_drug_concept_class_ids.add('Clinical Drug Comp')
-    # Quantity first in string
-    # accepted_drug_concept_class_ids.add('Quant Clinical Drug')
+    accepted_drug_concept_class_ids = ACCEPTED_DRUG_CONCEPT_CLASS_IDS
 
     # FIXME
     # get medication events from drug_exposure table
-    i_max = 10000
-    print(f"Limiting iteration of dataframe to a maximum of {i_max} rows")
+    i_max = max_rows
+    if i_max is not None:
+        print(f"Limiting iteration of dataframe to a maximum of {i_max} rows")
+    print_every = i_max / 10 if i_max else 100000
     for i, row in enumerate(new_df.itertuples()):
-        if i % (i_max / 10) == 0:
+        if i % print_every == 0:
             now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{now_str} Tuple: {i}/{i_max}")
-        if i >= i_max:
+            print(f"{now_str} Tuple: {i}/{i_max or 'all'}")
+        if i_max is not None and i >= i_max:
             break
         # FIXME, should events be required to have a single date if
         # they are more of an event range?
@@ -402,12 +416,17 @@ def get_events(
     diagnosis_df,
     omop_drug_exposure_df,
     use_dask=False,
+    max_rows=10000,
 ):
     print("Getting events...")
     print("Getting diagnosis events")
-    get_diagnosis_events(patients, diagnosis_df)
+    get_diagnosis_events(patients, diagnosis_df, max_rows=max_rows)
 
     print("Getting medication events")
     get_medication_events(
-        patients, omop_concept_df, omop_drug_exposure_df, use_dask=use_dask
+        patients,
+        omop_concept_df,
+        omop_drug_exposure_df,
+        use_dask=use_dask,
+        max_rows=max_rows,
     )
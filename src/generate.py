@@ -17,11 +17,65 @@ import pyarrow
 from dask.core import get
 from tqdm import tqdm
 
+from benchmark import StageProfiler
 from data_schema import EntityEncoder, Event, Patient, Visit
-from events import get_events
-from omop import omop_concept, omop_drug_exposure
+from events import ACCEPTED_DRUG_CONCEPT_CLASS_IDS, get_events
+from omop import (
+    CONCEPT_COLUMNS,
+    DRUG_EXPOSURE_COLUMNS,
+    omop_concept,
+    omop_drug_exposure,
+)
 from patient_db import PatientDB
-from utils import date_obj_to_str, get_df, get_patient_ids, get_person_ids, get_table
+from patient_registry import (
+    PatientIdRegistry,
+    get_input_fingerprint,
+    get_registry_path,
+)
+from utils import (
+    date_obj_to_str,
+    get_df,
+    get_table,
+)
+
+# meddra extraction columns used by Event.add_meddra_roles() and get_events()
+MEDDRA_EXTRACTIONS_COLUMNS = [
+    "patid",
+    "date",
+    "SOC",
+    "HLGT",
+    "HLT",
+    "PT",
+    "SOC_CUI",
+    "HLGT_CUI",
+    "HLT_CUI",
+    "PT_CUI",
+    "extracted_CUI",
+    "SOC_text",
+    "HLGT_text",
+    "HLT_text",
+    "PT_text",
+    "concept_text",
+    "PExperiencer",
+    "medID",
+    "note_id",
+    "note_title",
+    "polarity",
+    "pos",
+    "present",
+    "ttype",
+]
+
+# demographics columns used by PatientDB.add_demographic_info()
+DEMOGRAPHICS_COLUMNS = [
+    "person_id",
+    "year_of_birth",
+    "month_of_birth",
+    "day_of_birth",
+    "gender",
+    "race",
+    "ethnicity",
+]
 
 
 def count_column_values(row, counter):
@@ -115,31 +169,52 @@ def get_all_patient_visit_dates(patients: PatientDB, df):
     return patient_visit_dates
 
 
-def get_all_patient_ids(demographics, extractions, drug_exposure, use_dask=False):
-    all_patient_ids = set()
+def get_all_patient_ids(
+    demographics,
+    extractions,
+    drug_exposure,
+    use_dask=False,
+    registry_path=None,
+    input_fingerprint=None,
+):
+    """Get the registry of patient IDs found in any of the input tables.
+
+    If registry_path exists and was gathered from inputs with the same
+    input_fingerprint the registry is loaded from it, otherwise it is
+    gathered from the tables and dumped to registry_path.
+    """
+    if registry_path and os.path.exists(get_registry_path(registry_path)):
+        all_patient_ids = PatientIdRegistry.load(registry_path)
+        if all_patient_ids.fingerprint == input_fingerprint:
+            print(f"len(all_patient_ids): {len(all_patient_ids)}", flush=True)
+            return all_patient_ids
+        print("PatientIdRegistry is stale, gathering patient IDs again", flush=True)
+
+    tables = [
+        ("demographics", demographics, "person_id"),
+        ("extractions", extractions, "patid"),
+        ("medications", drug_exposure, "person_id"),
+    ]
+    all_patient_ids = PatientIdRegistry.from_tables(tables, use_dask=use_dask)
+    all_patient_ids.fingerprint = input_fingerprint
+    if registry_path:
+        all_patient_ids.dump(registry_path)
 
-    demo_person_ids = get_person_ids(demographics, use_dask)
-    demo_person_ids = set(demo_person_ids)
-    print(f"demographics: len(demo_person_ids): {len(demo_person_ids)}", flush=True)
-    all_patient_ids.update(demo_person_ids)
+    print(f"len(all_patient_ids): {len(all_patient_ids)}", flush=True)
+    return all_patient_ids
 
-    # Get distinct Patient ID values from dataframe
-    patient_ids = get_patient_ids(extractions, use_dask)
-    patient_ids = set(patient_ids)
-    print(f"extractions: len(patient_ids): {len(patient_ids)}", flush=True)
-    all_patient_ids.update(patient_ids)
 
-    drug_exposure_person_ids = get_person_ids(drug_exposure, use_dask)
-    # import pdb;pdb.set_trace()
-    # DEBUG FIXME, dask doesn't like turning this to a set
-    drug_exposure_person_ids = set(drug_exposure_person_ids)
-    print(
-        f"medications: len(med_person_ids): {len(drug_exposure_person_ids)}", flush=True
-    )
-    all_patient_ids.update(drug_exposure_person_ids)
+def get_date_range_filters(column, start_date=None, end_date=None):
+    """Create pyarrow style filters selecting start_date <= column <= end_date.
 
-    print(f"len(all_patient_ids): {len(all_patient_ids)}", flush=True)
-    return all_patient_ids
+    Dates are "%Y-%m-%d" strings, which compare in date order.
+    """
+    filters = []
+    if start_date:
+        filters.append((column, ">=", start_date))
+    if end_date:
+        filters.append((column, "<=", end_date))
+    return filters
 
 
 def generate_patient_db(
@@ -150,72 +225,133 @@ def generate_patient_db(
     output_dir,
     debug,
     use_dask,
+    start_date=None,
+    end_date=None,
+    num_read_workers=1,
+    csv_cache_dir=None,
+    patient_id_registry_path=None,
+    compact_dtypes=False,
+    profile_path=None,
+    trace_memory=False,
 ):
 
+    # Time and measure the memory of every stage, reported to profile_path
+    profiler = StageProfiler("generate_patient_db", trace_memory=trace_memory)
+
     # Create patient DB to store data
     patients = PatientDB(name="all")
 
-    # Get demographics dataframe
-    demographics = get_df(demographics_path, use_dask=use_dask, debug=debug)
+    with profiler.stage("read_demographics"):
+        # Get demographics dataframe
+        demographics = get_df(
+            demographics_path,
+            use_dask=use_dask,
+            debug=debug,
+            columns=DEMOGRAPHICS_COLUMNS,
+            compact=compact_dtypes,
+            id_columns=["person_id"],
+        )
 
     ### NLP TABLES ###
-    # Get meddra extractions dataframe
-    meddra_extractions_pattern = "*_*"
-    meddra_extractions_pattern_re = ".*_.*"
-    meddra_extractions = get_table(
-        meddra_extractions_dir,
-        prefix="all_POS_batch",
-        pattern=meddra_extractions_pattern,
-        pattern_re=meddra_extractions_pattern_re,
-        extension=".parquet",
-        use_dask=use_dask,
-        debug=debug,
-    )
-
-    meddra_extractions_columns = sorted(meddra_extractions.columns.tolist())
-    print(
-        f"meddra extractions column names:\n\t{meddra_extractions_columns}", flush=True
-    )
+    with profiler.stage("read_meddra_extractions"):
+        # Get meddra extractions dataframe
+        meddra_extractions_pattern = "*_*"
+        meddra_extractions_pattern_re = ".*_.*"
+        meddra_extractions = get_table(
+            meddra_extractions_dir,
+            prefix="all_POS_batch",
+            pattern=meddra_extractions_pattern,
+            pattern_re=meddra_extractions_pattern_re,
+            extension=".parquet",
+            use_dask=use_dask,
+            debug=debug,
+            columns=MEDDRA_EXTRACTIONS_COLUMNS,
+            filters=get_date_range_filters("date", start_date, end_date),
+            num_workers=num_read_workers,
+            compact=compact_dtypes,
+            id_columns=["patid"],
+        )
+
+        meddra_extractions_columns = sorted(meddra_extractions.columns.tolist())
+        print(
+            f"meddra extractions column names:\n\t{meddra_extractions_columns}",
+            flush=True,
+        )
 
     ### OMOP TABLES ###
-    # OMOP DRUG_EXPOSURE table
-    drug_exposure_pattern = "0000000000*"
-    drug_exposure_pattern_re = "0000000000.*"
-    drug_exposure = omop_drug_exposure(
-        drug_exposure_dir,
-        prefix="drug_exposure",
-        pattern=drug_exposure_pattern,
-        pattern_re=drug_exposure_pattern_re,
-        extension=".csv",
-        use_dask=use_dask,
-        debug=debug,
-    )
-    drug_exposure_columns = sorted(drug_exposure.columns.tolist())
-    print(f"drug exposure column names:\n\t{drug_exposure_columns}", flush=True)
-
-    # OMOP CONCEPT table
-    concept = omop_concept(concept_dir, use_dask=use_dask, debug=debug)
-    concept_columns = sorted(concept.columns.tolist())
-    print(f"concept column names:\n\t{concept_columns}", flush=True)
-    # import pdb;pdb.set_trace()
-
-    patient_ids = get_all_patient_ids(
-        demographics, meddra_extractions, drug_exposure, use_dask=use_dask
-    )
-
-    get_events(patients, concept, meddra_extractions, drug_exposure, use_dask=False)
-    if not patients.data["events"]:
-        print("Empty events dict! Exiting...", flush=True)
-        sys.exit(0)
-    print(f"Found {patients.num_events()} events", flush=True)
-
-    print("Filter out patient IDs that don't have any events", flush=True)
-    patient_ids = patients.select_non_empty_patients(patient_ids)
-
-    print("Generate patients from IDs", flush=True)
-    patients.generate_patients_from_ids(patient_ids)
-    # import pdb
-    # pdb.set_trace()
+    with profiler.stage("read_drug_exposure"):
+        # OMOP DRUG_EXPOSURE table
+        drug_exposure_pattern = "0000000000*"
+        drug_exposure_pattern_re = "0000000000.*"
+        drug_exposure = omop_drug_exposure(
+            drug_exposure_dir,
+            prefix="drug_exposure",
+            pattern=drug_exposure_pattern,
+            pattern_re=drug_exposure_pattern_re,
+            extension=".csv",
+            use_dask=use_dask,
+            debug=debug,
+            columns=DRUG_EXPOSURE_COLUMNS,
+            filters=get_date_range_filters(
+                "drug_exposure_start_DATE", start_date, end_date
+            ),
+            num_workers=num_read_workers,
+            cache_dir=csv_cache_dir,
+            compact=compact_dtypes,
+            id_columns=["person_id"],
+        )
+        drug_exposure_columns = sorted(drug_exposure.columns.tolist())
+        print(f"drug exposure column names:\n\t{drug_exposure_columns}", flush=True)
+
+    with profiler.stage("read_concept"):
+        # OMOP CONCEPT table
+        # Only CONCEPT rows in the accepted drug classes are joined to events
+        concept = omop_concept(
+            concept_dir,
+            use_dask=use_dask,
+            debug=debug,
+            columns=CONCEPT_COLUMNS,
+            filters=[
+                ("concept_class_id", "in", sorted(ACCEPTED_DRUG_CONCEPT_CLASS_IDS))
+            ],
+            num_workers=num_read_workers,
+            cache_dir=csv_cache_dir,
+        )
+        concept_columns = sorted(concept.columns.tolist())
+        print(f"concept column names:\n\t{concept_columns}", flush=True)
+        # import pdb;pdb.set_trace()
+
+    with profiler.stage("get_patient_ids"):
+        # A saved registry is only reused for the same inputs and dates
+        input_fingerprint = None
+        if patient_id_registry_path:
+            input_fingerprint = get_input_fingerprint(
+                [demographics_path, meddra_extractions_dir, drug_exposure_dir],
+                {"start_date": start_date, "end_date": end_date},
+            )
+        patient_ids = get_all_patient_ids(
+            demographics,
+            meddra_extractions,
+            drug_exposure,
+            use_dask=use_dask,
+            registry_path=patient_id_registry_path,
+            input_fingerprint=input_fingerprint,
+        )
+
+    with profiler.stage("get_events"):
+        get_events(patients, concept, meddra_extractions, drug_exposure, use_dask=False)
+        if not patients.data["events"]:
+            print("Empty events dict! Exiting...", flush=True)
+            sys.exit(0)
+        print(f"Found {patients.num_events()} events", flush=True)
+
+    with profiler.stage("select_non_empty_patients"):
+        print("Filter out patient IDs that don't have any events", flush=True)
+        patient_ids = patients.select_non_empty_patients(patient_ids)
+
+    with profiler.stage("generate_patients_from_ids"):
+        print("Generate patients from IDs", flush=True)
+        patients.generate_patients_from_ids(patient_ids)
 
     # print('Get all patient visit dates...')
     # patient_visit_dates = \
@@ -233,19 +369,21 @@ def generate_patient_db(
     # import pdb
     # pdb.set_trace()
 
-    # FIXME
-    print("Attach events to visits...", flush=True)
-    patients.attach_events_to_visits()
-    # import pdb
-    # pdb.set_trace()
+    with profiler.stage("attach_events_to_visits"):
+        # FIXME
+        print("Attach events to visits...", flush=True)
+        patients.attach_events_to_visits()
 
-    print("Attach demographic information to patients", flush=True)
-    patients.add_demographic_info(demographics, use_dask)
-    # import pdb
-    # pdb.set_trace()
+    with profiler.stage("add_demographic_info"):
+        print("Attach demographic information to patients", flush=True)
+        patients.add_demographic_info(demographics, use_dask)
+
+    with profiler.stage("dump"):
+        print("Dump patients to a file", flush=True)
+        patients.dump(output_dir, "patients", "jsonl", unique=True)
 
-    print("Dump patients to a file", flush=True)
-    patients.dump(output_dir, "patients", "jsonl", unique=True)
+    if profile_path:
+        profiler.dump(profile_path, {"output_dir": output_dir, "use_dask": use_dask})
 
     # import pdb
     # pdb.set_trace()
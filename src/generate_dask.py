@@ -0,0 +1,246 @@
+import os
+import shutil
+import time
+from collections import Counter
+
+import dask
+import pandas as pd
+
+from events import ACCEPTED_DRUG_CONCEPT_CLASS_IDS, get_events
+from generate import (
+    DEMOGRAPHICS_COLUMNS,
+    MEDDRA_EXTRACTIONS_COLUMNS,
+    get_date_range_filters,
+)
+from omop import (
+    CONCEPT_COLUMNS,
+    DRUG_EXPOSURE_COLUMNS,
+    omop_concept,
+    omop_drug_exposure,
+)
+from patient_db import PatientDB
+from utils import get_df, get_table
+
+try:
+    from dask.distributed import Client, LocalCluster
+except ImportError:
+    Client = None
+    LocalCluster = None
+
+# Integer patient ID that the tables are shuffled on
+PARTITION_COLUMN = "partition_patient_id"
+
+
+def add_partition_patient_id(df, id_column):
+    """Add an int64 copy of each row's patient ID to a pandas frame."""
+    df = df[df[id_column].notnull()]
+    # IDs read next to NaNs come in as floats, make sure "123.0" is "123"
+    df = df.astype({id_column: "int64"})
+    df = df.assign(**{PARTITION_COLUMN: df[id_column]})
+    return df
+
+
+def partition_by_patient(df, id_column, num_partitions):
+    """Shuffle a dask frame so each patient's rows share one partition.
+
+    The shuffle hashes the int64 patient IDs the same way for every frame,
+    so partition i of all frames holds the same patients.
+    """
+    df = df.map_partitions(add_partition_patient_id, id_column)
+    df = df.shuffle(PARTITION_COLUMN, npartitions=num_partitions)
+    return df
+
+
+def generate_partition_patient_db(
+    partition_i, meddra_extractions, drug_exposure, demographics, concept, output_dir
+):
+    """Build and dump the PatientDB for the patients of one partition."""
+    patients = PatientDB(name=f"partition_{partition_i}")
+    stats = Counter()
+    stats["partition"] = partition_i
+
+    get_events(
+        patients,
+        concept,
+        meddra_extractions,
+        drug_exposure,
+        use_dask=False,
+        max_rows=None,
+    )
+    if not patients.data["events"]:
+        print(f"Partition {partition_i}: empty events dict, skipping", flush=True)
+        return stats, None
+
+    patient_ids = set()
+    patient_ids.update(demographics.person_id.tolist())
+    patient_ids.update(meddra_extractions.patid.tolist())
+    patient_ids.update(drug_exposure.person_id.tolist())
+    patient_ids = patients.select_non_empty_patients(patient_ids)
+    patients.generate_patients_from_ids(patient_ids)
+    patients.attach_events_to_visits()
+    patients.add_demographic_info(demographics, use_dask=False)
+
+    partition_path = f"patients_partition{partition_i:05d}.jsonl"
+    patients.dump(output_dir, partition_path, "jsonl")
+
+    stats["num_patients"] = patients.num_patients()
+    stats["num_visits"] = patients.num_visits()
+    stats["num_events"] = patients.num_events()
+    return stats, f"{output_dir}/{partition_path}"
+
+
+def merge_partition_dumps(partition_paths, output_dir, path="patients"):
+    """Concatenate partition dumps, in partition order, into one dump."""
+    output_path = PatientDB().generate_path_with_time(f"{output_dir}/{path}", "jsonl")
+    print(f"Merging {len(partition_paths)} partition dumps into {output_path}")
+    with open(output_path, "w") as fout:
+        for partition_path in partition_paths:
+            with open(partition_path, "r") as fin:
+                shutil.copyfileobj(fin, fout)
+    return output_path
+
+
+def get_dask_client(scheduler_address=None, num_workers=None):
+    """Connect to a dask scheduler, or start a local cluster stand in.
+
+    Returns None when dask.distributed isn't installed, the local process
+    scheduler is used instead.
+    """
+    if Client is None:
+        print("dask.distributed is not installed, using the processes scheduler")
+        return None
+    if scheduler_address:
+        print(f"Connecting to dask scheduler {scheduler_address}")
+        return Client(scheduler_address)
+    # Event extraction is pure python, use one single threaded process per core
+    cluster = LocalCluster(n_workers=num_workers, threads_per_worker=1)
+    print(f"Started local dask cluster {cluster}")
+    return Client(cluster)
+
+
+def generate_patient_db_dask(
+    demographics_path,
+    meddra_extractions_dir,
+    drug_exposure_dir,
+    concept_dir,
+    output_dir,
+    debug,
+    num_partitions,
+    num_workers=None,
+    scheduler_address=None,
+    start_date=None,
+    end_date=None,
+    csv_cache_dir=None,
+    keep_partitions=False,
+):
+    """Generate a PatientDB with dask, one patient hash partition per task.
+
+    Event extraction, attaching events to visits, adding demographics and
+    dumping all run per partition on the dask workers. The partition dumps
+    are merged into a single dump at the end.
+    """
+    client = get_dask_client(scheduler_address, num_workers)
+
+    demographics = get_df(
+        demographics_path, use_dask=True, debug=debug, columns=DEMOGRAPHICS_COLUMNS
+    )
+    meddra_extractions = get_table(
+        meddra_extractions_dir,
+        prefix="all_POS_batch",
+        pattern="*_*",
+        pattern_re=".*_.*",
+        extension=".parquet",
+        use_dask=True,
+        debug=debug,
+        columns=MEDDRA_EXTRACTIONS_COLUMNS,
+        filters=get_date_range_filters("date", start_date, end_date),
+    )
+    drug_exposure = omop_drug_exposure(
+        drug_exposure_dir,
+        prefix="drug_exposure",
+        pattern="0000000000*",
+        pattern_re="0000000000.*",
+        extension=".csv",
+        use_dask=True,
+        debug=debug,
+        columns=DRUG_EXPOSURE_COLUMNS,
+        filters=get_date_range_filters(
+            "drug_exposure_start_DATE", start_date, end_date
+        ),
+        cache_dir=csv_cache_dir,
+    )
+    # The filtered CONCEPT table is small, every partition gets a copy
+    concept = omop_concept(
+        concept_dir,
+        use_dask=False,
+        debug=debug,
+        columns=CONCEPT_COLUMNS,
+        filters=[("concept_class_id", "in", sorted(ACCEPTED_DRUG_CONCEPT_CLASS_IDS))],
+        cache_dir=csv_cache_dir,
+    )
+
+    print(f"Partitioning tables into {num_partitions} patient partitions")
+    demographics = partition_by_patient(demographics, "person_id", num_partitions)
+    meddra_extractions = partition_by_patient(
+        meddra_extractions, "patid", num_partitions
+    )
+    drug_exposure = partition_by_patient(drug_exposure, "person_id", num_partitions)
+
+    partition_dir = f"{output_dir}/partitions_{time.strftime('%Y%m%d-%H%M%S')}"
+    os.makedirs(partition_dir, exist_ok=True)
+    concept = dask.delayed(concept, pure=True)
+    tasks = [
+        dask.delayed(generate_partition_patient_db)(
+            partition_i,
+            meddra_extractions_part,
+            drug_exposure_part,
+            demographics_part,
+            concept,
+            partition_dir,
+        )
+        for partition_i, (
+            meddra_extractions_part,
+            drug_exposure_part,
+            demographics_part,
+        ) in enumerate(
+            zip(
+                meddra_extractions.to_delayed(),
+                drug_exposure.to_delayed(),
+                demographics.to_delayed(),
+            )
+        )
+    ]
+
+    print(f"Generating {len(tasks)} partition PatientDBs", flush=True)
+    try:
+        if client is not None:
+            results = dask.compute(*tasks)
+        else:
+            results = dask.compute(
+                *tasks, scheduler="processes", num_workers=num_workers
+            )
+    finally:
+        if client is not None:
+            client.close()
+
+    c = Counter()
+    partition_paths = []
+    for stats, partition_path in results:
+        c["num_partitions"] += 1
+        if not partition_path:
+            c["empty_partitions"] += 1
+            continue
+        partition_paths.append(partition_path)
+        c["num_patients"] += stats["num_patients"]
+        c["num_visits"] += stats["num_visits"]
+        c["num_events"] += stats["num_events"]
+    print(f"{c}", flush=True)
+
+    if not partition_paths:
+        print("Empty events dict in all partitions! Exiting...", flush=True)
+        return None
+
+    output_path = merge_partition_dumps(partition_paths, output_dir)
+    if not keep_partitions:
+        shutil.rmtree(partition_dir)
+    return output_path
@@ -1,207 +1,508 @@
 import json
 import os
 import sys
-from collections import Counter
+from collections import Counter, deque
+from contextlib import ExitStack
+from itertools import product
+from multiprocessing import Pool
 from pathlib import Path
 from datetime import datetime
-from dateutil import rrule
 
+from count_cube import MAX_DAY, MIN_DAY, EntityCountCube
+from patient_attributes import PatientAttributeIndex
+from progress import Progress
 
-def get_patient_visit_id(patient):
-    graph_id = patient["graph_id"]
-    tokens = graph_id.split("_")
-    patient_id = tokens[0]
-    visit_id = tokens[1]
-    return patient_id, visit_id
+# Bytes buffered by the output writer
+WRITE_BUFFER_SIZE = 1 << 20
 
 
-def patient_length_of_stay(patient):
-    outcome = patient["outcome"]
-    length_of_stay = outcome["length_of_stay"]
-
-    return length_of_stay
-
+def load_json(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    return data
 
-def create_length_of_stay_map(patient_kg):
-    length_of_stay_map = dict()
-    unique_length_of_stay_values = set()
-    for patient in patient_kg:
-        patient_id, visit_id = get_patient_visit_id(patient)
-        length_of_stay_map[patient_id] = patient_length_of_stay(patient)
-        unique_length_of_stay_values.add(length_of_stay_map[patient_id])
-    return length_of_stay_map, unique_length_of_stay_values
 
+def patient_in_cohort(
+    patient_id, cohort, gender_map, length_of_stay_map, race_map, survivor_map
+):
+    """Check if a patient matches the cohort's gender/LOS/race/survivor filters."""
+    gender = gender_map.get(patient_id)
+    if cohort["check_gender"] and cohort["gender_of_patients"] != gender:
+        return False  # skip patients that don't have the gender we are counting
+
+    length_of_stay = length_of_stay_map.get(patient_id)
+    if (
+        cohort["check_length_of_stay"]
+        and cohort["length_of_stay_of_patients"] != length_of_stay
+    ):
+        return False  # skip patients that don't have the length of stay we are counting
 
-def patient_gender(patient):
-    attr = patient["attr"]
-    gender = attr["gender"]
-    return gender
+    race = race_map.get(patient_id)
+    if cohort["check_race"] and race not in cohort["races_of_patients"]:
+        return False  # skip patients that don't have the race we are counting
 
+    survivor = survivor_map.get(patient_id)
+    if (
+        cohort["check_survivor_outcome"]
+        and cohort["survivor_class_of_patients"] != survivor
+    ):
+        return False  # skip patients that are in a different class than we are counting
+    return True
+
+
+def new_ingest_counters():
+    counters = dict()
+    counters["c"] = Counter()
+    counters["d"] = Counter()
+    # Counter to see if we have any duplicate patient entries, We DO have multiple entires per patient
+    counters["p"] = Counter()
+    counters["non_empty_section_headers"] = Counter()
+    counters["counter_num_visits"] = Counter()
+    # Entity counts per (YYYY-MM-DD, entity), folded into an EntityCountCube
+    counters["entity_day_counts"] = Counter()
+    return counters
+
+
+def merge_ingest_counters(counters, chunk_counters):
+    for key, counter in chunk_counters.items():
+        counters[key].update(counter)
+
+
+def process_patient(patient, state, counters):
+    """Filter and scrub a cohort patient, returns None if the patient is dropped."""
+    c = counters["c"]
+    d = counters["d"]
+    p = counters["p"]
+    non_empty_section_headers = counters["non_empty_section_headers"]
+    counter_num_visits = counters["counter_num_visits"]
+    entity_day_counts = counters["entity_day_counts"]
+    use_first_section = state["use_first_section"]
+    use_first_visit = state["use_first_visit"]
+    drop_text = state["drop_text"]
+
+    # Drop patient ID since it has PHI in it
+    if drop_text:
+        #patient_id = -9999
+        patient_id = patient["patient_id"]
+    else:
+        patient_id = patient["patient_id"]
+
+    # Count to see if we have duplicate patients
+    p[patient_id] += 1
+
+    c["total_patients"] += 1
+    visits = patient["visits"]
+    num_visits = len(visits)
+    counter_num_visits[str(num_visits)] += 1
+    # Skip patients with no visits
+    if num_visits < 1:
+        return None
+    non_empty_visits = []
+    # Iterate over a patient's visits
+    for visit_i, visit in enumerate(visits):
+        c["total_visits"] += 1
+        # Only use the first visit
+        if use_first_visit and visit_i != 0:
+            continue
+
+        timestamp = visit["timestamp"]
+        month_key = timestamp[0:7]
+        day_key = timestamp[0:10]
+        year_key = timestamp[0:4]
+
+        # REMOVE temporarily only process 2020 records
+        #if year_key != "2020":
+        #    continue
+
+        d[month_key] += 1
+
+        # Remote note_ids if we are dropping PHI
+        if drop_text:
+            visit["note_id"] = "-9999"
+            #visit["timestamp"] = str(datetime.now())
+            pass
+
+        # Skip empty section data
+        non_empty_section_data = []
+        for section_i, section in enumerate(visit["section_data"]):
+            c["total_sections"] += 1
+            # Only use the first section
+            if use_first_section and section_i != 0:
+                continue
 
-def create_gender_map(patient_kg):
-    gender_map = dict()
-    unique_gender_values = set()
-    for patient in patient_kg:
-        patient_id, visit_id = get_patient_visit_id(patient)
-        gender_map[patient_id] = patient_gender(patient)
-        unique_gender_values.add(gender_map[patient_id])
-    return gender_map, unique_gender_values
+            risk_factor_entity_results = section.get("risk_factor_entity")
+            snomed_entity_results = section.get("snomed_entity")
 
+            if not risk_factor_entity_results and not snomed_entity_results:
+                c["empty_sections"] += 1
+                continue
 
-def patient_is_survivor(patient):
-    outcome = patient["outcome"]
-    survivor = outcome["survivor"]
-    return survivor
+            if risk_factor_entity_results:
+                risk_factor_entities = [x["entity"] for x in risk_factor_entity_results]
+                for entity in risk_factor_entities:
+                    entity_day_counts[(day_key, entity)] += 1
+            # entity_extraction_results = section['entity_extraction_results']
 
+            # Drop 'text' from entity_extraction_results items
+            if drop_text:
+                # for entity_extraction_dresult in entity_extraction_results:
+                #    entity_extraction_result['text'] = 'REMOVED'
+                if risk_factor_entity_results:
+                    for result in risk_factor_entity_results:
+                        if result.get("text"):
+                            result["text"] = "REMOVED"
+                if snomed_entity_results:
+                    for result in snomed_entity_results:
+                        if result.get("text"):
+                            result["text"] = "REMOVED"
+
+            non_empty_section_headers[section["section_header"]] += 1
+            c["non_empty_sections"] += 1
+
+            # Drop 'section_test'
+            if drop_text:
+                if section.get("section_text"):
+                    section["section_text"] = "REMOVED"
+            non_empty_section_data.append(section)
+        # replace section data with non empty section data
+        if not non_empty_section_data:
+            c["empty_visits"] += 1
+            continue
+        c["non_empty_visits"] += 1
+        visit["section_data"] = non_empty_section_data
+        non_empty_visits.append(visit)
+
+    if not non_empty_visits:
+        c["empty_patients"] += 1
+        return None
+    c["non_empty_patients"] += 1
+    patient["visits"] = non_empty_visits
+    patient["patient_id"] = str(patient_id)
+    return patient
+
+
+# State shared by all lines, set once per worker process by init_worker()
+worker_state = dict()
+
+
+def init_worker(state):
+    worker_state.update(state)
+
+
+def process_line_chunk(line_chunk, state=None):
+    """Parse, filter and scrub a chunk of lines for every cohort.
+
+    Returns an (output lines, counters) tuple per cohort in state["cohorts"],
+    output lines are in input order.
+    """
+    if state is None:
+        state = worker_state
+    cohorts = state["cohorts"]
+    start_line_num, lines = line_chunk
+    cohort_results = [([], new_ingest_counters()) for _ in cohorts]
+    for line_num, line in enumerate(lines, start_line_num):
+        try:
+            patient = json.loads(line)
+        except json.JSONDecodeError:
+            for _, counters in cohort_results:
+                counters["c"]["JSONDecodeError"] += 1
+            print(f"line_num: {line_num} failed due to JSONDecodeError")
+            continue
+
+        cohort_ids = [
+            cohort_i
+            for cohort_i, cohort in enumerate(cohorts)
+            if patient_in_cohort(
+                patient["patient_id"],
+                cohort,
+                state["gender_map"],
+                state["length_of_stay_map"],
+                state["race_map"],
+                state["survivor_map"],
+            )
+        ]
+        if not cohort_ids:
+            continue
+
+        # Scrubbing doesn't depend on the cohort, process the patient once
+        # and add its counts to every cohort it belongs to
+        if len(cohort_ids) == 1:
+            patient_counters = cohort_results[cohort_ids[0]][1]
+        else:
+            patient_counters = new_ingest_counters()
+        patient = process_patient(patient, state, patient_counters)
+        if len(cohort_ids) > 1:
+            for cohort_i in cohort_ids:
+                merge_ingest_counters(cohort_results[cohort_i][1], patient_counters)
+        if patient is None:
+            continue
+
+        out_line = f"{json.dumps(patient)}\n"
+        for cohort_i in cohort_ids:
+            out_lines, counters = cohort_results[cohort_i]
+            out_lines.append(out_line)
+            counters["c"]["dumped_patients"] += 1
+    return cohort_results
+
+
+def read_line_chunks(fin, chunk_size):
+    """Yield (line_num, lines) chunks of at most chunk_size lines."""
+    lines = []
+    start_line_num = 0
+    for line in fin:
+        lines.append(line)
+        if len(lines) >= chunk_size:
+            yield start_line_num, lines
+            start_line_num += len(lines)
+            lines = []
+    if lines:
+        yield start_line_num, lines
+
+
+def process_line_chunks(line_chunks, state, num_workers):
+    """Yield the lines and processed results of chunks in input order.
+
+    With more than one worker, chunks are processed by a process pool with at
+    most a few chunks per worker in flight so memory stays bounded.
+    """
+    if num_workers <= 1:
+        for line_chunk in line_chunks:
+            yield line_chunk[1], process_line_chunk(line_chunk, state)
+        return
+
+    max_pending = 4 * num_workers
+    with Pool(num_workers, initializer=init_worker, initargs=(state,)) as pool:
+        pending = deque()
+        for line_chunk in line_chunks:
+            result = pool.apply_async(process_line_chunk, (line_chunk,))
+            pending.append((line_chunk[1], result))
+            if len(pending) >= max_pending:
+                lines, result = pending.popleft()
+                yield lines, result.get()
+        while pending:
+            lines, result = pending.popleft()
+            yield lines, result.get()
+
+
+def create_cohort(
+    check_gender=False,
+    gender_of_patients=None,
+    check_length_of_stay=False,
+    length_of_stay_of_patients=None,
+    check_race=False,
+    races_of_patients=None,
+    check_survivor_outcome=False,
+    survivor_class_of_patients=None,
+):
+    cohort = dict()
+    cohort["check_gender"] = check_gender
+    cohort["gender_of_patients"] = gender_of_patients
+    cohort["check_length_of_stay"] = check_length_of_stay
+    cohort["length_of_stay_of_patients"] = length_of_stay_of_patients
+    cohort["check_race"] = check_race
+    cohort["races_of_patients"] = races_of_patients
+    cohort["check_survivor_outcome"] = check_survivor_outcome
+    cohort["survivor_class_of_patients"] = survivor_class_of_patients
+    return cohort
+
+
+def create_cohorts(genders, lengths_of_stay, race_groups, survivor_classes):
+    """Create a cohort for every gender x LOS x race x survivor combination.
+
+    A None value in a list is a cohort that isn't filtered on that attribute.
+    """
+    cohorts = []
+    for gender, length_of_stay, races, survivor_class in product(
+        genders, lengths_of_stay, race_groups, survivor_classes
+    ):
+        cohort = create_cohort(
+            check_gender=gender is not None,
+            gender_of_patients=gender,
+            check_length_of_stay=length_of_stay is not None,
+            length_of_stay_of_patients=length_of_stay,
+            check_race=races is not None,
+            races_of_patients=races,
+            check_survivor_outcome=survivor_class is not None,
+            survivor_class_of_patients=survivor_class,
+        )
+        cohorts.append(cohort)
+    return cohorts
+
+
+def get_cohort_unique_path(cohort, class_of_patients):
+    if cohort["check_survivor_outcome"]:
+        survivor_str = (
+            "survivor_" if cohort["survivor_class_of_patients"] else "non-survivor_"
+        )
+    else:
+        survivor_str = ""
 
-def create_survivor_map(patient_kg):
-    survivor_map = dict()
-    unique_survivor_values = set()
-    for patient in patient_kg:
-        patient_id, _ = get_patient_visit_id(patient)
-        survivor_map[patient_id] = patient_is_survivor(patient)
-        unique_survivor_values.add(survivor_map[patient_id])
+    if cohort["check_length_of_stay"]:
+        length_of_stay_str = f"{cohort['length_of_stay_of_patients']}_"
+    else:
+        length_of_stay_str = ""
 
-    return survivor_map, unique_survivor_values
+    if cohort["check_gender"]:
+        gender_str = f"{cohort['gender_of_patients']}_"
+    else:
+        gender_str = ""
 
+    if cohort["check_race"]:
+        #race_of_patients_formatted = race_of_patients.lower()
+        #race_of_patients_formatted = race_of_patients_formatted.replace(' ', '_')
+        #race_str = f"{race_of_patients_formatted}_"
+        if len(cohort["races_of_patients"]) > 1:
+            race_str = "non-whites_"
+        else:
+            race_str = "whites_"
+    else:
+        race_str = ""
 
-def patient_race(patient):
-    attr = patient["attr"]
-    race = attr['race']
-    return race
+    unique_path = (
+        f"{gender_str}{length_of_stay_str}{race_str}{survivor_str}{class_of_patients}"
+    )
+    return unique_path
 
 
-def create_race_map(patient_kg):
-    race_map = dict()
-    unique_races = set()
-    for patient in patient_kg:
-        patient_id, _ = get_patient_visit_id(patient)
-        race_map[patient_id] = patient_race(patient)
-        unique_races.add(race_map[patient_id])
-    return race_map, unique_races
+def ingest_cohorts(
+    input_path,
+    output_paths,
+    cohorts,
+    state,
+    num_workers=1,
+    chunk_size=1000,
+    min_day=MIN_DAY,
+    max_day=MAX_DAY,
+):
+    """Filter, scrub and count the input for many cohorts in a single pass.
+
+    Each cohort's patients are written to its output path, in input order.
+    Returns the counters of each cohort, with its entity counts between
+    min_day and max_day in an EntityCountCube under "entity_counts".
+    """
+    state = dict(state)
+    state["cohorts"] = cohorts
+    cohort_counters = [new_ingest_counters() for _ in cohorts]
+    for counters in cohort_counters:
+        # Chunk counts are folded into the cube, don't keep them around
+        del counters["entity_day_counts"]
+        counters["entity_counts"] = EntityCountCube(min_day, max_day)
+
+    # Updated once per chunk, and the pool forks during the loop: no thread
+    progress = Progress(
+        "ingest_jsonl",
+        total_bytes=os.path.getsize(input_path),
+        counters=cohort_counters[0]["c"],
+        threaded=False,
+        unit="lines",
+    )
+    # One buffered writer per cohort, overwrites any previous output files
+    with open(input_path, "r") as fin, ExitStack() as stack, progress:
+        fouts = [
+            stack.enter_context(open(output_path, "w", buffering=WRITE_BUFFER_SIZE))
+            for output_path in output_paths
+        ]
+        line_chunks = read_line_chunks(fin, chunk_size)
+        for lines, cohort_results in process_line_chunks(
+            line_chunks, state, num_workers
+        ):
+            for fout, counters, (out_lines, chunk_counters) in zip(
+                fouts, cohort_counters, cohort_results
+            ):
+                fout.writelines(out_lines)
+                entity_day_counts = chunk_counters.pop("entity_day_counts")
+                counters["entity_counts"].add_counts(entity_day_counts)
+                merge_ingest_counters(counters, chunk_counters)
+            # Characters, the same as bytes for ASCII input
+            progress.update(len(lines), sum(map(len, lines)))
+
+    print(
+        f"Processed {progress.num_items} lines for {len(cohorts)} cohorts", flush=True
+    )
+    return cohort_counters
 
 
-def load_json(path):
-    with open(path, "r") as f:
-        data = json.load(f)
-    return data
+def create_ingest_state(
+    gender_map,
+    length_of_stay_map,
+    race_map,
+    survivor_map,
+    use_first_section,
+    use_first_visit,
+    drop_text,
+):
+    state = dict()
+    state["gender_map"] = gender_map
+    state["length_of_stay_map"] = length_of_stay_map
+    state["race_map"] = race_map
+    state["survivor_map"] = survivor_map
+    state["use_first_section"] = use_first_section
+    state["use_first_visit"] = use_first_visit
+    state["drop_text"] = drop_text
+    return state
+
+
+def main_cohorts(
+    input_path,
+    output_dir,
+    output_prefix,
+    class_of_patients,
+    cohorts,
+    gender_map,
+    length_of_stay_map,
+    race_map,
+    survivor_map,
+    use_first_section,
+    use_first_visit,
+    drop_text,
+    num_workers=1,
+    chunk_size=1000,
+    resolutions=("month",),
+    start_date=None,
+    end_date=None,
+):
+    """Run main() for many cohorts with a single pass over the input.
+
+    Writes {output_prefix}_<cohort>.jsonl and a <resolution>s_<cohort>.csv
+    of entity counts between start_date and end_date for each resolution and
+    cohort to output_dir.
+    """
+    unique_paths = [
+        get_cohort_unique_path(cohort, class_of_patients) for cohort in cohorts
+    ]
+    if len(set(unique_paths)) != len(unique_paths):
+        raise ValueError(f"Cohorts must have unique names, got: {unique_paths}")
+    output_paths = [
+        f"{output_dir}/{output_prefix}_{unique_path}.jsonl"
+        for unique_path in unique_paths
+    ]
+    for cohort_path in output_paths:
+        print(f"\tcohort output_path: {cohort_path}")
 
+    state = create_ingest_state(
+        gender_map,
+        length_of_stay_map,
+        race_map,
+        survivor_map,
+        use_first_section,
+        use_first_visit,
+        drop_text,
+    )
+    cohort_counters = ingest_cohorts(
+        input_path, output_paths, cohorts, state, num_workers, chunk_size
+    )
 
-def dump_patient(patient, path):
-    with open(path, "a+") as fout:
-        patient_str = json.dumps(patient)
-        fout.write(f"{patient_str}\n")
-
-
-def dump_frequencies_quarters(path, quarter_counts, quarters, words):
-    print("Dumping frequencies for quarter counts")
-    with open(path, "w") as f:
-        header = "territory,quarter,profit\n"
-        f.write(header)
-
-        for word in sorted(words):
-            for quarter in quarters:
-                count = quarter_counts[quarter][word]
-                freq_line = f"{word},{quarter},{count}\n"
-                f.write(freq_line)
-
-
-def translate_month_name(month):
-    if month == "2020-01":
-        month_translation = "January 2020"
-    if month == "2020-02":
-        month_translation = "February 2020"
-    if month == "2020-03":
-        month_translation = "March 2020"
-    if month == "2020-04":
-        month_translation = "April 2020"
-    if month == "2020-05":
-        month_translation = "May 2020"
-    if month == "2020-06":
-        month_translation = "June 2020"
-    if month == "2020-07":
-        month_translation = "July 2020"
-    if month == "2020-08":
-        month_translation = "August 2020"
-    if month == "2020-09":
-        month_translation = "September 2020"
-    if month == "2020-10":
-        month_translation = "October 2020"
-    if month == "2020-11":
-        month_translation = "November 2020"
-    if month == "2020-12":
-        month_translation = "December 2020"
-    return month_translation
-
-
-def translate_month(month):
-    if month == "2020-01":
-        month_translation = "Q1 2020"
-    if month == "2020-02":
-        month_translation = "Q2 2020"
-    if month == "2020-03":
-        month_translation = "Q3 2020"
-    if month == "2020-04":
-        month_translation = "Q4 2020"
-    if month == "2020-05":
-        month_translation = "Q5 2020"
-    if month == "2020-06":
-        month_translation = "Q6 2020"
-    if month == "2020-07":
-        month_translation = "Q7 2020"
-    if month == "2020-08":
-        month_translation = "Q8 2020"
-    if month == "2020-09":
-        month_translation = "Q9 2020"
-    if month == "2020-10":
-        month_translation = "Q10 2020"
-    if month == "2020-11":
-        month_translation = "Q11 2020"
-    if month == "2020-12":
-        month_translation = "Q12 2020"
-    return month_translation
-
-
-def dump_frequencies_months(path, month_counts, months, words):
-    print(f"Dumping frequencies for month counts to {path}")
-    with open(path, "w") as f:
-        header = "territory,quarter,profit\n"
-        f.write(header)
-
-        for word in sorted(words):
-            for month in months:
-                count = month_counts[month][word]
-                #month_translation = translate_month(month)
-                # FIXME
-                month_translation = translate_month_name(month)
-                freq_line = f"{word},{month_translation},{count}\n"
-                f.write(freq_line)
-
-
-def aggregate_quarter_counts(month_counts):
-    quarter_counts = dict()
-    quarter_counts["Q1 2020"] = Counter()
-    quarter_counts["Q2 2020"] = Counter()
-    quarter_counts["Q3 2020"] = Counter()
-    quarter_counts["Q4 2020"] = Counter()
-
-    for month_key, month_count in month_counts.items():
-        if month_key[5:6] == "0":
-            month = int(month_key[6:7])
-        else:
-            month = int(month_key[5:7])
-
-        if month > 0 and month < 4:
-            quarter = "Q1 2020"
-        elif month > 4 and month < 7:
-            quarter = "Q2 2020"
-        elif month > 7 and month < 10:
-            quarter = "Q3 2020"
-        else:
-            quarter = "Q4 2020"
-        for word, word_count in month_count.items():
-            quarter_counts[quarter][word] += word_count
-    return quarter_counts
+    for unique_path, counters in zip(unique_paths, cohort_counters):
+        print(f"cohort: {unique_path}")
+        print(counters["c"], flush=True)
+        print(counters["d"], flush=True)
+        print(counters["entity_counts"], flush=True)
+        for resolution in resolutions:
+            frequencies_path = f"{output_dir}/{resolution}s_{unique_path}.csv"
+            counters["entity_counts"].dump_frequencies(
+                frequencies_path, resolution, start_date, end_date
+            )
+    return cohort_counters
 
 
 def main(
@@ -224,252 +525,37 @@ def main(
     use_first_section,
     use_first_visit,
     drop_text,
+    num_workers=1,
+    chunk_size=1000,
 ):
-    # Remove output file
-    try:
-        os.remove(output_path)
-    except OSError:
-        print(f"Can't delete {output_path} as it does not exist")
-
-    # We are only counting for the months of 2020 at the moment
-    start_visit_date = datetime(2020, 1, 1)
-    end_visit_date = datetime(2020, 12, 31)
-    visit_dates = []
-    month_counts = dict()
-    month_keys = []
-    for visit_date in rrule.rrule(
-        rrule.MONTHLY, dtstart=start_visit_date, until=end_visit_date
-    ):
-        month_key = visit_date.strftime("%Y-%m")
-        month_keys.append(month_key)
-        month_counts[month_key] = Counter()
-        visit_dates.append(visit_date)
-
-    c = Counter()
-    d = Counter()
-    p = (
-        Counter()
-    )  # Counter to see if we have any duplicate patient entries, We DO have multiple entires per patient
-    non_empty_section_headers = Counter()
-    counter_num_visits = Counter()
-    line_num = -1
-    with open(input_path, "r") as fin:
-        for line in fin:
-            line_num += 1
-            if line_num % 500 == 0:
-                print(f"Processing line no: {line_num}", flush=True)
-            try:
-                patient = json.loads(line)
-            except json.JSONDecodeError:
-                c["JSONDecodeError"] += 1
-                print(f"line_num: {line_num} failed due to JSONDecodeError")
-                continue
-
-            # import pdb;pdb.set_trace()
-
-            # Drop patient ID since it has PHI in it
-            if drop_text:
-                #patient_id = -9999
-                patient_id = patient["patient_id"]
-            else:
-                patient_id = patient["patient_id"]
-
-            gender = gender_map.get(patient_id)
-            if check_gender and gender_of_patients != gender:
-                continue  # skip patients that don't have the gender we are counting
-
-            length_of_stay = length_of_stay_map.get(patient_id)
-            if check_length_of_stay and length_of_stay_of_patients != length_of_stay:
-                continue  # skip patients that don't have the length of stay we are counting
-
-            race = race_map.get(patient_id)
-            if check_race and race not in races_of_patients:
-                continue  # skip patients that don't have the race we are counting
-
-            survivor = survivor_map.get(patient_id)
-            if check_survivor_outcome and survivor_class_of_patients != survivor:
-                continue  # skip patients that are in a different class than we are counting
-
-
-            # Count to see if we have duplicate patients
-            p[patient_id] += 1
-
-            c["total_patients"] += 1
-            visits = patient["visits"]
-            num_visits = len(visits)
-            counter_num_visits[str(num_visits)] += 1
-            # Skip patients with no visits
-            if num_visits < 1:
-                continue
-            non_empty_visits = []
-            # Iterate over a patient's visits
-            for visit_i, visit in enumerate(visits):
-                c["total_visits"] += 1
-                # Only use the first visit
-                if use_first_visit and visit_i != 0:
-                    continue
-
-                timestamp = visit["timestamp"]
-                month_key = timestamp[0:7]
-                year_key = timestamp[0:4]
-                test_var = "remove"
-
-                # REMOVE temporarily only process 2020 records
-                #if year_key != "2020":
-                #    continue
-
-                d[month_key] += 1
-
-                # Remote note_ids if we are dropping PHI
-                if drop_text:
-                    visit["note_id"] = "-9999"
-                    #visit["timestamp"] = str(datetime.now())
-                    pass
-
-                # Skip empty section data
-                non_empty_section_data = []
-                for section_i, section in enumerate(visit["section_data"]):
-                    c["total_sections"] += 1
-                    # Only use the first section
-                    if use_first_section and section_i != 0:
-                        continue
-
-                    risk_factor_entity_results = section.get("risk_factor_entity")
-                    snomed_entity_results = section.get("snomed_entity")
-
-                    if not risk_factor_entity_results and not snomed_entity_results:
-                        c["empty_sections"] += 1
-                        continue
-
-                    test_var = "remove"
-
-                    if risk_factor_entity_results:
-                        risk_factor_entities = [
-                            x["entity"] for x in risk_factor_entity_results
-                        ]
-                        if len(risk_factor_entities) > 1:
-                            test_var = "remove"
-                        for entity in risk_factor_entities:
-                            try:
-                                month_counts[month_key][entity] += 1
-                            except KeyError:
-                                pass
-
-                        test_var = "remove"
-                    # entity_extraction_results = section['entity_extraction_results']
-
-                    # Drop 'text' from entity_extraction_results items
-                    if drop_text:
-                        # for entity_extraction_dresult in entity_extraction_results:
-                        #    entity_extraction_result['text'] = 'REMOVED'
-                        if risk_factor_entity_results:
-                            for result in risk_factor_entity_results:
-                                if result.get("text"):
-                                    result["text"] = "REMOVED"
-                        if snomed_entity_results:
-                            for result in snomed_entity_results:
-                                if result.get("text"):
-                                    result["text"] = "REMOVED"
-
-                    non_empty_section_headers[section["section_header"]] += 1
-                    c["non_empty_sections"] += 1
-
-                    # Drop 'section_test'
-                    if drop_text:
-                        if section.get("section_text"):
-                            section["section_text"] = "REMOVED"
-                    non_empty_section_data.append(section)
-                # replace section data with non empty section data
-                if not non_empty_section_data:
-                    c["empty_visits"] += 1
-                    continue
-                c["non_empty_visits"] += 1
-                visit["section_data"] = non_empty_section_data
-                non_empty_visits.append(visit)
-
-            if not non_empty_visits:
-                c["empty_patients"] += 1
-                continue
-            c["non_empty_patients"] += 1
-            patient["visits"] = non_empty_visits
-            patient["patient_id"] = str(patient_id)
-
-            dump_patient(patient, output_path)
-            c["dumped_patients"] += 1
+    cohort = create_cohort(
+        check_gender,
+        gender_of_patients,
+        check_length_of_stay,
+        length_of_stay_of_patients,
+        check_race,
+        races_of_patients,
+        check_survivor_outcome,
+        survivor_class_of_patients,
+    )
+    state = create_ingest_state(
+        gender_map,
+        length_of_stay_map,
+        race_map,
+        survivor_map,
+        use_first_section,
+        use_first_visit,
+        drop_text,
+    )
+    counters = ingest_cohorts(
+        input_path, [output_path], [cohort], state, num_workers, chunk_size
+    )[0]
+    c = counters["c"]
+    d = counters["d"]
+    entity_counts = counters["entity_counts"]
     print(c, flush=True)
     print(d, flush=True)
-    print()
-
-    if check_survivor_outcome:
-        survivor_str = "survivor_" if survivor_class_of_patients else "non-survivor_"
-    else:
-        survivor_str = ""
-
-    if check_length_of_stay:
-        length_of_stay_str = f"{length_of_stay_of_patients}_"
-    else:
-        length_of_stay_str = ""
-
-    if check_gender:
-        gender_str = f"{gender_of_patients}_"
-    else:
-        gender_str = ""
-
-    if check_race:
-        #race_of_patients_formatted = race_of_patients.lower()
-        #race_of_patients_formatted = race_of_patients_formatted.replace(' ', '_')
-        #race_str = f"{race_of_patients_formatted}_"
-        if len(races_of_patients) > 1:
-            race_str = "non-whites_"
-        else:
-            race_str = "whites_"
-    else:
-        race_str = ""
-
-    unique_path = f"{gender_str}{length_of_stay_str}{race_str}{survivor_str}{class_of_patients}"
-
-
-    frequencies_months_path = f"{output_dir}/months_{unique_path}.csv"
-    months_unique_words = set()
-
-    for month, month_count in month_counts.items():
-        for word, word_count in month_count.items():
-            months_unique_words.add(word)
-
-    quarter_counts = aggregate_quarter_counts(month_counts)
-
-    # Dump month counts to file
-    # frequencies = []
-
-    frequencies_quarters_path = f"{output_dir}/quarters_{unique_path}.csv"
-    quarters_unique_words = set()
-
-    for quarter, quarter_count in quarter_counts.items():
-        for word, word_count in quarter_count.items():
-            quarters_unique_words.add(word)
-    #        item = (word, quarter, word_count)
-    #        frequencies.append(item)
-
-    quarters = ["Q1 2020", "Q2 2020", "Q3 2020", "Q4 2020"]
-
-    # We are not including Jan, February, October, November, December because the data seems empty
-    months = [
-        "2020-02",
-        "2020-03",
-        "2020-04",
-        "2020-05",
-        "2020-06",
-        "2020-07",
-        "2020-08",
-        "2020-09",
-    ]
-
-    #dump_frequencies_months(
-    #    frequencies_months_path, month_counts, months, months_unique_words
-    #)
-    #dump_frequencies_quarters(
-    #    frequencies_quarters_path, quarter_counts, quarters, quarters_unique_words
-    #)
+    print(entity_counts, flush=True)
     print()
 
 
@@ -563,27 +649,70 @@ if __name__ == "__main__":
     
     patient_kg_path = f"{slack_dir}/patient_kg.json"
     patient_kg_labels_path = f"{slack_dir}/patient_kg_labels.json"
+    # Saved attribute index, patient_kg.json is only loaded to create it
+    patient_attributes_path = f"{slack_dir}/patient_attributes.npz"
 
-    patient_kg = load_json(patient_kg_path)
-    patient_kg_labels = load_json(patient_kg_labels_path)
+    patient_attributes = PatientAttributeIndex.load_or_create(
+        patient_attributes_path, patient_kg_path
+    )
+    print(patient_attributes, flush=True)
 
     check_gender = False
     print(f"check_gender: {check_gender}")
-    gender_map, unique_gender_values = create_gender_map(patient_kg)
+    gender_map = patient_attributes.get_map("gender")
+    unique_gender_values = patient_attributes.get_unique_values("gender")
 
     check_length_of_stay = False
     print(f"check_length_of_stay: {check_length_of_stay}")
-    length_of_stay_map, unique_length_of_stay_values = create_length_of_stay_map(
-        patient_kg
+    length_of_stay_map = patient_attributes.get_map("length_of_stay")
+    unique_length_of_stay_values = patient_attributes.get_unique_values(
+        "length_of_stay"
     )
 
     check_survivor_outcome = False
     print(f"check_survivor_outcome: {check_survivor_outcome}")
-    survivor_map, unique_survivor_values = create_survivor_map(patient_kg)
+    survivor_map = patient_attributes.get_map("survivor")
+    unique_survivor_values = patient_attributes.get_unique_values("survivor")
 
     check_race = False
     print(f"check_race: {check_race}")
-    race_map, unique_race_values = create_race_map(patient_kg)
+    race_map = patient_attributes.get_map("race")
+    unique_race_values = patient_attributes.get_unique_values("race")
+
+    # Number of processes parsing and filtering lines
+    num_workers = os.cpu_count()
+    print(f"num_workers: {num_workers}")
+
+    # Evaluate every gender x LOS x race x survivor cohort in one pass
+    use_cohort_fan_out = False
+    print(f"use_cohort_fan_out: {use_cohort_fan_out}")
+    if use_cohort_fan_out:
+        cohorts = create_cohorts(
+            genders=[None] + sorted(unique_gender_values - {None}),
+            lengths_of_stay=[None] + sorted(unique_length_of_stay_values - {None}),
+            race_groups=[None, ["White"], races_of_patients],
+            survivor_classes=[None, True, False],
+        )
+        print(f"num_cohorts: {len(cohorts)}")
+        main_cohorts(
+            input_path,
+            output_dir,
+            f"{base_path}{output_suffix}",
+            class_of_patients,
+            cohorts,
+            gender_map,
+            length_of_stay_map,
+            race_map,
+            survivor_map,
+            use_first_section,
+            use_first_visit,
+            drop_text,
+            num_workers=num_workers,
+            resolutions=["week", "month", "quarter"],
+            start_date="2020-02-01",
+            end_date="2020-09-30",
+        )
+        sys.exit(0)
 
     main(
         input_path,
@@ -605,4 +734,5 @@ if __name__ == "__main__":
         use_first_section,
         use_first_visit,
         drop_text,
+        num_workers=num_workers,
     )
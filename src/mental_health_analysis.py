@@ -5,6 +5,10 @@ from datetime import date
 from pathlib import Path
 
 import pandas as pd
+from age_distribution import (
+    calculate_age_gender_histograms,
+    render_age_gender_histograms,
+)
 from generate import get_concept_name
 from utils import get_df
 from patient_db import (
@@ -16,6 +20,7 @@ from patient_db import (
     get_unique_match_patient_visits,
     print_top_k,
 )
+from patient_query import QueryIndex, Term
 
 
 def prepare_output_dirs(output_dir, num_questions=0, prefix=""):
@@ -26,46 +31,91 @@ def prepare_output_dirs(output_dir, num_questions=0, prefix=""):
         Path(num_q_output_dir).mkdir(parents=True, exist_ok=True)
 
 
-def run_q1(patients, search_terms, path):
+# Roles Q1 matches the search terms on, diagnosis_name or concept_text for
+# DiagnosisEvents and concept_text for MEDDRAEvents
+Q1_EVENT_TYPE_ROLES = {
+    "DiagnosisEvent": {"diagnosis_name", "concept_text"},
+    "MEDDRAEvent": {"concept_text"},
+}
+# Roles Q1 counts in the matched visits
+Q1_CNT_EVENT_TYPE_ROLES = {
+    "DiagnosisEvent": {"diagnosis_name", "concept_text"},
+    "MEDDRAEvent": {"concept_text"},
+}
+# Roles Q9 counts for the Q1 matches
+Q9_CNT_EVENT_TYPE_ROLES = {
+    # "drug_concept_id", "drug_type_concept_id"
+    "DRUG_EXPOSURE": {"drug_concept_name"},
+}
+ENTITY_LEVELS = ["patient", "visit", "event"]
+
+
+def get_q1_query(search_terms):
+    """Everything the Q1 matches and counters depend on, their cache query."""
+    return {
+        "question": "q1",
+        "terms": search_terms,
+        "event_type_roles": Q1_EVENT_TYPE_ROLES,
+        "cnt_event_type_roles": Q1_CNT_EVENT_TYPE_ROLES,
+        "entity_levels": ENTITY_LEVELS,
+    }
+
+
+def get_q9_query(search_terms):
+    """Everything the Q9 counters depend on, their cache query."""
+    return {
+        "question": "q9",
+        "matches": get_q1_query(search_terms),
+        "cnt_event_type_roles": Q9_CNT_EVENT_TYPE_ROLES,
+        "entity_levels": ENTITY_LEVELS,
+    }
+
+
+def get_cached(result_cache, db_fingerprint, query, compute):
+    """compute() memoized in result_cache, if any."""
+    if result_cache is None:
+        return compute()
+    return result_cache.get_or_compute(
+        result_cache.get_key(db_fingerprint, query), compute
+    )
+
+
+def run_q1(
+    patients,
+    search_terms,
+    path,
+    query_index=None,
+    result_cache=None,
+    db_fingerprint=None,
+):
     print("Running Q1...")
-    # Find all patients that match at least one of the search terms the roles
-    # diagnosis_name or concept_text for DiagnosisEvents and MEDDRAEvents
-
-    # Set up roles to match by event type data structure
-    event_type_roles = dict()
-    # DiagnosisEvent keys to match on
-    event_type_roles["DiagnosisEvent"] = set()
-    event_type_roles["DiagnosisEvent"].add("diagnosis_name")
-    event_type_roles["DiagnosisEvent"].add("concept_text")
-    # MEDDRAEvent keys to match on
-    event_type_roles["MEDDRAEvent"] = set()
-    event_type_roles["MEDDRAEvent"].add("concept_text")
-
-    matches = patients.match_terms(search_terms, event_type_roles)
-
-    # For all matched visits IDs iterate through and aggregate other event
-    # role counts
-    unique_patient_visits = get_unique_match_patient_visits(matches)
-
-    cnt_event_type_roles = dict()
-
-    # Set up roles to count on by event type data structure
-    cnt_event_type_roles["DiagnosisEvent"] = set()
-    # DiagnosisEvent keys to count on
-    cnt_event_type_roles["DiagnosisEvent"] = set()
-    cnt_event_type_roles["DiagnosisEvent"].add("diagnosis_name")
-    cnt_event_type_roles["DiagnosisEvent"].add("concept_text")
-    # MEDDRAEvent keys to match on
-    cnt_event_type_roles["MEDDRAEvent"] = set()
-    cnt_event_type_roles["MEDDRAEvent"].add("concept_text")
-
-    entity_levels = ["patient", "visit", "event"]
-    counters = patients.get_event_counters_from_matches(
-        matches,
-        event_type_roles,
-        cnt_event_type_roles,
-        entity_levels=entity_levels,
-        patient_visits=unique_patient_visits,
+    # Find all patients that match at least one of the search terms
+    event_type_roles = Q1_EVENT_TYPE_ROLES
+    cnt_event_type_roles = Q1_CNT_EVENT_TYPE_ROLES
+    entity_levels = ENTITY_LEVELS
+
+    def count_matches():
+        nonlocal query_index
+        if query_index is None:
+            query_index = QueryIndex.from_patient_db(patients)
+        matches = query_index.get_matches(
+            Term(search_terms, event_type_roles, exact=True)
+        )
+
+        # For all matched visits IDs iterate through and aggregate other event
+        # role counts
+        unique_patient_visits = get_unique_match_patient_visits(matches)
+        counters = patients.get_event_counters_from_matches(
+            matches,
+            event_type_roles,
+            cnt_event_type_roles,
+            entity_levels=entity_levels,
+            patient_visits=unique_patient_visits,
+        )
+        return matches, counters
+
+    matches, counters = get_cached(
+        result_cache, db_fingerprint, get_q1_query(search_terms), count_matches
     )
 
     # Aggregate counts for each such diagnosis code either based on
@@ -106,21 +156,32 @@ def run_q8():
     print("Running Q8...")
 
 
-def run_q9(patients, matches, event_type_roles, concepts, path):
+def run_q9(
+    patients,
+    matches,
+    event_type_roles,
+    concepts,
+    path,
+    result_cache=None,
+    db_fingerprint=None,
+    search_terms=None,
+):
+    """Q9 of the Q1 matches, cached when given the Q1 search_terms."""
     print("Running Q9...")
-    cnt_event_type_roles = dict()
-
-    # Set up roles to count on by event type data structure
-    cnt_event_type_roles["DRUG_EXPOSURE"] = set()
-    # cnt_event_type_roles['DRUG_EXPOSURE'].add('drug_concept_id')
-    # cnt_event_type_roles['DRUG_EXPOSURE'].add('drug_type_concept_id')
-    cnt_event_type_roles["DRUG_EXPOSURE"].add("drug_concept_name")
-
-    entity_levels = ["patient", "visit", "event"]
-    # entity_levels = ['patient']
-    counters = patients.get_event_counters_from_matches(
-        matches, event_type_roles, cnt_event_type_roles, entity_levels=entity_levels
-    )
+    cnt_event_type_roles = Q9_CNT_EVENT_TYPE_ROLES
+    entity_levels = ENTITY_LEVELS
+
+    def count_drugs():
+        return patients.get_event_counters_from_matches(
+            matches, event_type_roles, cnt_event_type_roles, entity_levels=entity_levels
+        )
+
+    if search_terms is None:
+        counters = count_drugs()
+    else:
+        counters = get_cached(
+            result_cache, db_fingerprint, get_q9_query(search_terms), count_drugs
+        )
 
     # Aggregate counts for each such diagnosis code either based on
     # the number of visits or number of patients
@@ -132,9 +193,6 @@ def run_q9(patients, matches, event_type_roles, concepts, path):
         top_k, cnt_event_type_roles, description=f"Top {k} DRUG_EXPOSURE roles per"
     )
     dump_dict(path, top_k)
-    import pdb
-
-    pdb.set_trace()
     return top_k, cnt_event_type_roles
 
 
@@ -146,47 +204,26 @@ def test_split_by_month(patients):
         print(f"{month_db}")
 
 
-# FIXME broken
-def mental_health_age_distribution(patients, search_terms, output_dir):
-    all_patients_dist_path = f"{output_dir}/all_patients_dist.png"
-    matched_patients_dist_path = f"{output_dir}/matched_patients_dist.png"
-
+def mental_health_age_distribution(
+    patients, search_terms, output_dir, num_workers=1, query_index=None
+):
     # Match patients based on search terms
-    matched_patients, matches = patients.match_terms(
-        search_terms,
-        ["diagnosis_name", "concept_text"],
-        ["DiagnosisEvent", "MEDDRAEvent"],
-    )
+    event_type_roles = Q1_EVENT_TYPE_ROLES
+    if query_index is None:
+        query_index = QueryIndex.from_patient_db(patients)
+    cohorts = {
+        "all_patients": None,
+        "matched_patients": query_index.select_patient_ids(
+            Term(search_terms, event_type_roles, exact=True)
+        ),
+    }
 
     # Set compare date for age calculation to today
     compare_date = date.today()
 
-    # Calulate age/gender distribution from input patients DB
-    min_age, max_age = patients.calculate_patient_ages(compare_date)
-    patients.calculate_age_gender_distribution(
-        min_age, max_age, patients.get_unique_genders(), all_patients_dist_path
+    # Histograms of both cohorts and each of their monthly splits, rendered
+    # after all of them are counted
+    age_gender_histograms = calculate_age_gender_histograms(
+        patients, cohorts, compare_date
     )
-    print(f"input patients: min_age: {min_age}, max_age: {max_age}")
-
-    # Calculate age/gender distribution from matched patients DB
-    min_age, max_age = matched_patients.calculate_patient_ages(compare_date)
-    matched_patients.calculate_age_gender_distribution(
-        min_age,
-        max_age,
-        matched_patients.get_unique_genders(),
-        matched_patients_dist_path,
-    )
-    print(f"matched patients: min_age: {min_age}, max_age: {max_age}")
-    # import pdb
-    # pdb.set_trace()
-    print()
-
-    # Calculate age/gener distribution for each monthly split
-    monthly_splits = patients.agg_time("M")
-    for key, month_split in monthly_splits.items():
-        month_split_dist_path = f"{output_dir}/{key}_dist.png"
-        print(month_split_dist_path)
-        min_age, max_age = month_split.calculate_patient_ages(compare_date)
-        month_split.calculate_age_gender_distribution(
-            min_age, max_age, month_split.get_unique_genders(), month_split_dist_path
-        )
+    render_age_gender_histograms(age_gender_histograms, output_dir, num_workers)
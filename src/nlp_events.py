@@ -0,0 +1,190 @@
+# Stream NLP JSONL patients straight into a PatientDB
+import json
+import os
+from collections import Counter
+
+import pandas as pd
+
+from data_schema import Event, Patient, Visit
+from patient_db import PatientDB, date_str_to_obj
+from progress import Progress
+
+# section_data entity lists and the event types they become
+NLP_ENTITY_EVENT_TYPES = {
+    "risk_factor_entity": "RiskFactorEvent",
+    "snomed_entity": "SnomedEvent",
+}
+
+# Columns of the event batches from get_nlp_event_batches()
+NLP_EVENT_COLUMNS = [
+    "patient_id",
+    "visit_id",
+    "note_id",
+    "section_header",
+    "event_type",
+    "entity",
+    "text",
+]
+
+
+def iter_nlp_records(lines, c, name="iter_nlp_records", total_bytes=None):
+    """Parse NLP JSONL lines, skipping lines that aren't valid JSON.
+
+    Progress is reported with the counts in c, the ETA from total_bytes.
+    """
+    with Progress(name, total_bytes=total_bytes, counters=c, unit="lines") as progress:
+        for line in lines:
+            progress.update(num_bytes=len(line))
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                c["JSONDecodeError"] += 1
+                continue
+            c["records"] += 1
+            yield record
+
+
+def iter_nlp_sections(record, use_first_section=False, use_first_visit=False):
+    """Yield (date_str, note_id, section) for a record's visit sections.
+
+    Visits are keyed by the YYYY-MM-DD of their timestamp, like the visits
+    that attach_events_to_visits() creates.
+    """
+    for visit_i, nlp_visit in enumerate(record["visits"]):
+        # Only use the first visit
+        if use_first_visit and visit_i != 0:
+            continue
+        date_str = nlp_visit["timestamp"][0:10]
+        note_id = nlp_visit.get("note_id", "")
+        for section_i, section in enumerate(nlp_visit["section_data"]):
+            # Only use the first section
+            if use_first_section and section_i != 0:
+                continue
+            yield date_str, note_id, section
+
+
+def nlp_record_to_patient(record, c, use_first_section=False, use_first_visit=False):
+    """Convert an NLP record to a Patient, None if it has no entities."""
+    patient_id = str(record["patient_id"])
+    patient = Patient(patient_id=patient_id)
+    visits = dict()
+    for date_str, note_id, section in iter_nlp_sections(
+        record, use_first_section, use_first_visit
+    ):
+        visit = visits.get(date_str)
+        if visit is None:
+            try:
+                date_obj = date_str_to_obj(date_str)
+            except ValueError:
+                c["malformed_timestamps"] += 1
+                continue
+            visit = Visit(date=date_obj, visit_id=date_str, patient_id=patient_id)
+            visits[date_str] = visit
+
+        section_header = section.get("section_header", "")
+        for entity_key, event_type in NLP_ENTITY_EVENT_TYPES.items():
+            for entity_result in section.get(entity_key) or []:
+                event = Event(
+                    chartdate=date_str, visit_id=date_str, patient_id=patient_id
+                )
+                event.nlp_entity_role(
+                    event_type, entity_result, section_header, note_id
+                )
+                visit.events.append(event)
+
+    patient.visits = [visit for visit in visits.values() if visit.events]
+    if not patient.visits:
+        c["empty_patients"] += 1
+        return None
+    return patient
+
+
+def add_nlp_patient(patients: PatientDB, patient: Patient):
+    """Add a patient, merging visits and events of repeated patient IDs."""
+    existing_patient = patients.data["patients"].get(patient.patient_id)
+    if existing_patient is None:
+        return patients.add_patient(patient, entity_id=patient.patient_id)
+
+    # The NLP output has more than one line for some patients
+    for visit in patient.visits:
+        existing_visit = existing_patient.get_visit_by_id(visit.visit_id)
+        if existing_visit is None:
+            existing_patient.visits.append(patients.add_visit(visit))
+            continue
+        for event in visit.events:
+            existing_visit.events.append(patients.add_event(event))
+    return existing_patient
+
+
+def load_nlp_patient_db(
+    patients: PatientDB,
+    input_path,
+    patient_ids=None,
+    use_first_section=False,
+    use_first_visit=False,
+):
+    """Add the patients of an NLP JSONL file to a PatientDB in one pass.
+
+    Visits and events are attached as they are read, so the PatientDB is
+    ready to query without attach_events_to_visits(). Only patients in
+    patient_ids are added when it is given.
+    """
+    print(f"Loading NLP patients from {input_path}", flush=True)
+    c = Counter()
+    total_bytes = os.path.getsize(input_path)
+    with open(input_path, "r") as f:
+        for record in iter_nlp_records(f, c, "load_nlp_patient_db", total_bytes):
+            if patient_ids is not None and str(record["patient_id"]) not in patient_ids:
+                c["skipped_patients"] += 1
+                continue
+            patient = nlp_record_to_patient(
+                record, c, use_first_section, use_first_visit
+            )
+            if patient is None:
+                continue
+            add_nlp_patient(patients, patient)
+    print(f"{c}", flush=True)
+    print(f"{patients}", flush=True)
+    return patients
+
+
+def get_nlp_event_batches(
+    input_path,
+    batch_size=100000,
+    patient_ids=None,
+    use_first_section=False,
+    use_first_visit=False,
+):
+    """Stream the NLP entities of a JSONL file as DataFrames of events.
+
+    Batches have about batch_size rows with NLP_EVENT_COLUMNS, the
+    columnar alternative to load_nlp_patient_db() for counting.
+    """
+    c = Counter()
+    columns = {column: [] for column in NLP_EVENT_COLUMNS}
+    total_bytes = os.path.getsize(input_path)
+    with open(input_path, "r") as f:
+        for record in iter_nlp_records(f, c, "get_nlp_event_batches", total_bytes):
+            patient_id = str(record["patient_id"])
+            if patient_ids is not None and patient_id not in patient_ids:
+                continue
+            for date_str, note_id, section in iter_nlp_sections(
+                record, use_first_section, use_first_visit
+            ):
+                section_header = section.get("section_header", "")
+                for entity_key, event_type in NLP_ENTITY_EVENT_TYPES.items():
+                    for entity_result in section.get(entity_key) or []:
+                        columns["patient_id"].append(patient_id)
+                        columns["visit_id"].append(date_str)
+                        columns["note_id"].append(note_id)
+                        columns["section_header"].append(section_header)
+                        columns["event_type"].append(event_type)
+                        columns["entity"].append(entity_result.get("entity"))
+                        columns["text"].append(entity_result.get("text"))
+
+                if len(columns["patient_id"]) >= batch_size:
+                    yield pd.DataFrame(columns)
+                    columns = {column: [] for column in NLP_EVENT_COLUMNS}
+    if columns["patient_id"]:
+        yield pd.DataFrame(columns)
+    print(f"{c}", flush=True)
@@ -1,5 +1,38 @@
 from utils import get_table
 
+# DRUG_EXPOSURE columns used by Event.add_drug_exposure_roles()
+DRUG_EXPOSURE_COLUMNS = [
+    "drug_exposure_id",
+    "person_id",
+    "drug_concept_id",
+    "drug_exposure_start_DATE",
+    "drug_exposure_start_DATETIME",
+    "drug_exposure_end_DATE",
+    "drug_exposure_end_DATETIME",
+    "verbatim_end_DATE",
+    "drug_type_concept_id",
+    "stop_reason",
+    "refills",
+    "quantity",
+    "days_supply",
+    "sig",
+    "route_concept_id",
+    "lot_number",
+    "provider_id",
+    "visit_occurrence_id",
+    "visit_detail_id",
+    "drug_source_value",
+    "drug_source_concept_id",
+    "route_source_value",
+    "dose_unit_source_value",
+    "trace_id",
+    "unit_id",
+    "load_table_id",
+]
+
+# CONCEPT columns used when joining DRUG_EXPOSURE to CONCEPT
+CONCEPT_COLUMNS = ["concept_id", "concept_name", "concept_class_id"]
+
 
 def omop_drug_exposure(
     drug_exposure_dir,
@@ -9,6 +42,12 @@ def omop_drug_exposure(
     extension=".csv",
     use_dask=False,
     debug=False,
+    columns=None,
+    filters=None,
+    num_workers=1,
+    cache_dir=None,
+    compact=False,
+    id_columns=None,
 ):
     print("OMOP DRUG_EXPOSURE", flush=True)
     drug_exposure = get_table(
@@ -18,6 +57,12 @@ def omop_drug_exposure(
         extension=extension,
         use_dask=use_dask,
         debug=debug,
+        columns=columns,
+        filters=filters,
+        num_workers=num_workers,
+        cache_dir=cache_dir,
+        compact=compact,
+        id_columns=id_columns,
     )
     return drug_exposure
 
@@ -30,9 +75,26 @@ def omop_concept(
     extension=".csv",
     use_dask=False,
     debug=False,
+    columns=None,
+    filters=None,
+    num_workers=1,
+    cache_dir=None,
+    compact=False,
+    id_columns=None,
 ):
     print("OMOP CONCEPT", flush=True)
-    concept = get_table(concept_dir, prefix=prefix, use_dask=use_dask, debug=debug)
+    concept = get_table(
+        concept_dir,
+        prefix=prefix,
+        use_dask=use_dask,
+        debug=debug,
+        columns=columns,
+        filters=filters,
+        num_workers=num_workers,
+        cache_dir=cache_dir,
+        compact=compact,
+        id_columns=id_columns,
+    )
     # FIXME
     # set index to int concept_id
     # concept.set_index('concept_id')
@@ -0,0 +1,241 @@
+# Compact patient attribute index over patient_kg.json
+import json
+import os
+
+import numpy as np
+
+# (attribute, patient_kg section, key) of the indexed patient attributes
+ATTRIBUTE_FIELDS = [
+    ("gender", "attr", "gender"),
+    ("length_of_stay", "outcome", "length_of_stay"),
+    ("race", "attr", "race"),
+    ("survivor", "outcome", "survivor"),
+]
+ATTRIBUTES = [attribute for attribute, _, _ in ATTRIBUTE_FIELDS]
+
+# Code of patients that don't have an attribute value
+MISSING_CODE = -1
+
+
+def get_code_dtype(num_categories):
+    if num_categories < np.iinfo(np.int8).max:
+        return np.int8
+    if num_categories < np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+
+class AttributeMap:
+    """Read only dict like view of one attribute, keyed by patient ID."""
+
+    def __init__(self, index, attribute):
+        self.index = index
+        self.attribute = attribute
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, patient_id):
+        return self.index.get_row(patient_id) is not None
+
+    def __getitem__(self, patient_id):
+        row = self.index.get_row(patient_id)
+        if row is None:
+            raise KeyError(patient_id)
+        return self.index.get_value(self.attribute, row)
+
+    def get(self, patient_id, default=None):
+        row = self.index.get_row(patient_id)
+        if row is None:
+            return default
+        return self.index.get_value(self.attribute, row)
+
+
+class PatientAttributeIndex:
+    """Integer coded patient attributes, one row per patient ID.
+
+    patient_ids is a sorted array of patient IDs, codes[attribute][row] is
+    the position of the patient's value in categories[attribute], or
+    MISSING_CODE.
+    """
+
+    def __init__(self, patient_ids=None, codes=None, categories=None):
+        if patient_ids is None:
+            patient_ids = np.array([], dtype=str)
+        if codes is None:
+            codes = {attribute: np.array([], dtype=np.int8) for attribute in ATTRIBUTES}
+        if categories is None:
+            categories = {attribute: [] for attribute in ATTRIBUTES}
+        self.patient_ids = patient_ids
+        self.codes = codes
+        self.categories = categories
+        # Scalar lookups go through a dict, built on first use
+        self.rows = None
+        # (size, mtime_ns) of the patient_kg.json the index was built from
+        self.source_stat = None
+
+    def __str__(self):
+        num_categories = {
+            attribute: len(categories)
+            for attribute, categories in self.categories.items()
+        }
+        return (
+            f"PatientAttributeIndex(num_patients: {len(self)}, "
+            f"num_categories: {num_categories})"
+        )
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def __getstate__(self):
+        # Don't ship the lookup dict to worker processes
+        state = self.__dict__.copy()
+        state["rows"] = None
+        return state
+
+    @classmethod
+    def from_patient_kg(cls, patient_kg):
+        """Index the attributes of all patients in a single pass."""
+        patient_values = dict()
+        for patient in patient_kg:
+            # graph_id is "<patient_id>_<visit_id>", the last visit wins
+            patient_id = patient["graph_id"].split("_", 1)[0]
+            patient_values[patient_id] = tuple(
+                patient[section][key] for _, section, key in ATTRIBUTE_FIELDS
+            )
+
+        patient_ids = sorted(patient_values)
+        codes = dict()
+        categories = dict()
+        for attribute_i, attribute in enumerate(ATTRIBUTES):
+            values = [
+                patient_values[patient_id][attribute_i] for patient_id in patient_ids
+            ]
+            # Sort categories so codes don't depend on patient_kg order
+            attribute_categories = sorted(
+                {value for value in values if value is not None},
+                key=lambda value: (type(value).__name__, value),
+            )
+            category_codes = {
+                value: code for code, value in enumerate(attribute_categories)
+            }
+            attribute_codes = np.fromiter(
+                (category_codes.get(value, MISSING_CODE) for value in values),
+                dtype=get_code_dtype(len(attribute_categories)),
+                count=len(values),
+            )
+            codes[attribute] = attribute_codes
+            categories[attribute] = attribute_categories
+
+        index = cls(np.array(patient_ids, dtype=str), codes, categories)
+        print(f"Indexed {index}", flush=True)
+        return index
+
+    @classmethod
+    def from_patient_kg_path(cls, patient_kg_path):
+        print(f"Loading patient_kg from {patient_kg_path}")
+        stat = os.stat(patient_kg_path)
+        with open(patient_kg_path, "r") as f:
+            patient_kg = json.load(f)
+        index = cls.from_patient_kg(patient_kg)
+        index.source_stat = (stat.st_size, stat.st_mtime_ns)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        print(f"Loading PatientAttributeIndex from {path}")
+        with np.load(path, allow_pickle=False) as data:
+            patient_ids = data["patient_ids"]
+            codes = {attribute: data[f"codes_{attribute}"] for attribute in ATTRIBUTES}
+            # Categories mix strings and bools, keep their types in JSON
+            categories = json.loads(str(data["categories"]))
+            source_stat = None
+            if "source_size" in data.files:
+                source_stat = (int(data["source_size"]), int(data["source_mtime_ns"]))
+        index = cls(patient_ids, codes, categories)
+        index.source_stat = source_stat
+        return index
+
+    @classmethod
+    def load_or_create(cls, path, patient_kg_path):
+        """Load a saved index, only reading patient_kg.json if there isn't one.
+
+        A saved index is rebuilt if patient_kg.json's size or mtime changed.
+        """
+        if os.path.exists(path):
+            index = cls.load(path)
+            stat = os.stat(patient_kg_path)
+            if index.source_stat == (stat.st_size, stat.st_mtime_ns):
+                return index
+            print(f"{path} is stale, indexing {patient_kg_path} again", flush=True)
+        index = cls.from_patient_kg_path(patient_kg_path)
+        index.dump(path)
+        return index
+
+    def dump(self, path):
+        print(f"Dumping {len(self)} patient attributes to {path}")
+        output_dir = os.path.dirname(path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        arrays = {
+            f"codes_{attribute}": self.codes[attribute] for attribute in ATTRIBUTES
+        }
+        if self.source_stat is not None:
+            arrays["source_size"], arrays["source_mtime_ns"] = self.source_stat
+        # np.savez adds .npz to paths without it, write to the exact path
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                patient_ids=self.patient_ids,
+                categories=np.array(json.dumps(self.categories)),
+                **arrays,
+            )
+
+    def get_row(self, patient_id):
+        """Row of a patient ID, None for unknown patients."""
+        if self.rows is None:
+            self.rows = {
+                patient_id: row
+                for row, patient_id in enumerate(self.patient_ids.tolist())
+            }
+        return self.rows.get(patient_id)
+
+    def get_rows(self, patient_ids):
+        """Vectorized rows of patient IDs, -1 for unknown patients."""
+        patient_ids = np.asarray(patient_ids, dtype=str)
+        if not len(self.patient_ids):
+            return np.full(len(patient_ids), -1, dtype=np.int64)
+        rows = np.searchsorted(self.patient_ids, patient_ids)
+        rows = np.minimum(rows, len(self.patient_ids) - 1).astype(np.int64)
+        rows[self.patient_ids[rows] != patient_ids] = -1
+        return rows
+
+    def get_value(self, attribute, row):
+        code = self.codes[attribute][row]
+        if code == MISSING_CODE:
+            return None
+        return self.categories[attribute][code]
+
+    def get_code(self, attribute, value):
+        """Code of an attribute value, MISSING_CODE for unknown values."""
+        try:
+            return self.categories[attribute].index(value)
+        except ValueError:
+            return MISSING_CODE
+
+    def get_map(self, attribute):
+        return AttributeMap(self, attribute)
+
+    def get_unique_values(self, attribute):
+        """Values of an attribute that patients have, like create_*_map."""
+        codes = np.unique(self.codes[attribute])
+        return {
+            None if code == MISSING_CODE else self.categories[attribute][code]
+            for code in codes.tolist()
+        }
+
+    def get_mask(self, attribute, values):
+        """Bool array over rows of the patients with one of the values."""
+        value_codes = [self.get_code(attribute, value) for value in values]
+        value_codes = [code for code in value_codes if code != MISSING_CODE]
+        return np.isin(self.codes[attribute], value_codes)
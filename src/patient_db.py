@@ -13,6 +13,7 @@ import pandas as pd
 from dateutil import rrule
 
 from data_schema import EntityDecoder, EntityEncoder, Event, Patient, Visit
+from progress import Progress
 
 Match = namedtuple(
     "Match", ["patient_id", "visit_id", "event_id", "event_type", "role", "term"]
@@ -384,24 +385,25 @@ class PatientDB:
         c = Counter()
         patient_ids = [str(x) for x in patient_ids]
         num_visits = len(self.visits)
-        for i, visit in enumerate(self.visits):
-            if i % 100000 == 0:
-                print(f"{now_str()} visit {i}/{num_visits}")
-            patient_id = str(visit.patient_id)
-            # Skipping patient_ids not in patient_ids set
-            if patient_id not in patient_ids:
-                continue
-            # FIXME
-            # patient = self.get_patient_by_patient_id(patient_id)
-            patient = self.data["patients"][patient_id]
-            if not patient:
-                import pdb
+        with Progress(
+            "attach_visits_to_patients", num_visits, counters=c, unit="visits"
+        ) as progress:
+            for visit in progress.track(self.visits):
+                patient_id = str(visit.patient_id)
+                # Skipping patient_ids not in patient_ids set
+                if patient_id not in patient_ids:
+                    continue
+                # FIXME
+                # patient = self.get_patient_by_patient_id(patient_id)
+                patient = self.data["patients"][patient_id]
+                if not patient:
+                    import pdb
 
-                pdb.set_trace()
-                c["missing"] += 1
-                continue
-            c["success"] += 1
-            patient.visits.append(visit)
+                    pdb.set_trace()
+                    c["missing"] += 1
+                    continue
+                c["success"] += 1
+                patient.visits.append(visit)
         print(
             f"Vists, Num missing keys: {c['missing']}\n"
             f"Visits, Num successful keys: {c['success']}"
@@ -993,40 +995,41 @@ class PatientDB:
         c = Counter()
 
         # Attach events to visits
-        for i, event in enumerate(self.events):
-            if i % 100000 == 0:
-                now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                print(f"{now_str} Attaching event {i} out of " f"{self.num_events()}")
-            try:
-                # FIXME, we dont have unique_visit_ids
-                patient = self.get_patient_by_id(event.patient_id)
-                if not patient:
+        num_events = self.num_events()
+        with Progress(
+            "attach_events_to_visits", num_events, counters=c, unit="events"
+        ) as progress:
+            for event in progress.track(self.events):
+                try:
+                    # FIXME, we dont have unique_visit_ids
+                    patient = self.get_patient_by_id(event.patient_id)
+                    if not patient:
+                        import pdb
+
+                        pdb.set_trace()
+                        print("Couldn't find patient")
+                    visit = patient.get_visit_by_id(event.visit_id)
+                    # FIXME, is this necessary?
+                    # FIXME, choosing to create visits here instead of creating all possible
+                    if not visit:
+                        # import pdb;pdb.set_trace()
+                        # print("Couldn't find visit.")
+                        date_str = event.visit_id
+                        date_obj = date_str_to_obj(date_str)
+                        visit = Visit(
+                            date=date_obj,
+                            visit_id=event.visit_id,
+                            patient_id=event.patient_id,
+                        )
+                        visit = self.add_visit(visit)
+                        patient.visits.append(visit)
+                    visit.events.append(event)
+                    c["successful_keys"] += 1
+                except KeyError:
                     import pdb
 
                     pdb.set_trace()
-                    print("Couldn't find patient")
-                visit = patient.get_visit_by_id(event.visit_id)
-                # FIXME, is this necessary?
-                # FIXME, choosing to create visits here instead of creating all possible
-                if not visit:
-                    # import pdb;pdb.set_trace()
-                    # print("Couldn't find visit.")
-                    date_str = event.visit_id
-                    date_obj = date_str_to_obj(date_str)
-                    visit = Visit(
-                        date=date_obj,
-                        visit_id=event.visit_id,
-                        patient_id=event.patient_id,
-                    )
-                    visit = self.add_visit(visit)
-                    patient.visits.append(visit)
-                visit.events.append(event)
-                c["successful_keys"] += 1
-            except KeyError:
-                import pdb
-
-                pdb.set_trace()
-                c["missing_keys"] += 1
+                    c["missing_keys"] += 1
         print(
             f"Events, Num missing keys: {c['missing_keys']}\n"
             f"Events, Num successful keys: {c['successful_keys']}"
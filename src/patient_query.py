@@ -0,0 +1,425 @@
+# Declarative PatientDB queries compiled to index lookups and bitmap set ops
+from fnmatch import fnmatchcase
+
+import numpy as np
+import pandas as pd
+
+from patient_db import Match
+
+# Spaces queries select rows in
+EVENT_SPACE = "event"
+PATIENT_SPACE = "patient"
+VISIT_SPACE = "visit"
+
+# MedDRA levels of MEDDRAEvent roles, most to least specific
+MEDDRA_LEVELS = ["PT", "HLT", "HLGT", "SOC"]
+
+
+def is_pattern(value):
+    return any(char in value for char in "*?[")
+
+
+class Query:
+    """A node of a query, combine them with &, | and ~.
+
+    Event queries select events, Patients() and Visits() lift them to the
+    patients or visits that have a selected event. Only queries of the same
+    space combine.
+    """
+
+    space = EVENT_SPACE
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def get_leaves(self):
+        """The RoleValue leaves that aren't negated."""
+        return []
+
+
+class BoolQuery(Query):
+    def __init__(self, *children):
+        spaces = {child.space for child in children}
+        if len(spaces) != 1:
+            raise ValueError(f"Can't combine queries over {sorted(spaces)}")
+        self.space = spaces.pop()
+        self.children = []
+        # Flatten nested nodes of the same kind, so the planner sees them all
+        for child in children:
+            if type(child) is type(self):
+                self.children.extend(child.children)
+            else:
+                self.children.append(child)
+
+    def get_leaves(self):
+        return [leaf for child in self.children for leaf in child.get_leaves()]
+
+    def __repr__(self):
+        children = ", ".join(repr(child) for child in self.children)
+        return f"{type(self).__name__}({children})"
+
+
+class And(BoolQuery):
+    pass
+
+
+class Or(BoolQuery):
+    pass
+
+
+class Not(Query):
+    def __init__(self, child):
+        self.space = child.space
+        self.child = child
+
+    def __repr__(self):
+        return f"Not({self.child!r})"
+
+
+class RoleValue(Query):
+    """Events with any of the values in any of the roles of the event types.
+
+    event_type_roles maps event types to roles, like match_terms(). Values
+    compare lower cased, values with *, ? or [] are fnmatch patterns
+    matched against every value the roles have. With exact=True values are
+    compared as they are to the lower cased role values, like
+    match_terms() does.
+    """
+
+    # Filters narrow down the events of other leaves, get_matches() doesn't
+    # give Matches of them
+    is_filter = False
+
+    def __init__(self, event_type_roles, values, exact=False):
+        if isinstance(values, str):
+            values = [values]
+        self.event_type_roles = {
+            event_type: sorted(roles) for event_type, roles in event_type_roles.items()
+        }
+        self.exact = exact
+        if exact:
+            self.values = [str(value) for value in values]
+        else:
+            self.values = [str(value).lower() for value in values]
+
+    def get_leaves(self):
+        return [self]
+
+    def __repr__(self):
+        return f"RoleValue({self.event_type_roles}, {self.values})"
+
+
+class Term(RoleValue):
+    """Events matching any of the terms.
+
+    With exact=True these are the events match_terms() matches.
+    """
+
+    def __init__(self, terms, event_type_roles, exact=False):
+        super().__init__(event_type_roles, terms, exact=exact)
+
+
+class Meddra(RoleValue):
+    """MEDDRAEvents with a MedDRA level text matching any of the patterns.
+
+    level is one of MEDDRA_LEVELS, "concept" for the extracted concept text or
+    "*" for any level, e.g. Meddra("depress*", level="HLT").
+    """
+
+    def __init__(self, patterns, level="PT"):
+        if level == "*":
+            roles = [f"{meddra_level}_text" for meddra_level in MEDDRA_LEVELS]
+        elif level == "concept":
+            roles = ["concept_text"]
+        elif level in MEDDRA_LEVELS:
+            roles = [f"{level}_text"]
+        else:
+            raise ValueError(f"Unknown MedDRA level: {level}")
+        super().__init__({"MEDDRAEvent": roles}, patterns)
+
+
+class Drug(RoleValue):
+    """DRUG_EXPOSURE events with a drug concept name matching the patterns."""
+
+    def __init__(self, patterns):
+        super().__init__({"DRUG_EXPOSURE": ["drug_concept_name"]}, patterns)
+
+
+class Polarity(RoleValue):
+    is_filter = True
+
+    def __init__(self, polarity="positive"):
+        super().__init__({"MEDDRAEvent": ["polarity"]}, polarity)
+
+
+class Present(RoleValue):
+    is_filter = True
+
+    def __init__(self, present="present"):
+        super().__init__({"MEDDRAEvent": ["present"]}, present)
+
+
+class EventType(Query):
+    def __init__(self, *event_types):
+        self.event_types = list(event_types)
+
+    def __repr__(self):
+        return f"EventType({', '.join(self.event_types)})"
+
+
+class DateRange(Query):
+    """Events with a chartdate between start_date and end_date, inclusive."""
+
+    def __init__(self, start_date=None, end_date=None):
+        self.start_date = start_date
+        self.end_date = end_date
+
+    def __repr__(self):
+        return f"DateRange({self.start_date}, {self.end_date})"
+
+
+class Patients(Query):
+    """Patients with at least one event selected by an event query."""
+
+    space = PATIENT_SPACE
+
+    def __init__(self, events):
+        if events.space != EVENT_SPACE:
+            raise ValueError(f"Patients() takes an event query, got {events}")
+        self.events = events
+
+    def __repr__(self):
+        return f"Patients({self.events!r})"
+
+
+class Visits(Patients):
+    """Visits with at least one event selected by an event query."""
+
+    space = VISIT_SPACE
+
+    def __repr__(self):
+        return f"Visits({self.events!r})"
+
+
+class QueryIndex:
+    """Columnar index of the events attached to a PatientDB's visits.
+
+    Events are rows, with their patient and visit rows, event type code and
+    chartdate in arrays. Postings of each (event type, role), lower cased
+    value to sorted event rows, are built the first time they're queried.
+    Queries evaluate to bool arrays over events, patients or visits.
+    """
+
+    def __init__(self, patients):
+        self.patient_ids = []
+        self.visit_keys = []
+        self.events = []
+        patient_rows = []
+        visit_rows = []
+        for patient in patients.patients:
+            patient_row = len(self.patient_ids)
+            self.patient_ids.append(patient.patient_id)
+            for visit in patient.visits:
+                visit_row = len(self.visit_keys)
+                self.visit_keys.append((patient.patient_id, visit.visit_id))
+                for event in visit.events:
+                    self.events.append(event)
+                    patient_rows.append(patient_row)
+                    visit_rows.append(visit_row)
+        self.patient_rows = np.array(patient_rows, dtype=np.int32)
+        self.visit_rows = np.array(visit_rows, dtype=np.int32)
+
+        event_types = pd.Categorical([event.event_type for event in self.events])
+        self.event_types = list(event_types.categories)
+        self.event_type_codes = event_types.codes
+        # Unparseable chartdates are NaT, which no date range selects
+        self.dates = (
+            pd.to_datetime(
+                pd.Series([event.chartdate for event in self.events], dtype=object),
+                errors="coerce",
+            )
+            .to_numpy()
+            .astype("datetime64[D]")
+        )
+        self.postings = dict()
+
+    def __str__(self):
+        return (
+            f"QueryIndex(num_patients: {len(self.patient_ids)}, "
+            f"num_visits: {len(self.visit_keys)}, num_events: {len(self.events)}, "
+            f"num_postings: {len(self.postings)})"
+        )
+
+    @classmethod
+    def from_patient_db(cls, patients):
+        return cls(patients)
+
+    def get_space_size(self, space):
+        if space == PATIENT_SPACE:
+            return len(self.patient_ids)
+        if space == VISIT_SPACE:
+            return len(self.visit_keys)
+        return len(self.events)
+
+    def get_event_type_rows(self, event_type):
+        if event_type not in self.event_types:
+            return np.empty(0, dtype=np.int64)
+        code = self.event_types.index(event_type)
+        return np.flatnonzero(self.event_type_codes == code)
+
+    def get_postings(self, event_type, role):
+        """Lower cased value -> sorted event rows of one event type role."""
+        key = (event_type, role)
+        if key not in self.postings:
+            value_rows = dict()
+            for row in self.get_event_type_rows(event_type).tolist():
+                value = self.events[row].roles.get(role)
+                if value is None:
+                    continue
+                value_rows.setdefault(str(value).lower(), []).append(row)
+            self.postings[key] = {
+                value: np.array(rows, dtype=np.int64)
+                for value, rows in value_rows.items()
+            }
+        return self.postings[key]
+
+    def get_role_value_rows(self, leaf):
+        """(event_type, role, value, rows) of every posting a leaf hits."""
+        hits = []
+        for event_type, roles in leaf.event_type_roles.items():
+            for role in roles:
+                postings = self.get_postings(event_type, role)
+                for value in leaf.values:
+                    if not leaf.exact and is_pattern(value):
+                        for posting_value, rows in postings.items():
+                            if fnmatchcase(posting_value, value):
+                                hits.append((event_type, role, posting_value, rows))
+                    elif value in postings:
+                        hits.append((event_type, role, value, postings[value]))
+        return hits
+
+    def estimate(self, query):
+        """Upper bound of the rows a query selects, for ordering And children."""
+        if isinstance(query, RoleValue):
+            return sum(len(rows) for *_, rows in self.get_role_value_rows(query))
+        if isinstance(query, EventType):
+            return sum(
+                len(self.get_event_type_rows(event_type))
+                for event_type in query.event_types
+            )
+        if isinstance(query, And):
+            return min(self.estimate(child) for child in query.children)
+        if isinstance(query, Or):
+            return sum(self.estimate(child) for child in query.children)
+        return self.get_space_size(query.space)
+
+    def evaluate(self, query):
+        """Bool array over the rows of the query's space it selects."""
+        size = self.get_space_size(query.space)
+        if isinstance(query, RoleValue):
+            mask = np.zeros(size, dtype=bool)
+            for *_, rows in self.get_role_value_rows(query):
+                mask[rows] = True
+            return mask
+        if isinstance(query, EventType):
+            codes = [
+                self.event_types.index(event_type)
+                for event_type in query.event_types
+                if event_type in self.event_types
+            ]
+            return np.isin(self.event_type_codes, codes)
+        if isinstance(query, DateRange):
+            mask = ~np.isnat(self.dates)
+            if query.start_date:
+                mask &= self.dates >= np.datetime64(query.start_date, "D")
+            if query.end_date:
+                mask &= self.dates <= np.datetime64(query.end_date, "D")
+            return mask
+        if isinstance(query, Patients):
+            entity_rows = (
+                self.visit_rows if query.space == VISIT_SPACE else self.patient_rows
+            )
+            mask = np.zeros(size, dtype=bool)
+            mask[entity_rows[self.evaluate(query.events)]] = True
+            return mask
+        if isinstance(query, Not):
+            return ~self.evaluate(query.child)
+        if isinstance(query, And):
+            # Most selective children first, negations last as set differences
+            positives = [c for c in query.children if not isinstance(c, Not)]
+            negatives = [c.child for c in query.children if isinstance(c, Not)]
+            positives.sort(key=self.estimate)
+            mask = np.ones(size, dtype=bool)
+            for child in positives:
+                mask &= self.evaluate(child)
+                if not mask.any():
+                    return mask
+            for child in negatives:
+                mask &= ~self.evaluate(child)
+                if not mask.any():
+                    return mask
+            return mask
+        if isinstance(query, Or):
+            mask = np.zeros(size, dtype=bool)
+            for child in query.children:
+                mask |= self.evaluate(child)
+            return mask
+        raise TypeError(f"Unknown query: {query!r}")
+
+    def select_patient_ids(self, query):
+        """IDs of the patients of a patient query."""
+        if query.space == EVENT_SPACE:
+            query = Patients(query)
+        if query.space != PATIENT_SPACE:
+            raise ValueError(f"Expected a patient query, got {query}")
+        return [self.patient_ids[row] for row in np.flatnonzero(self.evaluate(query))]
+
+    def select_visit_keys(self, query):
+        """(patient ID, visit ID) of the visits of a visit query."""
+        if query.space == EVENT_SPACE:
+            query = Visits(query)
+        if query.space != VISIT_SPACE:
+            raise ValueError(f"Expected a visit query, got {query}")
+        return [self.visit_keys[row] for row in np.flatnonzero(self.evaluate(query))]
+
+    def select_events(self, query):
+        if query.space != EVENT_SPACE:
+            raise ValueError(f"Expected an event query, got {query}")
+        return [self.events[row] for row in np.flatnonzero(self.evaluate(query))]
+
+    def get_matches(self, query, leaves=None):
+        """Matches of the events an event query selects, like match_terms().
+
+        There's a Match per selected event and (role, value) of one of the
+        leaves it has. leaves default to the query's RoleValues that aren't
+        filters, e.g. Term(terms, roles) & Present() gives Matches of the
+        terms in events that are present, but not of "present".
+        """
+        if query.space != EVENT_SPACE:
+            raise ValueError(f"Expected an event query, got {query}")
+        if leaves is None:
+            leaves = [leaf for leaf in query.get_leaves() if not leaf.is_filter]
+        mask = self.evaluate(query)
+        matches = set()
+        for leaf in leaves:
+            for event_type, role, value, rows in self.get_role_value_rows(leaf):
+                for row in rows[mask[rows]].tolist():
+                    event = self.events[row]
+                    patient_id, visit_id = self.visit_keys[self.visit_rows[row]]
+                    matches.add(
+                        Match(
+                            patient_id,
+                            visit_id,
+                            event.event_id,
+                            event_type,
+                            role,
+                            value,
+                        )
+                    )
+        return matches
@@ -0,0 +1,142 @@
+# Patient ID registry
+import glob
+import hashlib
+import json
+import os
+
+import dask
+import numpy as np
+
+REGISTRY_EXTENSION = ".npy"
+
+
+def get_unique_ids(df, column):
+    """Get the unique non-null ids of a column in a single scan."""
+    return df[column].dropna().unique()
+
+
+def get_registry_path(path):
+    """Path of a registry, np.save() adds .npy to paths without it."""
+    if path.endswith(REGISTRY_EXTENSION):
+        return path
+    return f"{path}{REGISTRY_EXTENSION}"
+
+
+def get_fingerprint_path(path):
+    return f"{get_registry_path(path)[: -len(REGISTRY_EXTENSION)]}.fingerprint.json"
+
+
+def get_input_fingerprint(paths, filters=None):
+    """Hash of the paths, sizes and mtimes of input files and the filters.
+
+    Dirs stand for all the files in them.
+    """
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_paths = sorted(glob.glob(os.path.join(path, "*")))
+        else:
+            file_paths = [path]
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            inputs.append([os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns])
+    fingerprint = json.dumps({"inputs": inputs, "filters": filters}, sort_keys=True)
+    return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+
+
+def to_id_array(ids):
+    ids = np.asarray(ids)
+    # Ids read next to NaNs come in as floats
+    return ids.astype(np.int64)
+
+
+class PatientIdRegistry:
+    """Sorted int64 array of all known patient IDs.
+
+    Positions in the sorted array are dense ids, 0..len(registry) - 1, that
+    can stand in for the sparse patient IDs in arrays and bitmaps.
+    """
+
+    def __init__(self, ids=None, fingerprint=None):
+        if ids is None:
+            ids = []
+        self.ids = np.unique(to_id_array(ids))
+        # Fingerprint of the inputs the IDs were gathered from
+        self.fingerprint = fingerprint
+
+    def __str__(self):
+        return f"PatientIdRegistry(num_ids: {len(self)})"
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __contains__(self, patient_id):
+        return bool(self.contains([patient_id])[0])
+
+    @classmethod
+    def from_tables(cls, tables, use_dask=False):
+        """Gather the ids of (name, df, column) tables with one scan each."""
+        table_ids = [get_unique_ids(df, column) for _, df, column in tables]
+        if use_dask:
+            # Compute all tables together so shared inputs are only read once
+            table_ids = dask.compute(*table_ids)
+
+        all_ids = []
+        for (name, _, column), ids in zip(tables, table_ids):
+            ids = to_id_array(ids)
+            print(f"{name}: found {len(ids)} unique {column} values", flush=True)
+            all_ids.append(ids)
+
+        registry = cls(np.concatenate(all_ids) if all_ids else None)
+        print(f"Found {len(registry)} patient IDs in all tables", flush=True)
+        return registry
+
+    @classmethod
+    def load(cls, path):
+        path = get_registry_path(path)
+        print(f"Loading PatientIdRegistry from {path}")
+        registry = cls()
+        # Saved arrays are already sorted and unique
+        registry.ids = np.load(path)
+        fingerprint_path = get_fingerprint_path(path)
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path) as f:
+                registry.fingerprint = json.load(f)["fingerprint"]
+        return registry
+
+    def dump(self, path):
+        path = get_registry_path(path)
+        print(f"Dumping {len(self)} patient IDs to {path}")
+        output_dir = os.path.dirname(path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        np.save(path, self.ids)
+        with open(get_fingerprint_path(path), "w") as f:
+            json.dump({"fingerprint": self.fingerprint}, f)
+
+    def update(self, ids):
+        self.ids = np.union1d(self.ids, to_id_array(ids))
+
+    def contains(self, ids):
+        """Vectorized membership test, returns a bool array."""
+        ids = to_id_array(ids)
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=bool)
+        dense_ids = np.searchsorted(self.ids, ids)
+        # IDs past the largest known ID would index out of bounds
+        dense_ids = np.minimum(dense_ids, len(self.ids) - 1)
+        return self.ids[dense_ids] == ids
+
+    def to_dense(self, ids):
+        """Map patient IDs to dense ids, -1 for unknown IDs."""
+        ids = to_id_array(ids)
+        dense_ids = np.searchsorted(self.ids, ids).astype(np.int64)
+        dense_ids[~self.contains(ids)] = -1
+        return dense_ids
+
+    def from_dense(self, dense_ids):
+        """Map dense ids back to patient IDs."""
+        return self.ids[np.asarray(dense_ids, dtype=np.int64)]
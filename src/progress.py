@@ -0,0 +1,167 @@
+# Timer-sampled progress and throughput metrics of long loops
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Seconds between progress reports
+REPORT_INTERVAL = 10
+
+# Metrics samples of every Progress are appended to this JSONL file, if set,
+# e.g. by configure() or the PROGRESS_METRICS_PATH environment variable
+metrics_path = os.environ.get("PROGRESS_METRICS_PATH")
+metrics_lock = threading.Lock()
+
+
+def configure(path=None, interval=None):
+    """Set the default metrics file and report interval of new Progresses."""
+    global metrics_path, REPORT_INTERVAL
+    metrics_path = path
+    if interval is not None:
+        REPORT_INTERVAL = interval
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class Progress:
+    """Progress of a loop: items/s, bytes/s, ETA and counters.
+
+    The loop only adds to num_items/num_bytes, with update() or directly,
+    and keeps its counts in counters. A daemon thread samples them every
+    interval seconds, prints a report and appends it to the metrics file.
+    With threaded=False nothing runs in the background, update() checks the
+    clock instead: use it when updates are coarse, e.g. per chunk, or when
+    processes are forked during the loop.
+    """
+
+    def __init__(
+        self,
+        name,
+        total=None,
+        total_bytes=None,
+        counters=None,
+        interval=None,
+        path=None,
+        threaded=True,
+        unit="items",
+    ):
+        self.name = name
+        self.unit = unit
+        self.total = total
+        self.total_bytes = total_bytes
+        self.counters = Counter() if counters is None else counters
+        self.interval = REPORT_INTERVAL if interval is None else interval
+        self.path = metrics_path if path is None else path
+        self.threaded = threaded
+        self.num_items = 0
+        self.num_bytes = 0
+        self.start_time = None
+        self.last_time = None
+        self.last_items = 0
+        self.last_bytes = 0
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        self.last_time = self.start_time
+        if self.threaded:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+        self.sample(final=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def update(self, num_items=1, num_bytes=0):
+        self.num_items += num_items
+        self.num_bytes += num_bytes
+        if not self.threaded:
+            if time.perf_counter() - self.last_time >= self.interval:
+                self.sample()
+
+    def track(self, iterable):
+        """Yield the items of iterable, counting them."""
+        for item in iterable:
+            yield item
+            self.num_items += 1
+
+    def get_eta(self, items_per_s, bytes_per_s):
+        """Seconds left at the recent rate, from bytes if their total is known."""
+        if self.total_bytes and bytes_per_s:
+            return max(self.total_bytes - self.num_bytes, 0) / bytes_per_s
+        if self.total and items_per_s:
+            return max(self.total - self.num_items, 0) / items_per_s
+        return None
+
+    def sample(self, final=False):
+        now = time.perf_counter()
+        num_items = self.num_items
+        num_bytes = self.num_bytes
+        elapsed = max(now - self.start_time, 1e-9)
+        window = max(now - self.last_time, 1e-9)
+        items_per_s = (num_items - self.last_items) / window
+        bytes_per_s = (num_bytes - self.last_bytes) / window
+        if final:
+            items_per_s = num_items / elapsed
+            bytes_per_s = num_bytes / elapsed
+        self.last_time = now
+        self.last_items = num_items
+        self.last_bytes = num_bytes
+
+        sample = {
+            "name": self.name,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "final": final,
+            "elapsed_s": elapsed,
+            "num_items": num_items,
+            "total": self.total,
+            "items_per_s": items_per_s,
+            "num_bytes": num_bytes,
+            "total_bytes": self.total_bytes,
+            "bytes_per_s": bytes_per_s,
+            "eta_s": 0.0 if final else self.get_eta(items_per_s, bytes_per_s),
+            "unit": self.unit,
+            "counters": dict(self.counters),
+        }
+        self.samples.append(sample)
+        self.report(sample)
+        if self.path:
+            with metrics_lock, open(self.path, "a") as f:
+                f.write(json.dumps(sample, default=str))
+                f.write("\n")
+        return sample
+
+    def report(self, sample):
+        total_str = f"/{sample['total']}" if sample["total"] else ""
+        report = (
+            f"{datetime.now():%Y-%m-%d %H:%M:%S} {self.name}: "
+            f"{sample['num_items']}{total_str} {self.unit} "
+            f"({sample['items_per_s']:.0f} {self.unit}/s"
+        )
+        if sample["num_bytes"]:
+            report += f", {sample['bytes_per_s'] / 1e6:.1f} MB/s"
+        report += ")"
+        if sample["final"]:
+            report += f" in {format_duration(sample['elapsed_s'])}"
+        else:
+            report += f", ETA {format_duration(sample['eta_s'])}"
+        if sample["counters"]:
+            report += f", {sample['counters']}"
+        print(report, flush=True)
@@ -0,0 +1,129 @@
+# On-disk LRU cache of analysis results keyed by DB fingerprint and query
+import glob
+import hashlib
+import json
+import os
+import pickle
+import time
+import zlib
+
+# Bump to invalidate every cached result when what's computed changes
+CACHE_VERSION = 1
+
+# Default size limit of a cache dir
+MAX_CACHE_MB = 2048
+
+# zlib level of cached results, fast rather than small
+COMPRESSION_LEVEL = 1
+
+CACHE_EXTENSION = ".pkl.z"
+
+
+def get_file_fingerprint(path):
+    """Fingerprint of a file, e.g. a PatientDB dump, by path, size and mtime."""
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+    fingerprint = f"{abs_path}-{stat.st_size}-{stat.st_mtime_ns}"
+    return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+
+
+def canonicalize(obj):
+    """JSON-able form of a query where sets and dict order don't matter."""
+    if isinstance(obj, dict):
+        return {str(key): canonicalize(value) for key, value in obj.items()}
+    if isinstance(obj, (set, frozenset)):
+        return sorted(canonicalize(value) for value in obj)
+    if isinstance(obj, (list, tuple)):
+        return [canonicalize(value) for value in obj]
+    return obj
+
+
+def get_query_hash(query):
+    query_json = json.dumps(canonicalize(query), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(query_json.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Results pickled and zlib compressed, one file per key.
+
+    A key is the hash of a DB fingerprint and a canonical query. Reading a
+    result touches its file, and after each write the least recently used
+    results are removed until the cache fits in max_mb.
+    """
+
+    def __init__(self, cache_dir, max_mb=MAX_CACHE_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 2**20)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, db_fingerprint, query):
+        key = f"{CACHE_VERSION}-{db_fingerprint}-{get_query_hash(query)}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}{CACHE_EXTENSION}")
+
+    def contains(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def get(self, key, default=None):
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return default
+        # Reads are accesses of the LRU order
+        os.utime(path)
+        start_time = time.perf_counter()
+        result = pickle.loads(zlib.decompress(data))
+        elapsed = time.perf_counter() - start_time
+        print(
+            f"Loaded cached result {key} ({len(data) / 2**20:.1f} MB) in {elapsed:.2f}s",
+            flush=True,
+        )
+        return result
+
+    def put(self, key, result):
+        data = zlib.compress(
+            pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), COMPRESSION_LEVEL
+        )
+        path = self.get_path(key)
+        # Write to a temporary file first so readers never see a partial file
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        print(f"Cached result {key} ({len(data) / 2**20:.1f} MB)", flush=True)
+        self.evict(keep_path=path)
+
+    def get_or_compute(self, key, compute):
+        """The cached result of key, or compute() cached."""
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def evict(self, keep_path=None):
+        """Remove least recently used results until the cache fits."""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, f"*{CACHE_EXTENSION}")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            # The result just written stays, even if it alone doesn't fit
+            if path == keep_path:
+                continue
+            print(f"Evicting cached result {path}", flush=True)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
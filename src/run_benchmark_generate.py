@@ -0,0 +1,147 @@
+import argparse
+import glob
+import json
+import os
+import shlex
+import shutil
+import sys
+
+from benchmark import dump_results, measure, measure_command
+from synthetic_omop import write_synthetic_inputs
+
+
+def get_command_line_args():
+    parser = argparse.ArgumentParser()
+
+    # Scale of the synthetic inputs
+    parser.add_argument("--num_patients", type=int, default=10000)
+    parser.add_argument("--num_meddra_rows", type=int, default=100000)
+    parser.add_argument("--num_drug_exposure_rows", type=int, default=50000)
+    parser.add_argument("--num_meddra_frames", type=int, default=4)
+    parser.add_argument("--num_drug_exposure_frames", type=int, default=2)
+    parser.add_argument("--num_meddra_terms", type=int, default=2000)
+    parser.add_argument("--num_drugs", type=int, default=500)
+    parser.add_argument("--zipf_exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--num_null_id_rows",
+        type=int,
+        default=0,
+        help="Drug exposures without a person_id, e.g. to check --compact_dtypes",
+    )
+
+    # Runs
+    parser.add_argument("--num_repeats", type=int, default=1)
+    parser.add_argument(
+        "--reuse_inputs",
+        action="store_true",
+        help="Don't regenerate the synthetic inputs if they exist with the same scale",
+    )
+    parser.add_argument(
+        "--run_generate_args",
+        default="",
+        help='More run_generate.py arguments, e.g. "--use_dask --num_read_workers 4"',
+    )
+
+    # Dirs
+    parser.add_argument(
+        "--output_dir",
+        default="/tmp/benchmark_generate",
+        help="Output dir for the synthetic inputs, PatientDB dumps and results.json",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    return args
+
+
+def get_input_stats(input_paths):
+    """Total size in MB of the generate_patient_db() input files."""
+    paths = [input_paths["demographics_path"]]
+    for key in ["meddra_extractions_dir", "drug_exposure_dir", "concept_dir"]:
+        paths += glob.glob(f"{input_paths[key]}/*")
+    return {
+        "num_input_files": len(paths),
+        "input_mb": sum(os.path.getsize(path) for path in paths) / 1e6,
+    }
+
+
+def load_generate_kwargs(inputs_dir):
+    """Arguments the inputs in inputs_dir were written with, None if unknown."""
+    path = f"{inputs_dir}/generate_kwargs.json"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_inputs(inputs_dir, generate_kwargs):
+    """Write the synthetic inputs and the arguments they were written with."""
+    input_paths = write_synthetic_inputs(inputs_dir, **generate_kwargs)
+    with open(f"{inputs_dir}/generate_kwargs.json", "w") as f:
+        json.dump(generate_kwargs, f, indent=2)
+    return input_paths
+
+
+def main(args):
+    print(f"\nargs: {args}\n")
+    inputs_dir = f"{args.output_dir}/inputs"
+    records = []
+    generate_kwargs = dict(
+        num_patients=args.num_patients,
+        num_meddra_rows=args.num_meddra_rows,
+        num_drug_exposure_rows=args.num_drug_exposure_rows,
+        num_meddra_frames=args.num_meddra_frames,
+        num_drug_exposure_frames=args.num_drug_exposure_frames,
+        seed=args.seed,
+        num_meddra_terms=args.num_meddra_terms,
+        num_drugs=args.num_drugs,
+        zipf_exponent=args.zipf_exponent,
+        num_null_id_rows=args.num_null_id_rows,
+    )
+    saved_kwargs = load_generate_kwargs(inputs_dir) if args.reuse_inputs else None
+    if args.reuse_inputs and saved_kwargs != generate_kwargs:
+        print(f"No inputs written with these arguments in {inputs_dir}, writing them")
+    if saved_kwargs == generate_kwargs:
+        input_paths = {
+            "demographics_path": f"{inputs_dir}/demographics.parquet",
+            "meddra_extractions_dir": f"{inputs_dir}/labeled_extractions",
+            "drug_exposure_dir": f"{inputs_dir}/drug_exposure",
+            "concept_dir": f"{inputs_dir}/concept",
+        }
+    else:
+        # Frames of a previous scale would be read with the new ones
+        if os.path.exists(inputs_dir):
+            shutil.rmtree(inputs_dir)
+        input_paths, record = measure(
+            "write_synthetic_inputs",
+            write_inputs,
+            inputs_dir,
+            generate_kwargs,
+        )
+        records.append(record)
+    input_stats = get_input_stats(input_paths)
+    num_input_rows = args.num_meddra_rows + args.num_drug_exposure_rows
+
+    run_generate_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "run_generate.py"
+    )
+    patient_db_dir = f"{args.output_dir}/patient_db"
+    os.makedirs(patient_db_dir, exist_ok=True)
+    command = [sys.executable, run_generate_path]
+    for key, path in input_paths.items():
+        command += [f"--{key}", path]
+    command += ["--output_dir", patient_db_dir]
+    command += shlex.split(args.run_generate_args)
+
+    for repeat in range(args.num_repeats):
+        record = measure_command("run_generate", command)
+        record["repeat"] = repeat
+        record["num_input_rows"] = num_input_rows
+        record.update(input_stats)
+        record["input_rows_per_s"] = num_input_rows / record["wall_s"]
+        record["input_mb_per_s"] = input_stats["input_mb"] / record["wall_s"]
+        records.append(record)
+    dump_results(f"{args.output_dir}/results.json", records, vars(args))
+
+
+if __name__ == "__main__":
+    main(get_command_line_args())
@@ -0,0 +1,236 @@
+import argparse
+import os
+
+from benchmark import dump_results, measure
+from bump_chart import (
+    count_drug_categories,
+    create_drug_category_index,
+    get_visit_months,
+    load_json,
+)
+from convert_json_to_jsonl import chunk_big_json, convert_big_json_parallel
+from ingest_jsonl import create_cohorts, main as ingest_main, main_cohorts
+from patient_attributes import PatientAttributeIndex
+from synthetic_nlp import write_synthetic_nlp_inputs
+
+
+def get_command_line_args():
+    parser = argparse.ArgumentParser()
+
+    # Scale of the synthetic inputs
+    parser.add_argument("--num_patients", type=int, default=10000)
+    parser.add_argument("--visits_per_patient", type=float, default=3.0)
+    parser.add_argument("--sections_per_visit", type=float, default=4.0)
+    parser.add_argument("--entities_per_section", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+    # Runs
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--num_repeats", type=int, default=1)
+    parser.add_argument(
+        "--reuse_inputs",
+        action="store_true",
+        help="Don't regenerate the synthetic inputs if they already exist",
+    )
+
+    # Dirs
+    parser.add_argument(
+        "--output_dir",
+        default="/tmp/benchmark_ingest",
+        help="Output dir for the synthetic inputs, outputs and results.json",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    return args
+
+
+def count_lines(path):
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def add_throughput(record, num_lines, input_path):
+    """Add lines/s, MB/s of input_path and the peak RSS to a record."""
+    input_mb = os.path.getsize(input_path) / 1e6
+    record["num_lines"] = num_lines
+    record["input_mb"] = input_mb
+    record["lines_per_s"] = num_lines / record["wall_s"]
+    record["mb_per_s"] = input_mb / record["wall_s"]
+    print(
+        f"{record['name']}: {record['lines_per_s']:.0f} lines/s, "
+        f"{record['mb_per_s']:.1f} MB/s, peak_rss_mb: {record['peak_rss_mb']:.1f}",
+        flush=True,
+    )
+    return record
+
+
+def run_ingest(input_path, output_dir, patient_attributes, num_workers):
+    """ingest_jsonl.main() without any cohort filters."""
+    ingest_main(
+        input_path,
+        f"{output_dir}/ingested.jsonl",
+        output_dir,
+        "synthetic",
+        False,
+        None,
+        patient_attributes.get_map("gender"),
+        False,
+        None,
+        patient_attributes.get_map("length_of_stay"),
+        False,
+        [],
+        patient_attributes.get_map("race"),
+        False,
+        None,
+        patient_attributes.get_map("survivor"),
+        False,
+        False,
+        True,
+        num_workers=num_workers,
+    )
+
+
+def run_ingest_cohorts(input_path, output_dir, patient_attributes, num_workers):
+    """ingest_jsonl.main_cohorts() over every gender x survivor cohort."""
+    cohorts = create_cohorts(
+        genders=[None]
+        + sorted(patient_attributes.get_unique_values("gender") - {None}),
+        lengths_of_stay=[None],
+        race_groups=[None],
+        survivor_classes=[None, True, False],
+    )
+    main_cohorts(
+        input_path,
+        output_dir,
+        "ingested",
+        "synthetic",
+        cohorts,
+        patient_attributes.get_map("gender"),
+        patient_attributes.get_map("length_of_stay"),
+        patient_attributes.get_map("race"),
+        patient_attributes.get_map("survivor"),
+        False,
+        False,
+        True,
+        num_workers=num_workers,
+        resolutions=["week", "month"],
+    )
+    return len(cohorts)
+
+
+def run_bump_chart(patient_kg_path, patient_kg_labels_path, nlp_jsonl_path):
+    patient_kg = load_json(patient_kg_path)
+    drug_category_index = create_drug_category_index(load_json(patient_kg_labels_path))
+    visit_months = get_visit_months(nlp_jsonl_path)
+    count_drug_categories(patient_kg, drug_category_index, visit_months)
+    return len(patient_kg)
+
+
+def run_benchmarks(input_paths, args, repeat):
+    """Benchmark every consumer of the synthetic inputs, returns the records."""
+    records = []
+    num_patients = count_lines(input_paths["nlp_jsonl_path"])
+    # patient_kg.json is a single line, count its visits instead
+    num_visits = len(load_json(input_paths["patient_kg_path"]))
+
+    def run(name, num_lines, input_path, fn, *fn_args, **fn_kwargs):
+        result, record = measure(name, fn, *fn_args, **fn_kwargs)
+        record["repeat"] = repeat
+        records.append(add_throughput(record, num_lines, input_path))
+        return result
+
+    nlp_json_path = input_paths["nlp_json_path"]
+    run(
+        "chunk_big_json",
+        num_patients,
+        nlp_json_path,
+        chunk_big_json,
+        nlp_json_path,
+        f"{args.output_dir}/chunk_big_json",
+        "nlp_patients",
+        1000,
+    )
+    run(
+        "convert_big_json_parallel",
+        num_patients,
+        nlp_json_path,
+        convert_big_json_parallel,
+        nlp_json_path,
+        f"{args.output_dir}/convert_big_json_parallel",
+        "nlp_patients",
+        args.num_workers,
+    )
+
+    patient_kg_path = input_paths["patient_kg_path"]
+    patient_attributes = run(
+        "patient_attributes",
+        num_visits,
+        patient_kg_path,
+        PatientAttributeIndex.from_patient_kg_path,
+        patient_kg_path,
+    )
+
+    ingest_dir = f"{args.output_dir}/ingest_jsonl"
+    os.makedirs(ingest_dir, exist_ok=True)
+    nlp_jsonl_path = input_paths["nlp_jsonl_path"]
+    run(
+        "ingest_jsonl",
+        num_patients,
+        nlp_jsonl_path,
+        run_ingest,
+        nlp_jsonl_path,
+        ingest_dir,
+        patient_attributes,
+        args.num_workers,
+    )
+    run(
+        "ingest_jsonl_cohorts",
+        num_patients,
+        nlp_jsonl_path,
+        run_ingest_cohorts,
+        nlp_jsonl_path,
+        ingest_dir,
+        patient_attributes,
+        args.num_workers,
+    )
+
+    run(
+        "bump_chart",
+        num_visits,
+        patient_kg_path,
+        run_bump_chart,
+        patient_kg_path,
+        input_paths["patient_kg_labels_path"],
+        nlp_jsonl_path,
+    )
+    return records
+
+
+def main(args):
+    print(f"\nargs: {args}\n")
+    inputs_dir = f"{args.output_dir}/inputs"
+    records = []
+    input_paths = {
+        "nlp_jsonl_path": f"{inputs_dir}/nlp_patients.jsonl",
+        "nlp_json_path": f"{inputs_dir}/nlp_patients.json",
+        "patient_kg_path": f"{inputs_dir}/patient_kg.json",
+        "patient_kg_labels_path": f"{inputs_dir}/patient_kg_labels.json",
+    }
+    if not (args.reuse_inputs and os.path.exists(input_paths["nlp_jsonl_path"])):
+        input_paths, record = measure(
+            "write_synthetic_nlp_inputs",
+            write_synthetic_nlp_inputs,
+            inputs_dir,
+            num_patients=args.num_patients,
+            seed=args.seed,
+            visits_per_patient=args.visits_per_patient,
+            sections_per_visit=args.sections_per_visit,
+            entities_per_section=args.entities_per_section,
+        )
+        records.append(record)
+    for repeat in range(args.num_repeats):
+        records.extend(run_benchmarks(input_paths, args, repeat))
+    dump_results(f"{args.output_dir}/results.json", records, vars(args))
+
+
+if __name__ == "__main__":
+    main(get_command_line_args())
@@ -0,0 +1,134 @@
+import argparse
+import os
+
+from benchmark import dump_results, measure
+from patient_db import PatientDB, get_unique_match_patient_visits
+from patient_query import QueryIndex, Term
+from synthetic_patient_db import MENTAL_HEALTH_TERMS, generate_synthetic_patient_db
+
+# Same terms and roles as run_q1()
+MATCH_TERMS = list(MENTAL_HEALTH_TERMS)
+EVENT_TYPE_ROLES = {
+    "DiagnosisEvent": {"diagnosis_name", "concept_text"},
+    "MEDDRAEvent": {"concept_text"},
+}
+COUNTER_EVENT_TYPES = ["DiagnosisEvent", "MEDDRAEvent"]
+
+
+def get_command_line_args():
+    parser = argparse.ArgumentParser()
+
+    # Scales, a run per number of events
+    parser.add_argument(
+        "--num_events", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--events_per_visit", type=float, default=4.0)
+    parser.add_argument("--visits_per_patient", type=float, default=5.0)
+    parser.add_argument("--num_meddra_terms", type=int, default=2000)
+    parser.add_argument("--num_drugs", type=int, default=500)
+    parser.add_argument("--zipf_exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num_repeats", type=int, default=1)
+    parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Also measure Python allocations with tracemalloc, much slower",
+    )
+
+    # Dirs
+    parser.add_argument(
+        "--output_dir",
+        default="/tmp/benchmark_patient_db",
+        help="Output dir for the PatientDB dumps and results.json",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    return args
+
+
+def get_scale(num_events, events_per_visit, visits_per_patient):
+    num_visits = max(1, int(num_events / events_per_visit))
+    num_patients = max(1, int(num_visits / visits_per_patient))
+    return {
+        "num_patients": num_patients,
+        "num_visits": num_visits,
+        "num_events": num_events,
+    }
+
+
+def run_benchmarks(scale, args, repeat):
+    """Benchmark the PatientDB methods at one scale, returns the records."""
+    records = []
+
+    def run(name, fn, *fn_args, **fn_kwargs):
+        result, record = measure(
+            name, fn, *fn_args, trace_memory=args.trace_memory, **fn_kwargs
+        )
+        record.update(scale)
+        record["repeat"] = repeat
+        records.append(record)
+        return result
+
+    generate_kwargs = dict(
+        seed=args.seed,
+        num_meddra_terms=args.num_meddra_terms,
+        num_drugs=args.num_drugs,
+        zipf_exponent=args.zipf_exponent,
+        **scale,
+    )
+    patients = run("generate", generate_synthetic_patient_db, **generate_kwargs)
+
+    dump_name = f"patients_{scale['num_events']}.jsonl"
+    run("dump", patients.dump, args.output_dir, dump_name)
+    del patients
+
+    # Everything after load runs on the loaded DB, like the analyses do
+    loaded_patients = PatientDB(name="loaded")
+    run("load", loaded_patients.load, f"{args.output_dir}/{dump_name}")
+    matches = run(
+        "match_terms", loaded_patients.match_terms, MATCH_TERMS, EVENT_TYPE_ROLES
+    )
+    query_index = run("query_index", QueryIndex.from_patient_db, loaded_patients)
+    # Cold builds the postings of the queried roles, warm reuses them
+    for name in ["query_matches_cold", "query_matches_warm"]:
+        run(
+            name,
+            query_index.get_matches,
+            Term(MATCH_TERMS, EVENT_TYPE_ROLES, exact=True),
+        )
+    del query_index
+    run(
+        "get_event_counters",
+        loaded_patients.get_event_counters,
+        COUNTER_EVENT_TYPES,
+        meddra_roles=True,
+    )
+    run(
+        "get_event_counters_from_matches",
+        loaded_patients.get_event_counters_from_matches,
+        matches,
+        EVENT_TYPE_ROLES,
+        EVENT_TYPE_ROLES,
+        patient_visits=get_unique_match_patient_visits(matches),
+    )
+    # agg_time re-adds visits and events to its splits, so it runs last
+    run("agg_time", loaded_patients.agg_time, "M")
+    del loaded_patients
+
+    detached_patients = generate_synthetic_patient_db(attach=False, **generate_kwargs)
+    run("attach_events_to_visits", detached_patients.attach_events_to_visits)
+    return records
+
+
+def main(args):
+    print(f"\nargs: {args}\n")
+    os.makedirs(args.output_dir, exist_ok=True)
+    records = []
+    for num_events in args.num_events:
+        scale = get_scale(num_events, args.events_per_visit, args.visits_per_patient)
+        for repeat in range(args.num_repeats):
+            records.extend(run_benchmarks(scale, args, repeat))
+    dump_results(f"{args.output_dir}/results.json", records, vars(args))
+
+
+if __name__ == "__main__":
+    main(get_command_line_args())
@@ -1,5 +1,9 @@
 import argparse
+
+import progress
+from benchmark import get_profile_path
 from generate import generate_patient_db
+from generate_dask import generate_patient_db_dask
 
 
 def get_command_line_args():
@@ -9,6 +13,58 @@ def get_command_line_args():
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--use_dask", action="store_true")
     parser.add_argument("--sample_column_values", action="store_true")
+    parser.add_argument(
+        "--compact_dtypes",
+        action="store_true",
+        help="Use categoricals and downcast numerics in pandas tables",
+    )
+    parser.add_argument(
+        "--dask_pipeline",
+        action="store_true",
+        help="Run the whole pipeline per patient partition on dask workers",
+    )
+
+    # Dask pipeline options
+    parser.add_argument("--num_partitions", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument(
+        "--scheduler_address",
+        default=None,
+        help="Address of a dask scheduler, starts a local cluster if not set",
+    )
+    parser.add_argument("--keep_partitions", action="store_true")
+
+    # Stage instrumentation
+    parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Report the top tracemalloc allocators of every stage, slows runs down",
+    )
+    parser.add_argument(
+        "--profile_path",
+        default=None,
+        help="Stage timing/memory JSON report, a new one in output_dir if not set",
+    )
+
+    # Date range, "%Y-%m-%d", of extractions and drug exposures to read
+    parser.add_argument("--start_date", default=None)
+    parser.add_argument("--end_date", default=None)
+
+    # Number of threads reading table frames in parallel
+    parser.add_argument("--num_read_workers", type=int, default=1)
+
+    # Progress reports of long loops
+    parser.add_argument(
+        "--progress_interval",
+        type=float,
+        default=None,
+        help="Seconds between progress reports",
+    )
+    parser.add_argument(
+        "--progress_metrics_path",
+        default=None,
+        help="Append timed progress samples of long loops to this JSONL file",
+    )
 
     # Paths
     parser.add_argument(
@@ -30,6 +86,17 @@ def get_command_line_args():
         "--drug_exposure_dir", default="/share/pi/stamang/covid/data/drug_exposure"
     )
     parser.add_argument("--concept_dir", default="/share/pi/stamang/covid/data/concept")
+    parser.add_argument(
+        "--csv_cache_dir",
+        default=None,
+        help="Cache gzipped OMOP CSVs as parquet in this dir",
+    )
+    parser.add_argument(
+        "--patient_id_registry_path",
+        default=None,
+        help="Reuse the patient IDs of this .npy registry if the inputs and dates "
+        "are the same, else gather and dump them to it",
+    )
     parser.add_argument(
         "--output_dir",
         default="/home/colbyham/output/patient_db",
@@ -42,6 +109,25 @@ def get_command_line_args():
 
 def main(args):
     print(f"\nargs: {args}\n")
+    progress.configure(args.progress_metrics_path, args.progress_interval)
+    if args.dask_pipeline:
+        generate_patient_db_dask(
+            args.demographics_path,
+            args.meddra_extractions_dir,
+            args.drug_exposure_dir,
+            args.concept_dir,
+            args.output_dir,
+            args.debug,
+            args.num_partitions,
+            num_workers=args.num_workers,
+            scheduler_address=args.scheduler_address,
+            start_date=args.start_date,
+            end_date=args.end_date,
+            csv_cache_dir=args.csv_cache_dir,
+            keep_partitions=args.keep_partitions,
+        )
+        return
+
     generate_patient_db(
         args.demographics_path,
         args.meddra_extractions_dir,
@@ -50,6 +136,15 @@ def main(args):
         args.output_dir,
         args.debug,
         args.use_dask,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        num_read_workers=args.num_read_workers,
+        csv_cache_dir=args.csv_cache_dir,
+        patient_id_registry_path=args.patient_id_registry_path,
+        compact_dtypes=args.compact_dtypes,
+        profile_path=args.profile_path
+        or get_profile_path(args.output_dir, "generate_patient_db"),
+        trace_memory=args.trace_memory,
     )
 
 
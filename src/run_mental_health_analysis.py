@@ -1,11 +1,20 @@
 import argparse
 
 import pandas as pd
+from benchmark import StageProfiler, get_profile_path
 from omop import omop_concept
 
 from utils import get_df, get_table
-from mental_health_analysis import prepare_output_dirs, run_q1, run_q9
+from mental_health_analysis import (
+    get_q1_query,
+    get_q9_query,
+    prepare_output_dirs,
+    run_q1,
+    run_q9,
+)
 from patient_db import PatientDB
+from patient_query import QueryIndex
+from result_cache import MAX_CACHE_MB, ResultCache, get_file_fingerprint
 
 
 def get_command_line_args():
@@ -14,8 +23,18 @@ def get_command_line_args():
     # Bools
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--use_dask", action="store_true")
+    parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Report the top tracemalloc allocators of every stage, slows runs down",
+    )
 
     # Paths
+    parser.add_argument(
+        "--profile_path",
+        default=None,
+        help="Stage timing/memory JSON report, a new one in output_dir if not set",
+    )
     parser.add_argument(
         "--patient_db_path", help="Path to load patient_db dump from", required=True
     )
@@ -26,46 +45,98 @@ def get_command_line_args():
         default="/share/pi/stamang/covid/data/concept",
         help="Input dir to read in OMOP CONCEPT table",
     )
+    parser.add_argument(
+        "--csv_cache_dir",
+        default=None,
+        help="Cache gzipped OMOP CSVs as parquet in this dir",
+    )
     parser.add_argument(
         "--output_dir",
         default="/home/colbyham/output/mental_health_queries",
         help="Output dir to dump results",
     )
+    parser.add_argument(
+        "--result_cache_dir",
+        default=None,
+        help="Reuse the matches and counters of an unchanged PatientDB dump "
+        "cached in this dir",
+    )
+    parser.add_argument(
+        "--result_cache_mb",
+        type=float,
+        default=MAX_CACHE_MB,
+        help="Size of the result cache, least recently used results are evicted",
+    )
     args: argparse.Namespace = parser.parse_args()
     return args
 
 
-def main(args):
-    print("START OF PROGRAM\n")
-    # FIXME
+def run_analysis(args, profiler, run_config):
+    with profiler.stage("read_concept"):
+        concept_pattern = "*"
+        concept_pattern_re = ".*"
+        concept = omop_concept(
+            args.concept_dir,
+            prefix="concept",
+            pattern=concept_pattern,
+            pattern_re=concept_pattern_re,
+            extension=".csv",
+            use_dask=args.use_dask,
+            debug=args.debug,
+            cache_dir=args.csv_cache_dir,
+        )
+        # import pdb;pdb.set_trace()
 
-    concept_pattern = "*"
-    concept_pattern_re = ".*"
-    concept = omop_concept(
-        args.concept_dir,
-        prefix="concept",
-        pattern=concept_pattern,
-        pattern_re=concept_pattern_re,
-        extension=".csv",
-        use_dask=args.use_dask,
-        debug=args.debug,
-    )
-    # import pdb;pdb.set_trace()
+    question_one_terms = ["depression", "anxiety", "insomnia", "distress"]
 
-    # Create and load an instance of PatientDB
-    patients = PatientDB(name="all")
-    patients.load(args.patient_db_path)
+    # Matches and counters of an unchanged PatientDB dump are reused
+    result_cache = None
+    db_fingerprint = None
+    cached_queries = [
+        get_q1_query(question_one_terms),
+        get_q9_query(question_one_terms),
+    ]
+    if args.result_cache_dir:
+        result_cache = ResultCache(args.result_cache_dir, args.result_cache_mb)
+        db_fingerprint = get_file_fingerprint(args.patient_db_path)
+    all_cached = result_cache is not None and all(
+        result_cache.contains(result_cache.get_key(db_fingerprint, query))
+        for query in cached_queries
+    )
+    run_config["all_cached"] = all_cached
+
+    patients = None
+    query_index = None
+    if all_cached:
+        print("All results are cached, not loading the PatientDB", flush=True)
+    else:
+        # Create and load an instance of PatientDB
+        with profiler.stage("load_patient_db"):
+            patients = PatientDB(name="all")
+            patients.load(args.patient_db_path)
+
+        # Queries of all questions are answered from one index
+        with profiler.stage("index_patient_db"):
+            query_index = QueryIndex.from_patient_db(patients)
+            print(query_index, flush=True)
 
     # Make sure output dirs are created
     prepare_output_dirs(args.output_dir, num_questions=9, prefix="q")
 
     # Q1 - What are the co-morbidities associated with mental health?
-    question_one_terms = ["depression", "anxiety", "insomnia", "distress"]
-    (
-        question_one_matches,
-        question_one_event_type_roles,
-        question_one_cnt_event_type_roles,
-    ) = run_q1(patients, question_one_terms, f"{args.output_dir}/q1/top_k.jsonl")
+    with profiler.stage("q1"):
+        (
+            question_one_matches,
+            question_one_event_type_roles,
+            question_one_cnt_event_type_roles,
+        ) = run_q1(
+            patients,
+            question_one_terms,
+            f"{args.output_dir}/q1/top_k.jsonl",
+            query_index=query_index,
+            result_cache=result_cache,
+            db_fingerprint=db_fingerprint,
+        )
 
     # Q2 - What is the distribution of age groups for patients with major
     #      depression, anxiety, insomnia or distress?
@@ -103,13 +174,37 @@ def main(args):
     # run_q8()
 
     # Q9 - What are the top medications prescribed for patients with mental health related issues?
-    question_nine_top_k, question_nine_cnt_event_type_roles = run_q9(
-        patients,
-        question_one_matches,
-        question_one_event_type_roles,
-        concept,
-        f"{args.output_dir}/q9/top_k.jsonl",
-    )
+    with profiler.stage("q9"):
+        question_nine_top_k, question_nine_cnt_event_type_roles = run_q9(
+            patients,
+            question_one_matches,
+            question_one_event_type_roles,
+            concept,
+            f"{args.output_dir}/q9/top_k.jsonl",
+            result_cache=result_cache,
+            db_fingerprint=db_fingerprint,
+            search_terms=question_one_terms,
+        )
+
+
+def main(args):
+    print("START OF PROGRAM\n")
+    # FIXME
+
+    profiler = StageProfiler("mental_health_analysis", trace_memory=args.trace_memory)
+    run_config = {
+        "patient_db_path": args.patient_db_path,
+        "output_dir": args.output_dir,
+    }
+    # The stages run so far are reported even if a later one fails
+    try:
+        run_analysis(args, profiler, run_config)
+    finally:
+        profiler.dump(
+            args.profile_path
+            or get_profile_path(args.output_dir, "mental_health_analysis"),
+            run_config,
+        )
 
     print("END OF PROGRAM")
 
@@ -0,0 +1,47 @@
+import argparse
+import os
+import re
+
+from utils import warm_csv_cache
+
+
+def get_command_line_args():
+    parser = argparse.ArgumentParser()
+
+    # Dirs
+    parser.add_argument(
+        "--table_dirs",
+        nargs="+",
+        default=[
+            "/share/pi/stamang/covid/data/drug_exposure",
+            "/share/pi/stamang/covid/data/concept",
+        ],
+        help="Dirs with gzipped OMOP CSVs to convert",
+    )
+    parser.add_argument(
+        "--csv_cache_dir", help="Dir to write parquet caches to", required=True
+    )
+
+    # Options
+    parser.add_argument("--pattern_re", default=".*\\.csv.*")
+    parser.add_argument("--num_workers", type=int, default=1)
+    args: argparse.Namespace = parser.parse_args()
+    return args
+
+
+def main(args):
+    print(f"\nargs: {args}\n")
+    paths = []
+    for table_dir in args.table_dirs:
+        table_paths = [
+            os.path.join(table_dir, path)
+            for path in sorted(os.listdir(table_dir))
+            if re.match(args.pattern_re, path)
+        ]
+        print(f"Found {len(table_paths)} CSVs in {table_dir}")
+        paths.extend(table_paths)
+    warm_csv_cache(paths, args.csv_cache_dir, num_workers=args.num_workers)
+
+
+if __name__ == "__main__":
+    main(get_command_line_args())
@@ -1,6 +1,9 @@
 # library
+import argparse
 import datetime
+import os
 import random
+from collections import Counter
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -9,6 +12,13 @@ import seaborn as sns
 from dateutil import rrule
 from mpl_toolkits.mplot3d import Axes3D
 
+from patient_db import PatientDB
+from result_cache import get_file_fingerprint, get_query_hash
+
+AGE_BAND_YEARS = 10
+# Older patients go in the last age band
+MAX_AGE = 100
+
 
 def create_age_data():
     age_data = []
@@ -34,15 +44,184 @@ def create_age_df():
     return df
 
 
-def main():
-    # Get the data (csv file is hosted on the web)
-    url = "https://python-graph-gallery.com/wp-content/uploads/volcano.csv"
-    data = pd.read_csv(url)
+def get_patient_visit_months(patients, patient_ids=None):
+    """Age at the visit, visit month and gender of every patient visit month.
+
+    A patient with several visits in a month is only counted once. Patients
+    without a date of birth and visits without a date are left out.
+    """
+    c = Counter()
+    gender_codes = dict()
+    patient_rows = []
+    dobs = []
+    visit_dates = []
+    genders = []
+    for patient_row, patient in enumerate(patients.patients):
+        if patient_ids is not None and patient.patient_id not in patient_ids:
+            continue
+        c["patients"] += 1
+        if not patient.date_of_birth:
+            c["patients_without_dob"] += 1
+            continue
+        gender = gender_codes.setdefault(str(patient.gender or ""), len(gender_codes))
+        dob = patient.date_of_birth.isoformat()
+        for visit in patient.visits:
+            if not visit.date:
+                c["visits_without_date"] += 1
+                continue
+            patient_rows.append(patient_row)
+            dobs.append(dob)
+            visit_dates.append(visit.date.strftime("%Y-%m-%d"))
+            genders.append(gender)
+    print(f"{c}", flush=True)
+
+    dobs = np.array(dobs, dtype="datetime64[D]")
+    visit_dates = np.array(visit_dates, dtype="datetime64[D]")
+    # Full years old, like PatientDB.calculate_patient_ages
+    ages = (visit_dates - dobs).astype(np.int64) // 365
+    months = visit_dates.astype("datetime64[M]")
+    _, first = np.unique(
+        np.stack([np.array(patient_rows, dtype=np.int64), months.astype(np.int64)]),
+        axis=1,
+        return_index=True,
+    )
+    gender_names = np.array(list(gender_codes), dtype=str)
+    return (
+        ages[first],
+        months[first],
+        np.array(genders, dtype=np.int64)[first],
+        gender_names,
+    )
+
+
+def calculate_age_month_surface(
+    patients,
+    patient_ids=None,
+    split_by_gender=False,
+    age_band_years=AGE_BAND_YEARS,
+    max_age=MAX_AGE,
+):
+    """Count patients per age band x visit month in one pass over a PatientDB.
+
+    Returns a dict with int64 counts of shape (genders, age bands, months),
+    the gender names ("all" without split_by_gender), the first age of each
+    band and the YYYY-MM months from the first to the last visit month.
+    """
+    ages, months, genders, gender_names = get_patient_visit_months(
+        patients, patient_ids
+    )
+    valid = ages >= 0
+    ages, months, genders = ages[valid], months[valid], genders[valid]
+    if not split_by_gender:
+        genders = np.zeros(len(genders), dtype=np.int64)
+        gender_names = np.array(["all"], dtype=str)
+
+    age_bands = np.arange(0, max_age, age_band_years)
+    bands = np.minimum(ages // age_band_years, len(age_bands) - 1)
+    if len(months):
+        first_month = months.min()
+        month_range = np.arange(first_month, months.max() + 1)
+        month_cols = (months - first_month).astype(np.int64)
+    else:
+        month_range = np.array([], dtype="datetime64[M]")
+        month_cols = np.array([], dtype=np.int64)
+
+    shape = (len(gender_names), len(age_bands), len(month_range))
+    bins = np.ravel_multi_index((genders, bands, month_cols), shape)
+    counts = np.bincount(bins, minlength=int(np.prod(shape))).reshape(shape)
+    return {
+        "counts": counts.astype(np.int64),
+        "genders": gender_names,
+        "age_bands": age_bands,
+        "months": np.datetime_as_string(month_range, unit="M"),
+    }
+
+
+def dump_surface(path, surface):
+    print(f"Dumping age x month surface to {path}")
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    # np.savez adds .npz to paths without it, write to the exact path
+    with open(path, "wb") as f:
+        np.savez(f, **surface)
+
+
+def load_surface(path):
+    print(f"Loading age x month surface from {path}")
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
 
-    # age_data = [{''}]
-    age_df = create_age_df()
-    # age_df =
-    # age_df.columns = ["Age", "Month", "Patient Count"]
+
+def get_surface_parameters_hash(patient_ids=None, split_by_gender=False):
+    return get_query_hash(
+        {
+            "patient_ids": None if patient_ids is None else set(map(str, patient_ids)),
+            "split_by_gender": split_by_gender,
+            "age_band_years": AGE_BAND_YEARS,
+            "max_age": MAX_AGE,
+        }
+    )
+
+
+def load_or_create_surface(
+    path, patient_db_path, patient_ids=None, split_by_gender=False
+):
+    """Load a saved surface, only loading the PatientDB if there isn't one.
+
+    A saved surface is only reused if it was counted with the same
+    parameters and, when patient_db_path is given, from the same dump.
+    """
+    parameters_hash = get_surface_parameters_hash(patient_ids, split_by_gender)
+    db_fingerprint = None
+    if patient_db_path:
+        db_fingerprint = get_file_fingerprint(patient_db_path)
+    if os.path.exists(path):
+        surface = load_surface(path)
+        if str(surface.get("parameters_hash")) == parameters_hash and (
+            db_fingerprint is None
+            or str(surface.get("db_fingerprint")) == db_fingerprint
+        ):
+            return surface
+        print(f"Saved surface {path} is stale, counting it again", flush=True)
+    if not patient_db_path:
+        raise ValueError(f"A patient_db_path is needed to create {path}")
+    patients = PatientDB(name="surface")
+    patients.load(patient_db_path)
+    surface = calculate_age_month_surface(patients, patient_ids, split_by_gender)
+    surface["parameters_hash"] = np.array(parameters_hash)
+    surface["db_fingerprint"] = np.array(db_fingerprint or "")
+    dump_surface(path, surface)
+    return surface
+
+
+def surface_to_df(surface, gender=None):
+    """X/Y/Z rows of a surface like create_age_df(), all genders summed by default."""
+    if gender is None:
+        counts = surface["counts"].sum(axis=0)
+    else:
+        gender_i = surface["genders"].tolist().index(gender)
+        counts = surface["counts"][gender_i]
+    age_bands = surface["age_bands"]
+    months = surface["months"]
+    return pd.DataFrame(
+        {
+            "X": np.tile(months, len(age_bands)),
+            "Y": np.repeat(age_bands, len(months)),
+            "Z": counts.ravel(),
+        }
+    )
+
+
+def main(surface_path=None, patient_db_path=None, gender=None):
+    # Plot a saved surface, random data without one
+    if surface_path:
+        surface = load_or_create_surface(
+            surface_path, patient_db_path, split_by_gender=gender is not None
+        )
+        age_df = surface_to_df(surface, gender)
+    else:
+        age_df = create_age_df()
 
     # Transform it to a long format
     # df = data.unstack().reset_index()
@@ -57,7 +236,7 @@ def main():
 
     # Make the plot
     fig = plt.figure()
-    ax = fig.gca(projection="3d")
+    ax = fig.add_subplot(projection="3d")
     ax.plot_trisurf(df["Y"], df["X"], df["Z"], cmap=plt.cm.viridis, linewidth=0.2)
     plt.show()
 
@@ -77,5 +256,26 @@ def main():
     plt.show()
 
 
+def get_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--surface_path",
+        default=None,
+        help="Plot the .npz surface at this path, counting it if it's missing "
+        "or stale, random data if not set",
+    )
+    parser.add_argument(
+        "--patient_db_path", default=None, help="PatientDB dump to count from"
+    )
+    parser.add_argument(
+        "--gender",
+        default=None,
+        help="Only plot this gender, e.g. FEMALE, all genders if not set",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    return args
+
+
 if __name__ == "__main__":
-    main()
+    args = get_command_line_args()
+    main(args.surface_path, args.patient_db_path, args.gender)
@@ -0,0 +1,240 @@
+# Seeded synthetic NLP patients, patient_kg.json and patient_kg_labels.json
+import json
+import os
+
+import numpy as np
+
+from synthetic_patient_db import RACES, get_zipf_probabilities
+
+SECTION_HEADERS = [
+    "chief complaint",
+    "history of present illness",
+    "past medical history",
+    "medications",
+    "allergies",
+    "social history",
+    "family history",
+    "review of systems",
+    "physical exam",
+    "assessment and plan",
+]
+
+# Risk factors lead the vocabulary so the Zipfian draws hit them often
+RISK_FACTORS = [
+    "fever",
+    "cough",
+    "shortness of breath",
+    "hypertension",
+    "diabetes",
+    "obesity",
+    "smoking",
+    "asthma",
+    "copd",
+    "chronic kidney disease",
+]
+
+# Patient attribute values of patient_kg.json that ingest_jsonl.py filters on
+GENDERS = ["FEMALE", "MALE"]
+LENGTHS_OF_STAY = ["los_1_wk", "los_2_wks", "los_2-4_wks", "los_gt_4_wks"]
+
+DRUG_CATEGORIES = [
+    "analgesic",
+    "antibiotic",
+    "anticoagulant",
+    "antihypertensive",
+    "antiviral",
+    "bronchodilator",
+    "corticosteroid",
+    "diuretic",
+    "sedative",
+    "statin",
+]
+
+
+class NlpVocab:
+    """Entities of the synthetic notes, drawn from Zipf distributions."""
+
+    def __init__(self, num_risk_factors=500, num_snomed=2000, zipf_exponent=1.1):
+        self.risk_factors = RISK_FACTORS + [
+            f"risk factor {i}" for i in range(num_risk_factors - len(RISK_FACTORS))
+        ]
+        self.snomed = [f"snomed concept {i}" for i in range(num_snomed)]
+        self.risk_factor_p = get_zipf_probabilities(
+            len(self.risk_factors), zipf_exponent
+        )
+        self.snomed_p = get_zipf_probabilities(len(self.snomed), zipf_exponent)
+
+    def get_entities(self, rng, entities, p, num_entities):
+        entity_ids = rng.choice(len(entities), size=num_entities, p=p)
+        return [
+            {
+                "entity": entities[entity_id],
+                "text": entities[entity_id].upper(),
+                "start": int(10 * i),
+                "end": int(10 * i + len(entities[entity_id])),
+            }
+            for i, entity_id in enumerate(entity_ids)
+        ]
+
+
+def create_nlp_patient(
+    rng,
+    patient_id,
+    vocab,
+    visits_per_patient=3.0,
+    sections_per_visit=4.0,
+    entities_per_section=2.0,
+    empty_section_fraction=0.2,
+    start_date="2020-01-01",
+    num_days=366,
+    section_text_length=200,
+):
+    """An NLP patient, patients -> visits -> section_data entities."""
+    visits = []
+    num_visits = int(rng.poisson(visits_per_patient))
+    visit_days = np.sort(
+        np.datetime64(start_date, "D") + rng.integers(num_days, size=num_visits)
+    )
+    for visit_i, visit_day in enumerate(visit_days):
+        section_data = []
+        num_sections = max(1, int(rng.poisson(sections_per_visit)))
+        for section_i in range(num_sections):
+            section = {
+                "section_header": SECTION_HEADERS[section_i % len(SECTION_HEADERS)],
+                "section_text": "x" * section_text_length,
+            }
+            if rng.random() >= empty_section_fraction:
+                section["risk_factor_entity"] = vocab.get_entities(
+                    rng,
+                    vocab.risk_factors,
+                    vocab.risk_factor_p,
+                    max(1, int(rng.poisson(entities_per_section))),
+                )
+                section["snomed_entity"] = vocab.get_entities(
+                    rng,
+                    vocab.snomed,
+                    vocab.snomed_p,
+                    int(rng.poisson(entities_per_section)),
+                )
+            section_data.append(section)
+        visits.append(
+            {
+                "note_id": f"{patient_id}-{visit_i}",
+                "timestamp": f"{visit_day}T{int(rng.integers(24)):02d}:00:00",
+                "section_data": section_data,
+            }
+        )
+    return {"patient_id": patient_id, "visits": visits}
+
+
+def generate_nlp_patients(num_patients, seed=0, vocab=None, **patient_kwargs):
+    """Yield num_patients NLP patients with patient IDs "0", "1", ..."""
+    rng = np.random.default_rng(seed)
+    vocab = vocab or NlpVocab()
+    for patient_i in range(num_patients):
+        yield create_nlp_patient(rng, str(patient_i), vocab, **patient_kwargs)
+
+
+def write_nlp_jsonl(path, patients):
+    """Write NLP patients one per line, like ingest_jsonl.py reads them."""
+    print(f"Writing NLP patients to {path}", flush=True)
+    with open(path, "w") as f:
+        for patient in patients:
+            f.write(json.dumps(patient))
+            f.write("\n")
+
+
+def write_nlp_big_json(path, patients, indent=2):
+    """Write NLP patients as one pretty-printed JSON object keyed by patient ID.
+
+    This is the monolithic input chunk_big_json() splits, patients don't
+    repeat their patient_id. Patients are written one at a time.
+    """
+    print(f"Writing pretty-printed NLP patients to {path}", flush=True)
+    pad = " " * indent
+    with open(path, "w") as f:
+        f.write("{")
+        for patient_i, patient in enumerate(patients):
+            patient = dict(patient)
+            patient_id = patient.pop("patient_id")
+            patient_json = json.dumps(patient, indent=indent).replace("\n", f"\n{pad}")
+            separator = "," if patient_i else ""
+            f.write(f"{separator}\n{pad}{json.dumps(patient_id)}: {patient_json}")
+        f.write("\n}\n")
+
+
+def generate_patient_kg_labels(num_drugs=500, num_other_labels=500):
+    """patient_kg_labels.json entries, drug labels have drug categories."""
+    labels = []
+    for i in range(num_drugs):
+        categories = [DRUG_CATEGORIES[i % len(DRUG_CATEGORIES)]]
+        if i % 7 == 0:
+            categories.append(DRUG_CATEGORIES[(i + 3) % len(DRUG_CATEGORIES)])
+        labels.append(
+            {
+                "label": f"drug{i}",
+                "entity_id": f"RX{i:06d}",
+                "drug_category": categories,
+            }
+        )
+    for i in range(num_other_labels):
+        labels.append({"label": f"finding {i}", "entity_id": f"F{i:06d}"})
+    return labels
+
+
+def generate_patient_kg(
+    num_patients, seed=0, num_drugs=500, visits_per_patient=1.5, rx_per_visit=4.0
+):
+    """patient_kg.json entries, one per patient visit with attributes and rx."""
+    rng = np.random.default_rng(seed)
+    drug_p = get_zipf_probabilities(num_drugs)
+    patient_kg = []
+    for patient_i in range(num_patients):
+        gender = GENDERS[int(rng.integers(len(GENDERS)))]
+        race = RACES[int(rng.integers(len(RACES)))]
+        for visit_i in range(max(1, int(rng.poisson(visits_per_patient)))):
+            drugs = rng.choice(num_drugs, size=int(rng.poisson(rx_per_visit)), p=drug_p)
+            patient_kg.append(
+                {
+                    "graph_id": f"{patient_i}_{visit_i}",
+                    "attr": {"gender": gender, "race": race},
+                    "outcome": {
+                        "length_of_stay": LENGTHS_OF_STAY[
+                            int(rng.integers(len(LENGTHS_OF_STAY)))
+                        ],
+                        "survivor": bool(rng.random() < 0.9),
+                    },
+                    "rx": [f"RX{drug:06d}" for drug in drugs],
+                }
+            )
+    return patient_kg
+
+
+def write_synthetic_nlp_inputs(
+    output_dir, num_patients=10000, seed=0, **patient_kwargs
+):
+    """Write the NLP JSONL, its monolithic JSON twin, patient_kg.json and
+    patient_kg_labels.json of the same patients. Returns their paths."""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        "nlp_jsonl_path": f"{output_dir}/nlp_patients.jsonl",
+        "nlp_json_path": f"{output_dir}/nlp_patients.json",
+        "patient_kg_path": f"{output_dir}/patient_kg.json",
+        "patient_kg_labels_path": f"{output_dir}/patient_kg_labels.json",
+    }
+    vocab = NlpVocab()
+    write_nlp_jsonl(
+        paths["nlp_jsonl_path"],
+        generate_nlp_patients(num_patients, seed, vocab, **patient_kwargs),
+    )
+    write_nlp_big_json(
+        paths["nlp_json_path"],
+        generate_nlp_patients(num_patients, seed, vocab, **patient_kwargs),
+    )
+    print(f"Writing patient_kg to {paths['patient_kg_path']}", flush=True)
+    with open(paths["patient_kg_path"], "w") as f:
+        json.dump(generate_patient_kg(num_patients, seed), f)
+    print(f"Writing patient_kg labels to {paths['patient_kg_labels_path']}", flush=True)
+    with open(paths["patient_kg_labels_path"], "w") as f:
+        json.dump(generate_patient_kg_labels(), f)
+    return paths
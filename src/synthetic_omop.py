@@ -0,0 +1,266 @@
+# Seeded synthetic generate_patient_db() input tables, no PHI
+import os
+
+import numpy as np
+import pandas as pd
+
+from generate import DEMOGRAPHICS_COLUMNS, MEDDRA_EXTRACTIONS_COLUMNS
+from omop import DRUG_EXPOSURE_COLUMNS
+from synthetic_patient_db import (
+    ETHNICITIES,
+    GENDERS,
+    RACES,
+    create_drug_vocab,
+    create_meddra_vocab,
+    get_zipf_probabilities,
+)
+
+# Concept IDs the synthetic drug exposures refer to besides drugs
+DRUG_TYPE_CONCEPT_ID = 38000177
+ROUTE_CONCEPT_ID = 4132161
+
+# Concept classes of CONCEPT rows that aren't Clinical Drugs, which
+# get_medication_events() skips
+OTHER_CONCEPT_CLASS_IDS = ["Ingredient", "Branded Drug", "Drug Product", "Undefined"]
+
+
+def get_day_strs(rng, num_rows, start_date, num_days):
+    days = np.datetime64(start_date, "D") + rng.integers(num_days, size=num_rows)
+    return np.datetime_as_string(days, unit="D")
+
+
+def generate_meddra_extractions(
+    rng, patient_ids, num_rows, meddra_vocab, start_date, num_days, zipf_exponent
+):
+    """all_POS_batch rows with MEDDRA_EXTRACTIONS_COLUMNS, Zipfian terms."""
+    terms = rng.choice(
+        len(meddra_vocab),
+        size=num_rows,
+        p=get_zipf_probabilities(len(meddra_vocab), zipf_exponent),
+    )
+    vocab_df = pd.DataFrame(meddra_vocab)
+    df = vocab_df.iloc[terms].reset_index(drop=True)
+    df["patid"] = rng.choice(patient_ids, size=num_rows)
+    df["date"] = get_day_strs(rng, num_rows, start_date, num_days)
+    df["extracted_CUI"] = df["PT_CUI"]
+    df["PExperiencer"] = "patient"
+    df["medID"] = np.arange(num_rows).astype(str)
+    df["note_id"] = (np.arange(num_rows) // 4).astype(str)
+    df["note_title"] = "Progress Note"
+    df["polarity"] = np.where(rng.random(num_rows) < 0.1, "negative", "positive")
+    df["pos"] = "NOUN"
+    df["present"] = np.where(rng.random(num_rows) < 0.9, "present", "absent")
+    df["ttype"] = "ProblemMention"
+    return df[MEDDRA_EXTRACTIONS_COLUMNS]
+
+
+def generate_drug_exposure(
+    rng,
+    patient_ids,
+    num_rows,
+    drug_vocab,
+    start_date,
+    num_days,
+    zipf_exponent,
+    num_null_id_rows=0,
+):
+    """DRUG_EXPOSURE rows with DRUG_EXPOSURE_COLUMNS, Zipfian drugs.
+
+    The first num_null_id_rows rows have no person_id, like rows of the real
+    table that make pandas read person_id as floats.
+    """
+    drugs = rng.choice(
+        len(drug_vocab),
+        size=num_rows,
+        p=get_zipf_probabilities(len(drug_vocab), zipf_exponent),
+    )
+    drug_concept_ids = np.array([concept_id for concept_id, _ in drug_vocab])
+    drug_names = np.array([concept_name for _, concept_name in drug_vocab])
+    start_days = np.datetime64(start_date, "D") + rng.integers(num_days, size=num_rows)
+    days_supply = rng.integers(1, 91, size=num_rows)
+    end_days = start_days + days_supply
+    start_strs = np.datetime_as_string(start_days, unit="D")
+    end_strs = np.datetime_as_string(end_days, unit="D")
+    df = pd.DataFrame(
+        {
+            "drug_exposure_id": np.arange(num_rows),
+            "person_id": rng.choice(patient_ids, size=num_rows),
+            "drug_concept_id": drug_concept_ids[drugs],
+            "drug_exposure_start_DATE": start_strs,
+            "drug_exposure_start_DATETIME": np.char.add(start_strs, " 00:00:00"),
+            "drug_exposure_end_DATE": end_strs,
+            "drug_exposure_end_DATETIME": np.char.add(end_strs, " 00:00:00"),
+            "verbatim_end_DATE": "",
+            "drug_type_concept_id": DRUG_TYPE_CONCEPT_ID,
+            "stop_reason": "",
+            "refills": rng.integers(0, 4, size=num_rows),
+            "quantity": rng.integers(1, 120, size=num_rows).astype(float),
+            "days_supply": days_supply,
+            "sig": "Take as directed",
+            "route_concept_id": ROUTE_CONCEPT_ID,
+            "lot_number": "",
+            "provider_id": rng.integers(1, 1000, size=num_rows),
+            "visit_occurrence_id": np.arange(num_rows) // 8,
+            "visit_detail_id": 0,
+            "drug_source_value": drug_names[drugs],
+            "drug_source_concept_id": drug_concept_ids[drugs],
+            "route_source_value": "oral",
+            "dose_unit_source_value": "mg",
+            "trace_id": "",
+            "unit_id": "",
+            "load_table_id": "synthetic",
+        }
+    )
+    if num_null_id_rows:
+        df["person_id"] = df["person_id"].astype(float)
+        df.loc[: num_null_id_rows - 1, "person_id"] = np.nan
+    return df[DRUG_EXPOSURE_COLUMNS]
+
+
+def generate_concept(drug_vocab, num_other_concepts=1000):
+    """CONCEPT rows of the drugs as Clinical Drugs plus other drug classes."""
+    concept_ids = [concept_id for concept_id, _ in drug_vocab]
+    concept_names = [concept_name for _, concept_name in drug_vocab]
+    concept_class_ids = ["Clinical Drug"] * len(drug_vocab)
+    for i in range(num_other_concepts):
+        concept_ids.append(30000000 + i)
+        concept_names.append(f"concept {i}")
+        concept_class_ids.append(
+            OTHER_CONCEPT_CLASS_IDS[i % len(OTHER_CONCEPT_CLASS_IDS)]
+        )
+    concept_ids += [DRUG_TYPE_CONCEPT_ID, ROUTE_CONCEPT_ID]
+    concept_names += ["Prescription written", "Oral"]
+    concept_class_ids += ["Drug Type", "Route"]
+    num_concepts = len(concept_ids)
+    return pd.DataFrame(
+        {
+            "concept_id": concept_ids,
+            "concept_name": concept_names,
+            "domain_id": "Drug",
+            "vocabulary_id": "RxNorm",
+            "concept_class_id": concept_class_ids,
+            "standard_concept": "S",
+            "concept_code": [str(concept_id) for concept_id in concept_ids],
+            "valid_start_date": ["1970-01-01"] * num_concepts,
+            "valid_end_date": ["2099-12-31"] * num_concepts,
+            "invalid_reason": "",
+        }
+    )
+
+
+def generate_demographics(rng, patient_ids):
+    """Demographics rows with DEMOGRAPHICS_COLUMNS for every patient ID."""
+    num_patients = len(patient_ids)
+    birth_days = np.datetime64("1930-01-01", "D") + rng.integers(
+        32000, size=num_patients
+    )
+    birth_dates = pd.DatetimeIndex(birth_days)
+    df = pd.DataFrame(
+        {
+            "person_id": patient_ids,
+            "year_of_birth": birth_dates.year,
+            "month_of_birth": birth_dates.month,
+            "day_of_birth": birth_dates.day,
+            "gender": np.array(GENDERS)[rng.integers(len(GENDERS), size=num_patients)],
+            "race": np.array(RACES)[rng.integers(len(RACES), size=num_patients)],
+            "ethnicity": np.array(ETHNICITIES)[
+                rng.integers(len(ETHNICITIES), size=num_patients)
+            ],
+        }
+    )
+    return df[DEMOGRAPHICS_COLUMNS]
+
+
+def write_frames(df, paths, write_frame):
+    """Split df into one frame per path, in row order."""
+    for path, frame_rows in zip(paths, np.array_split(np.arange(len(df)), len(paths))):
+        write_frame(df.iloc[frame_rows], path)
+
+
+def write_synthetic_inputs(
+    output_dir,
+    num_patients=10000,
+    num_meddra_rows=100000,
+    num_drug_exposure_rows=50000,
+    num_meddra_frames=4,
+    num_drug_exposure_frames=2,
+    seed=0,
+    num_meddra_terms=2000,
+    num_drugs=500,
+    zipf_exponent=1.1,
+    start_date="2020-01-01",
+    num_days=366,
+    num_null_id_rows=0,
+):
+    """Write synthetic versions of all generate_patient_db() inputs.
+
+    Frame names match the patterns run_generate.py reads: all_POS_batch
+    parquet extractions, gzipped drug_exposure and concept CSVs with a .csv
+    extension, and a demographics parquet. Returns the run_generate.py
+    path arguments.
+    """
+    rng = np.random.default_rng(seed)
+    patient_ids = np.arange(1000000, 1000000 + num_patients)
+    paths = {
+        "demographics_path": f"{output_dir}/demographics.parquet",
+        "meddra_extractions_dir": f"{output_dir}/labeled_extractions",
+        "drug_exposure_dir": f"{output_dir}/drug_exposure",
+        "concept_dir": f"{output_dir}/concept",
+    }
+    for key in ["meddra_extractions_dir", "drug_exposure_dir", "concept_dir"]:
+        os.makedirs(paths[key], exist_ok=True)
+
+    print(f"Writing synthetic demographics of {num_patients} patients", flush=True)
+    demographics = generate_demographics(rng, patient_ids)
+    demographics.to_parquet(paths["demographics_path"], index=False)
+
+    print(f"Writing {num_meddra_rows} synthetic meddra extractions", flush=True)
+    meddra_vocab = create_meddra_vocab(num_meddra_terms)
+    meddra_extractions = generate_meddra_extractions(
+        rng,
+        patient_ids,
+        num_meddra_rows,
+        meddra_vocab,
+        start_date,
+        num_days,
+        zipf_exponent,
+    )
+    meddra_paths = [
+        f"{paths['meddra_extractions_dir']}/all_POS_batch{i:03d}_0.parquet"
+        for i in range(num_meddra_frames)
+    ]
+    write_frames(
+        meddra_extractions,
+        meddra_paths,
+        lambda frame, path: frame.to_parquet(path, index=False),
+    )
+
+    print(f"Writing {num_drug_exposure_rows} synthetic drug exposures", flush=True)
+    drug_vocab = create_drug_vocab(num_drugs)
+    drug_exposure = generate_drug_exposure(
+        rng,
+        patient_ids,
+        num_drug_exposure_rows,
+        drug_vocab,
+        start_date,
+        num_days,
+        zipf_exponent,
+        num_null_id_rows=num_null_id_rows,
+    )
+    drug_exposure_paths = [
+        f"{paths['drug_exposure_dir']}/drug_exposure{i:012d}.csv"
+        for i in range(num_drug_exposure_frames)
+    ]
+    # get_df() reads .csv paths as gzipped CSVs
+    write_frames(
+        drug_exposure,
+        drug_exposure_paths,
+        lambda frame, path: frame.to_csv(path, index=False, compression="gzip"),
+    )
+
+    print("Writing synthetic CONCEPT table", flush=True)
+    concept = generate_concept(drug_vocab)
+    concept.to_csv(
+        f"{paths['concept_dir']}/concept.csv", index=False, compression="gzip"
+    )
+    return paths
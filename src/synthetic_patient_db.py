@@ -0,0 +1,303 @@
+# Seeded synthetic PatientDBs for benchmarks, no PHI
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from data_schema import Event, Patient, Visit
+from patient_db import PatientDB
+
+# Concept texts get_diagnosis_events() turns into DiagnosisEvents, they lead
+# the MedDRA vocabulary so the Zipfian draws hit them often
+MENTAL_HEALTH_TERMS = {
+    "depression": "Depression",
+    "anxiety": "Anxiety",
+    "insomnia": "Insomnia",
+    "distress": "Distress",
+}
+
+# Synthetic MedDRA terms per HLT, HLTs per HLGT and HLGTs per SOC
+MEDDRA_BRANCHING = 8
+
+GENDERS = ["FEMALE", "MALE", "UNKNOWN"]
+RACES = ["White", "Black or African American", "Asian", "Other", "Unknown"]
+ETHNICITIES = ["Not Hispanic or Latino", "Hispanic or Latino", "Unknown"]
+DRUG_FORMS = ["Oral Tablet", "Oral Capsule", "Injectable Solution", "Topical Cream"]
+DRUG_STRENGTHS = ["5 MG", "10 MG", "20 MG", "50 MG", "100 MG", "500 MG"]
+
+MeddraRow = namedtuple(
+    "MeddraRow",
+    [
+        "SOC",
+        "HLGT",
+        "HLT",
+        "PT",
+        "SOC_CUI",
+        "HLGT_CUI",
+        "HLT_CUI",
+        "PT_CUI",
+        "extracted_CUI",
+        "SOC_text",
+        "HLGT_text",
+        "HLT_text",
+        "PT_text",
+        "concept_text",
+        "PExperiencer",
+        "medID",
+        "note_id",
+        "note_title",
+        "polarity",
+        "pos",
+        "present",
+        "ttype",
+    ],
+)
+
+DrugExposureRow = namedtuple(
+    "DrugExposureRow",
+    [
+        "drug_exposure_id",
+        "person_id",
+        "drug_concept_id",
+        "drug_exposure_start_DATE",
+        "drug_exposure_start_DATETIME",
+        "drug_exposure_end_DATE",
+        "drug_exposure_end_DATETIME",
+        "verbatim_end_DATE",
+        "drug_type_concept_id",
+        "stop_reason",
+        "refills",
+        "quantity",
+        "days_supply",
+        "sig",
+        "route_concept_id",
+        "lot_number",
+        "provider_id",
+        "visit_occurrence_id",
+        "visit_detail_id",
+        "drug_source_value",
+        "drug_source_concept_id",
+        "route_source_value",
+        "dose_unit_source_value",
+        "trace_id",
+        "unit_id",
+        "load_table_id",
+    ],
+)
+
+
+def get_zipf_probabilities(num_values, exponent=1.1):
+    """Bounded Zipf distribution over ranks 1..num_values."""
+    weights = 1.0 / np.arange(1, num_values + 1) ** exponent
+    return weights / weights.sum()
+
+
+def create_meddra_vocab(num_terms):
+    """MedDRA like term records, the mental health terms first."""
+    concept_texts = list(MENTAL_HEALTH_TERMS)
+    concept_texts += [f"term {i}" for i in range(num_terms - len(concept_texts))]
+    vocab = []
+    for i, concept_text in enumerate(concept_texts):
+        hlt = i // MEDDRA_BRANCHING
+        hlgt = hlt // MEDDRA_BRANCHING
+        soc = hlgt // MEDDRA_BRANCHING
+        vocab.append(
+            {
+                "SOC": str(10000000 + soc),
+                "HLGT": str(10100000 + hlgt),
+                "HLT": str(10200000 + hlt),
+                "PT": str(10300000 + i),
+                "SOC_CUI": f"C{soc:07d}",
+                "HLGT_CUI": f"C1{hlgt:06d}",
+                "HLT_CUI": f"C2{hlt:06d}",
+                "PT_CUI": f"C3{i:06d}",
+                "SOC_text": f"soc {soc}",
+                "HLGT_text": f"hlgt {hlgt}",
+                "HLT_text": f"hlt {hlt}",
+                "PT_text": MENTAL_HEALTH_TERMS.get(concept_text, concept_text),
+                "concept_text": concept_text,
+            }
+        )
+    return vocab
+
+
+def create_drug_vocab(num_drugs):
+    """(concept_id, concept_name) of Clinical Drug like names."""
+    return [
+        (
+            40000000 + i,
+            f"drug{i} {DRUG_STRENGTHS[i % len(DRUG_STRENGTHS)]} "
+            f"{DRUG_FORMS[i % len(DRUG_FORMS)]}",
+        )
+        for i in range(num_drugs)
+    ]
+
+
+def assign_parents(rng, num_parents, num_children):
+    """Parent of each child, every parent gets at least one child."""
+    if num_children < num_parents:
+        raise ValueError(
+            f"Can't give {num_parents} parents at least one of {num_children} children"
+        )
+    parents = np.concatenate(
+        [
+            np.arange(num_parents),
+            rng.integers(num_parents, size=num_children - num_parents),
+        ]
+    )
+    return np.sort(parents)
+
+
+def create_meddra_event(rng, term, date_str, patient_id, event_i):
+    row = MeddraRow(
+        extracted_CUI=term["PT_CUI"],
+        PExperiencer="patient",
+        medID=str(event_i),
+        note_id=str(event_i // 4),
+        note_title="Progress Note",
+        polarity="negative" if rng.random() < 0.1 else "positive",
+        pos="NOUN",
+        present="present" if rng.random() < 0.9 else "absent",
+        ttype="ProblemMention",
+        **term,
+    )
+    event = Event(chartdate=date_str, visit_id=date_str, patient_id=patient_id)
+    diagnosis_name = MENTAL_HEALTH_TERMS.get(term["concept_text"])
+    if diagnosis_name:
+        # Like get_diagnosis_events()
+        event.diagnosis_role(
+            diagnosis_name=diagnosis_name, diagnosis_long_name=term["PT_text"]
+        )
+        event.add_meddra_roles(row)
+    else:
+        event.meddra_role(row)
+    return event
+
+
+def create_drug_exposure_event(rng, drug, date_str, patient_id, event_i):
+    drug_concept_id, drug_concept_name = drug
+    days_supply = int(rng.integers(1, 91))
+    end_date_str = (
+        datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=days_supply)
+    ).strftime("%Y-%m-%d")
+    row = DrugExposureRow(
+        drug_exposure_id=event_i,
+        person_id=int(patient_id),
+        drug_concept_id=drug_concept_id,
+        drug_exposure_start_DATE=date_str,
+        drug_exposure_start_DATETIME=f"{date_str} 00:00:00",
+        drug_exposure_end_DATE=end_date_str,
+        drug_exposure_end_DATETIME=f"{end_date_str} 00:00:00",
+        verbatim_end_DATE="",
+        drug_type_concept_id=38000177,
+        stop_reason="",
+        refills=int(rng.integers(0, 4)),
+        quantity=float(rng.integers(1, 120)),
+        days_supply=days_supply,
+        sig="Take as directed",
+        route_concept_id=4132161,
+        lot_number="",
+        provider_id=int(rng.integers(1, 1000)),
+        visit_occurrence_id=event_i // 8,
+        visit_detail_id=0,
+        drug_source_value=drug_concept_name,
+        drug_source_concept_id=drug_concept_id,
+        route_source_value="oral",
+        dose_unit_source_value="mg",
+        trace_id="",
+        unit_id="",
+        load_table_id="synthetic",
+    )
+    event = Event(chartdate=date_str, visit_id=date_str, patient_id=patient_id)
+    event.drug_exposure_role(row, drug_concept_name)
+    return event
+
+
+def generate_synthetic_patient_db(
+    num_patients=1000,
+    num_visits=5000,
+    num_events=20000,
+    seed=0,
+    num_meddra_terms=2000,
+    num_drugs=500,
+    zipf_exponent=1.1,
+    drug_event_fraction=0.3,
+    start_date="2020-01-01",
+    num_days=366,
+    attach=True,
+    name="synthetic",
+):
+    """Build a PatientDB of num_patients/num_visits/num_events from a seed.
+
+    Every patient has a visit and every visit an event. MedDRA terms and drug
+    names are drawn from Zipf distributions, visit dates uniformly from
+    num_days days after start_date; visits of a patient on the same day are
+    merged, so the DB can have slightly fewer visits. Without attach the
+    events are only added to the DB, like generate_patient_db() before
+    attach_events_to_visits().
+    """
+    rng = np.random.default_rng(seed)
+    meddra_vocab = create_meddra_vocab(num_meddra_terms)
+    drug_vocab = create_drug_vocab(num_drugs)
+    start_day = np.datetime64(start_date, "D")
+
+    visit_patients = assign_parents(rng, num_patients, num_visits)
+    visit_days = start_day + rng.integers(num_days, size=num_visits)
+    visit_date_strs = np.datetime_as_string(visit_days, unit="D").tolist()
+    event_visits = assign_parents(rng, num_visits, num_events)
+    is_drug_event = rng.random(num_events) < drug_event_fraction
+    meddra_terms = rng.choice(
+        num_meddra_terms,
+        size=num_events,
+        p=get_zipf_probabilities(num_meddra_terms, zipf_exponent),
+    )
+    drugs = rng.choice(
+        num_drugs, size=num_events, p=get_zipf_probabilities(num_drugs, zipf_exponent)
+    )
+
+    patients = PatientDB(name=name)
+    patient_objs = []
+    for patient_i in range(num_patients):
+        dob = date(1930, 1, 1) + timedelta(days=int(rng.integers(0, 32000)))
+        patient = Patient(
+            patient_id=str(patient_i),
+            patient_date_of_birth=dob,
+            patient_gender=GENDERS[int(rng.integers(len(GENDERS)))],
+            patient_race=RACES[int(rng.integers(len(RACES)))],
+            patient_ethnicity=ETHNICITIES[int(rng.integers(len(ETHNICITIES)))],
+        )
+        patient_objs.append(patient)
+
+    visit_objs = dict()
+    events = []
+    for event_i, visit_i in enumerate(event_visits.tolist()):
+        patient_id = str(visit_patients[visit_i])
+        date_str = visit_date_strs[visit_i]
+        if is_drug_event[event_i]:
+            event = create_drug_exposure_event(
+                rng, drug_vocab[drugs[event_i]], date_str, patient_id, event_i
+            )
+        else:
+            event = create_meddra_event(
+                rng, meddra_vocab[meddra_terms[event_i]], date_str, patient_id, event_i
+            )
+        if not attach:
+            events.append(event)
+            continue
+        visit = visit_objs.get((patient_id, date_str))
+        if visit is None:
+            visit = Visit(
+                date=datetime.strptime(date_str, "%Y-%m-%d"),
+                visit_id=date_str,
+                patient_id=patient_id,
+            )
+            visit_objs[(patient_id, date_str)] = visit
+            patient_objs[int(patient_id)].visits.append(visit)
+        visit.events.append(event)
+
+    for patient in patient_objs:
+        patients.add_patient(patient, entity_id=patient.patient_id)
+    for event in events:
+        patients.add_event(event)
+    print(f"Generated {patients}", flush=True)
+    return patients
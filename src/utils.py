@@ -1,36 +1,345 @@
+import glob
+import hashlib
 import os
 import re
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 
 import dask.dataframe as dd
 import pandas as pd
 
+# Number of CSV rows to parse at a time when filtering rows on read
+CSV_CHUNKSIZE = 1000000
 
-def get_df(path, use_dask=False, debug=False):
+
+def normalize_filters(filters):
+    """Return pyarrow style filters in disjunctive normal form."""
+    if not filters:
+        return []
+    # A flat list of (column, op, value) tuples is a single conjunction
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    return [list(conjunction) for conjunction in filters]
+
+
+def get_filter_mask(df, column, op, value):
+    series = df[column]
+    if op in ["=", "=="]:
+        mask = series == value
+    elif op == "!=":
+        mask = series != value
+    elif op == "<":
+        mask = series < value
+    elif op == "<=":
+        mask = series <= value
+    elif op == ">":
+        mask = series > value
+    elif op == ">=":
+        mask = series >= value
+    elif op == "in":
+        mask = series.isin(list(value))
+    elif op == "not in":
+        mask = ~series.isin(list(value))
+    else:
+        raise ValueError(f"Unhandled filter op: {op}")
+    return mask
+
+
+def filter_df(df, filters):
+    """Apply pyarrow style filters to a pandas or dask dataframe."""
+    filters = normalize_filters(filters)
+    if not filters:
+        return df
+
+    mask = None
+    for conjunction in filters:
+        conjunction_mask = None
+        for column, op, value in conjunction:
+            filter_mask = get_filter_mask(df, column, op, value)
+            if conjunction_mask is None:
+                conjunction_mask = filter_mask
+            else:
+                conjunction_mask = conjunction_mask & filter_mask
+        if mask is None:
+            mask = conjunction_mask
+        else:
+            mask = mask | conjunction_mask
+    return df[mask]
+
+
+def get_filter_columns(filters):
+    filter_columns = []
+    for conjunction in normalize_filters(filters):
+        for column, _, _ in conjunction:
+            if column not in filter_columns:
+                filter_columns.append(column)
+    return filter_columns
+
+
+def read_csv_filtered(path, columns=None, filters=None, chunksize=CSV_CHUNKSIZE):
+    """Read a gzipped CSV with pandas, dropping filtered rows chunk by chunk."""
+    chunks = pd.read_csv(path, compression="gzip", usecols=columns, chunksize=chunksize)
+    df_chunks = [filter_df(chunk, filters) for chunk in chunks]
+    if not df_chunks:
+        return pd.read_csv(path, compression="gzip", usecols=columns, nrows=0)
+    df = pd.concat(df_chunks, sort=False)
+    return df
+
+
+# Object columns with fewer unique values than this fraction of rows become
+# categoricals when compacting a dataframe
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.5
+
+
+def compact_column(series, is_id=False):
+    """Return the smallest lossless dtype version of a column."""
+    if pd.api.types.is_string_dtype(series.dtype):
+        num_unique = series.nunique(dropna=True)
+        if num_unique < CATEGORICAL_MAX_UNIQUE_RATIO * max(len(series), 1):
+            return series.astype("category")
+    elif pd.api.types.is_integer_dtype(series.dtype):
+        # Keep ids 64 bit so they match ids from other tables
+        if not is_id:
+            return pd.to_numeric(series, downcast="integer")
+    elif pd.api.types.is_float_dtype(series.dtype):
+        # Ids come in as floats because of NaNs, compact_df() drops the rows
+        # of null ids so they go back to plain integers
+        if is_id and series.notnull().all() and (series == series.round()).all():
+            return series.astype("int64")
+        float32_series = series.astype("float32")
+        if (float32_series.astype(series.dtype) == series)[series.notnull()].all():
+            return float32_series
+    return series
+
+
+def compact_df(df, id_columns=None):
+    """Shrink dataframe dtypes and print per-column memory before and after.
+
+    Low cardinality strings become categoricals and numerics are downcast
+    when no values are lost. Rows with a null id in id_columns are dropped,
+    since they can't be attached to a patient, and ids are kept as 64 bit
+    integers.
+    """
+    if id_columns is None:
+        id_columns = []
+    id_columns = [column for column in id_columns if column in df.columns]
+    if id_columns:
+        null_ids = df[id_columns].isnull().any(axis=1)
+        if null_ids.any():
+            print(f"Dropping {null_ids.sum()} rows with null {id_columns}")
+            df = df[~null_ids]
+    memory_before = df.memory_usage(index=False, deep=True)
+    compact_columns = dict()
+    for column in df.columns:
+        compact_columns[column] = compact_column(df[column], is_id=column in id_columns)
+    df = pd.DataFrame(compact_columns, index=df.index)
+    memory_after = df.memory_usage(index=False, deep=True)
+
+    print("Compacted dataframe columns:")
+    for column in df.columns:
+        before_mb = memory_before[column] / 1e6
+        after_mb = memory_after[column] / 1e6
+        print(
+            f"\t{column}: {before_mb:.1f} MB -> {after_mb:.1f} MB "
+            f"({df[column].dtype})"
+        )
+    total_before_mb = memory_before.sum() / 1e6
+    total_after_mb = memory_after.sum() / 1e6
+    print(f"\ttotal: {total_before_mb:.1f} MB -> {total_after_mb:.1f} MB", flush=True)
+    return df
+
+
+def compact_table(df, use_dask=False, id_columns=None):
+    if use_dask:
+        # Categories and downcasts would differ between dask partitions
+        print("Skipping dataframe compaction, only pandas dataframes are compacted")
+        return df
+    return compact_df(df, id_columns=id_columns)
+
+
+def get_csv_cache_key(path):
+    """Key a CSV by its absolute path, size and modification time."""
+    abs_path = os.path.abspath(path)
+    path_hash = hashlib.sha1(abs_path.encode("utf-8")).hexdigest()[:16]
+    stat = os.stat(abs_path)
+    return path_hash, f"{path_hash}-{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def type_df_for_parquet(df):
+    """Make object columns with mixed values storable as parquet strings."""
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        inferred_dtype = pd.api.types.infer_dtype(df[column], skipna=True)
+        if inferred_dtype in ["string", "empty"]:
+            continue
+        df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+def convert_csv_to_parquet(path, cache_path):
+    print(f"Converting {path} to parquet cache {cache_path}", flush=True)
+    start_time = time.perf_counter()
+    df = pd.read_csv(path, compression="gzip", low_memory=False)
+    df = type_df_for_parquet(df)
+    # Write to a temporary file first so readers never see a partial file
+    tmp_cache_path = f"{cache_path}.tmp-{os.getpid()}"
+    df.to_parquet(tmp_cache_path, engine="pyarrow", index=False)
+    os.replace(tmp_cache_path, cache_path)
+    elapsed = time.perf_counter() - start_time
+    print(f"Converted {len(df)} rows in {elapsed:.2f}s", flush=True)
+
+
+def get_cached_parquet_path(path, cache_dir):
+    """Return the parquet cache of a gzipped CSV, converting it if needed."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path_hash, cache_key = get_csv_cache_key(path)
+    cache_path = os.path.join(cache_dir, f"{cache_key}.parquet")
+    if os.path.exists(cache_path):
+        print(f"Using parquet cache {cache_path} for {path}")
+        return cache_path
+
+    # Remove stale caches of older versions of this CSV. Only finished
+    # caches end in .parquet, other processes' temporary files are left alone
+    stale_pattern = os.path.join(cache_dir, f"{path_hash}-*.parquet")
+    for stale_cache_path in glob.glob(stale_pattern):
+        print(f"Removing stale parquet cache {stale_cache_path}")
+        try:
+            os.remove(stale_cache_path)
+        except FileNotFoundError:
+            pass  # Removed by another process
+    convert_csv_to_parquet(path, cache_path)
+    return cache_path
+
+
+def warm_csv_cache(paths, cache_dir, num_workers=1):
+    """Convert CSVs to their parquet caches ahead of time."""
+    print(f"Warming parquet cache {cache_dir} for {len(paths)} CSVs")
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        cache_paths = list(
+            executor.map(lambda path: get_cached_parquet_path(path, cache_dir), paths)
+        )
+    return cache_paths
+
+
+def read_parquet(path, df_lib, columns=None, filters=None):
+    # pyarrow skips row groups and rows that don't match the filters
+    df = df_lib.read_parquet(
+        path,
+        engine="pyarrow",
+        columns=columns,
+        filters=normalize_filters(filters) or None,
+    )
+    # Older pyarrow/dask versions only prune row groups with the filters,
+    # make sure the remaining rows are filtered as well
+    df = filter_df(df, filters)
+    return df
+
+
+def get_df(
+    path,
+    use_dask=False,
+    debug=False,
+    columns=None,
+    filters=None,
+    cache_dir=None,
+    compact=False,
+    id_columns=None,
+):
+    """Read a dataframe from a parquet, HDF or gzipped CSV path.
+
+    When cache_dir is set, gzipped CSVs are converted to parquet once and
+    later reads use the parquet cache instead of parsing the CSV again.
+    When compact is set, pandas dataframes are compacted with compact_df().
+    """
     if use_dask:
         df_lib = dd
     else:
         df_lib = pd
 
+    # Make sure the columns we filter on are read in as well
+    read_columns = columns
+    if columns is not None:
+        read_columns = list(columns)
+        for filter_column in get_filter_columns(filters):
+            if filter_column not in read_columns:
+                read_columns.append(filter_column)
+
     if ".parquet" in path:
-        df = df_lib.read_parquet(path, engine="pyarrow")
+        df = read_parquet(path, df_lib, columns=read_columns, filters=filters)
     elif ".hdf" in path:
-        df = df_lib.read_hdf(path)
+        df = df_lib.read_hdf(path, columns=read_columns)
+        df = filter_df(df, filters)
+    elif ".csv" in path and cache_dir:
+        # dask paths may be globs over many CSVs
+        csv_paths = sorted(glob.glob(path)) if use_dask else [path]
+        cache_paths = [
+            get_cached_parquet_path(csv_path, cache_dir) for csv_path in csv_paths
+        ]
+        cache_path = cache_paths if use_dask else cache_paths[0]
+        df = read_parquet(cache_path, df_lib, columns=read_columns, filters=filters)
     elif ".csv" in path:
         # FIXME, files that are gzipped need to have the correct extension
         # .gz
-        df = df_lib.read_csv(path, compression="gzip")
+        if use_dask:
+            df = df_lib.read_csv(path, compression="gzip", usecols=read_columns)
+            df = filter_df(df, filters)
+        elif filters:
+            df = read_csv_filtered(path, columns=read_columns, filters=filters)
+        else:
+            df = df_lib.read_csv(path, compression="gzip", usecols=read_columns)
     else:
         print(f"Unhandled path, no matching file extension: {path}")
         sys.exit(1)
 
+    # Drop the columns that were only needed for filtering
+    if columns is not None and len(read_columns) != len(columns):
+        df = df[list(columns)]
+
     print(f"Successfully read dataframe from path: {path}")
+    if compact:
+        df = compact_table(df, use_dask, id_columns)
+    return df
+
+
+def read_df_frame(path, use_dask=False, columns=None, filters=None, cache_dir=None):
+    """Read a single frame and report its read throughput."""
+    start_time = time.perf_counter()
+    df = get_df(path, use_dask, columns=columns, filters=filters, cache_dir=cache_dir)
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    size_mb = os.path.getsize(path) / 1e6
+    throughput_str = f"{size_mb:.1f} MB in {elapsed:.2f}s "
+    throughput_str += f"({size_mb / elapsed:.1f} MB/s"
+    # Counting rows would force a dask dataframe to be computed
+    if not use_dask:
+        throughput_str += f", {len(df) / elapsed:.0f} rows/s"
+    print(f"\tRead {path}: {throughput_str})", flush=True)
     return df
 
 
-def get_df_frames(df_frames_dir, pattern_re, use_dask=False, debug=False):
-    paths = [path for path in os.listdir(df_frames_dir) if re.match(pattern_re, path)]
+def get_df_frames(
+    df_frames_dir,
+    pattern_re,
+    use_dask=False,
+    debug=False,
+    columns=None,
+    filters=None,
+    num_workers=1,
+    cache_dir=None,
+    compact=False,
+    id_columns=None,
+):
+    """Read and concatenate all frames in df_frames_dir matching pattern_re.
+
+    Frames are read by a pool of num_workers threads, pyarrow and the pandas
+    CSV parser release the GIL while reading. Frames are concatenated in
+    sorted path order no matter which read finishes first.
+    """
+    paths = sorted(
+        path for path in os.listdir(df_frames_dir) if re.match(pattern_re, path)
+    )
     paths_full = [os.path.join(df_frames_dir, path) for path in paths]
     # import pdb;pdb.set_trace()
     # Only load one frame for debug mode
@@ -40,9 +349,40 @@ def get_df_frames(df_frames_dir, pattern_re, use_dask=False, debug=False):
     print("Attempting to read df from paths: ")
     for path in paths_full:
         print(f"\t{path}")
-    df_frames = [get_df(path, use_dask) for path in paths_full]
+
+    start_time = time.perf_counter()
+    num_workers = max(1, min(num_workers, len(paths_full)))
+    if num_workers > 1:
+        print(f"Reading {len(paths_full)} frames with {num_workers} workers")
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # map() yields results in the order of paths_full
+            df_frames = list(
+                executor.map(
+                    lambda path: read_df_frame(
+                        path, use_dask, columns, filters, cache_dir
+                    ),
+                    paths_full,
+                )
+            )
+    else:
+        df_frames = [
+            read_df_frame(path, use_dask, columns, filters, cache_dir)
+            for path in paths_full
+        ]
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    total_size_mb = sum(os.path.getsize(path) for path in paths_full) / 1e6
+    print(
+        f"Read {len(paths_full)} frames, {total_size_mb:.1f} MB in {elapsed:.2f}s "
+        f"({total_size_mb / elapsed:.1f} MB/s)",
+        flush=True,
+    )
+
     df = pd.concat(df_frames, sort=False)
     print("Successfully read dataframe from paths")
+    # Compact after concatenating, categoricals with different categories
+    # concatenate back to object columns
+    if compact:
+        df = compact_table(df, use_dask, id_columns)
     return df
 
 
@@ -54,17 +394,47 @@ def get_table(
     extension=".csv",
     use_dask=False,
     debug=False,
+    columns=None,
+    filters=None,
+    num_workers=1,
+    cache_dir=None,
+    compact=False,
+    id_columns=None,
 ):
     print("get_table()")
+    if columns is not None:
+        print(f"\tcolumns: {columns}")
+    if filters:
+        print(f"\tfilters: {filters}")
     if use_dask:
         print("\tUsing dask")
         table_path = f"{table_dir}/{prefix}{pattern}{extension}"
         print(f"\ttable_path: {table_path}")
-        df = get_df(table_path, use_dask, debug)
+        df = get_df(
+            table_path,
+            use_dask,
+            debug,
+            columns=columns,
+            filters=filters,
+            cache_dir=cache_dir,
+            compact=compact,
+            id_columns=id_columns,
+        )
     else:
         print("\tGetting df frames")
         pattern_re_full = f"{prefix}{pattern_re}{extension}"
-        df = get_df_frames(table_dir, pattern_re_full, use_dask, debug)
+        df = get_df_frames(
+            table_dir,
+            pattern_re_full,
+            use_dask,
+            debug,
+            columns=columns,
+            filters=filters,
+            num_workers=num_workers,
+            cache_dir=cache_dir,
+            compact=compact,
+            id_columns=id_columns,
+        )
     return df
 
 
@@ -73,9 +443,8 @@ def get_person_ids(df, use_dask=False):
     if use_dask:
         unique_person_ids = unique_person_ids.compute()
 
-    nunique_person_ids = df.person_id.nunique()
-    if use_dask:
-        nunique_person_ids = nunique_person_ids.compute()
+    # Count the unique values we already have instead of scanning again
+    nunique_person_ids = len(unique_person_ids)
 
     print(f"Found {nunique_person_ids} person IDs")
     return unique_person_ids
@@ -86,9 +455,7 @@ def get_patient_ids(df, use_dask=False):
     if use_dask:
         unique_patient_ids = unique_patient_ids.compute()
 
-    nunique_patient_ids = df.patid.nunique()
-    if use_dask:
-        nunique_patient_ids = nunique_patient_ids.compute()
+    nunique_patient_ids = len(unique_patient_ids)
 
     print(f"Found {nunique_patient_ids} patient IDs")
     return unique_patient_ids
@@ -99,9 +466,7 @@ def get_dates(df, use_dask=False):
     if use_dask:
         unique_dates = unique_dates.compute()
 
-    nunique_dates = df.date.nunique()
-    if use_dask:
-        nunique_dates = nunique_dates.compute()
+    nunique_dates = len(unique_dates)
 
     print(f"Found {nunique_dates} dates")
     return unique_dates